@@ -0,0 +1,76 @@
+# Parses arguments (max_players values, baseline file and other stuff)
+# Runs benchmarks of game session hot paths
+
+
+# Imports----------------------------------------------------------------------
+from argparse import ArgumentParser  # Parsing command line arguments
+from os.path import abspath, exists, join, sep
+from sys import path, argv, exit
+
+# Main method -----------------------------------------------------------------
+if __name__ == '__main__':
+    # Find the script absolute path, cut the working directory
+    a_path = sep.join(abspath(argv[0]).split(sep)[:-1])
+    # Append script working directory into PYTHONPATH
+    path.append(a_path)
+    path.append(join(a_path, 'server'))  # server modules import each other without package name
+
+    from server.benchmark import BENCHMARKS, DEFAULT_MAX_PLAYERS, DEFAULT_SEED, DEFAULT_REPEAT, \
+        DEFAULT_TOLERANCE, run_benchmarks, compare_results, environment_differences, load_baseline, save_baseline, \
+        print_results, print_comparison
+
+    default_baseline = join(a_path, 'benchmark_baseline.json')
+
+    # Parsing arguments
+    parser = ArgumentParser(description='Benchmarks of game session hot paths')
+    parser.add_argument('-m', '--max-players', type=int, nargs='+',\
+                        help='max_players values of benchmarked sessions, '\
+                        'defaults to %s' % ' '.join(map(str, DEFAULT_MAX_PLAYERS)), \
+                        default=list(DEFAULT_MAX_PLAYERS))
+    parser.add_argument('-k', '--benchmark', nargs='+', choices=[name for name, benchmark in BENCHMARKS],\
+                        help='Benchmarks to run, all if not given')
+    parser.add_argument('--seed', type=int,\
+                        help='Seed of random map pieces, fleets and shooting order, '\
+                        'defaults to %d' % DEFAULT_SEED, \
+                        default=DEFAULT_SEED)
+    parser.add_argument('--repeat', type=int,\
+                        help='Measurements of each benchmark (fastest is reported), '\
+                        'defaults to %d' % DEFAULT_REPEAT, \
+                        default=DEFAULT_REPEAT)
+    parser.add_argument('--save', nargs='?', const=default_baseline,\
+                        help='Save results as baseline, defaults to %s' % default_baseline)
+    parser.add_argument('--compare', nargs='?', const=default_baseline,\
+                        help='Compare results to baseline saved on same machine (exit status 1 on regression), '\
+                        'defaults to %s' % default_baseline)
+    parser.add_argument('--tolerance', type=float,\
+                        help='Relative slowdown compared to baseline reported as regression, '\
+                        'defaults to %.2f' % DEFAULT_TOLERANCE, \
+                        default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    # baseline is not part of repository, timings of other machine (or Python, numpy) say nothing about this one
+    if args.compare and not exists(args.compare):
+        print "No baseline %s, save one on this machine first with --save" % args.compare
+        exit(2)
+
+    report = run_benchmarks(args.max_players, args.seed, args.repeat, args.benchmark)
+
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        differences = environment_differences(report, baseline)
+        for key, baseline_value, value in differences:
+            print "Baseline was measured with %s %s, not %s" % (key, baseline_value, value)
+        comparison = compare_results(report['results'], baseline['results'], args.tolerance)
+        print_comparison(comparison)
+        if differences:  # results are shown, but they can not fail the comparison
+            comparison = []
+    else:
+        comparison = []
+        print_results(report['results'])
+
+    if args.save:
+        save_baseline(report, args.save)
+        print "Baseline saved to %s" % args.save
+
+    if any(regression for name, max_players, baseline_time, time, regression in comparison):
+        exit(1)
@@ -9,7 +9,7 @@ from sys import path, argv
 
 from client.main import __info, ___VER, client_main
 from common import DEFAULT_MQ_INET_ADDR,\
-    DEFAULT_MQ_PORT
+    DEFAULT_MQ_PORT, HEARTBEAT_INTERVAL, PLAYER_TIMEOUT
 
 # Main method -----------------------------------------------------------------
 if __name__ == '__main__':
@@ -29,6 +29,14 @@ if __name__ == '__main__':
                         help='Port of RabbitMQ, ' \
                         'defaults to %d' % DEFAULT_MQ_PORT,
                         default=DEFAULT_MQ_PORT)
+    parser.add_argument('-q', '--single-queue', action='store_true',
+                        help='Send all RPC-s to one server queue (server must be started with same option)')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='Send RPC-s in compact msgpack format (falls back to JSON if msgpack is not installed)')
+    parser.add_argument('--heartbeat-interval', type=float,
+                        help='Seconds without RPC-s after which player activity is announced to server, '
+                        'defaults to %d (server times player out after %d)' % (HEARTBEAT_INTERVAL, PLAYER_TIMEOUT),
+                        default=HEARTBEAT_INTERVAL)
     args = parser.parse_args()
 
     # Run main function of Client
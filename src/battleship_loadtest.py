@@ -0,0 +1,103 @@
+# Parses arguments (number of bots, broker and other stuff)
+# Runs bots playing against server and reports latency and throughput of RPC-s
+
+
+# Imports----------------------------------------------------------------------
+from argparse import ArgumentParser  # Parsing command line arguments
+from os import devnull
+from os.path import abspath, join, sep
+import sys
+from sys import path, argv
+
+from common import DEFAULT_MQ_INET_ADDR, DEFAULT_MQ_PORT, DEFAULT_PREFETCH_COUNT, TRANSPORTS, TRANSPORT_MEMORY, \
+    LOG_LEVELS, init_logging
+
+# Main method -----------------------------------------------------------------
+if __name__ == '__main__':
+    # Find the script absolute path, cut the working directory
+    a_path = sep.join(abspath(argv[0]).split(sep)[:-1])
+    # Append script working directory into PYTHONPATH
+    path.append(a_path)
+    path.append(join(a_path, 'server'))  # server modules import each other without package name
+
+    from server.loadtest import DEFAULT_BOTS, DEFAULT_PLAYERS, DEFAULT_GAMES, DEFAULT_TIMEOUT, run_load, \
+        start_server, print_report
+
+    # Parsing arguments
+    parser = ArgumentParser(description='Load test of battleship server, server is run in the same process '\
+                            'without broker unless RabbitMQ transport is chosen')
+    parser.add_argument('-n', '--bots', type=int,\
+                        help='Number of bots, defaults to %d' % DEFAULT_BOTS, \
+                        default=DEFAULT_BOTS)
+    parser.add_argument('--players', type=int,\
+                        help='Bots in one game session, defaults to %d' % DEFAULT_PLAYERS, \
+                        default=DEFAULT_PLAYERS)
+    parser.add_argument('-g', '--games', type=int,\
+                        help='Games played in each session, defaults to %d' % DEFAULT_GAMES, \
+                        default=DEFAULT_GAMES)
+    parser.add_argument('--seed', type=int,\
+                        help='Seed of random fleets and shots, defaults to 0', \
+                        default=0)
+    parser.add_argument('--timeout', type=float,\
+                        help='Seconds bot waits for response or its turn, defaults to %d' % DEFAULT_TIMEOUT, \
+                        default=DEFAULT_TIMEOUT)
+    parser.add_argument('-t', '--transport', choices=TRANSPORTS,\
+                        help='Transport of messages: %s runs server in the same process, '\
+                        'amqp connects bots to server NAME through RabbitMQ (server is started separately), '\
+                        'defaults to %s' % (TRANSPORT_MEMORY, TRANSPORT_MEMORY), \
+                        default=TRANSPORT_MEMORY)
+    parser.add_argument('-H', '--host',\
+                        help='INET address of RabbitMQ, defaults to %s' % DEFAULT_MQ_INET_ADDR, \
+                        default=DEFAULT_MQ_INET_ADDR)
+    parser.add_argument('-p', '--port', type=int,\
+                        help='Port of RabbitMQ, defaults to %d' % DEFAULT_MQ_PORT, \
+                        default=DEFAULT_MQ_PORT)
+    parser.add_argument('--name', type=str, \
+                        help='Name of Game Server, defaults to loadtest', \
+                        default='loadtest')
+    parser.add_argument('-q', '--single-queue', action='store_true', \
+                        help='Send all RPC-s to one queue (server must use the same mode)')
+    parser.add_argument('-b', '--binary', action='store_true', \
+                        help='Send RPC-s in msgpack format')
+    parser.add_argument('-w', '--workers', type=int, \
+                        help='Number of threads handling RPC-s of server in the same process, defaults to 0', \
+                        default=0)
+    parser.add_argument('--prefetch', type=int, \
+                        help='Number of RPC requests delivered to server in the same process before '\
+                        'acknowledging, defaults to %d' % DEFAULT_PREFETCH_COUNT, \
+                        default=DEFAULT_PREFETCH_COUNT)
+    parser.add_argument('--log-level', choices=LOG_LEVELS, \
+                        help='Lowest level of records logged by server in the same process, defaults to info', \
+                        default='info')
+    parser.add_argument('--log-sample', type=int, \
+                        help='Log only every N-th debug and info record of each message, defaults to 1 (all)', \
+                        default=1)
+    parser.add_argument('--quiet', action='store_true', \
+                        help='Discard log of server in the same process')
+    args = parser.parse_args()
+
+    if args.players < 2 or args.bots < args.players or args.bots % args.players:
+        parser.error('--bots must be a multiple of --players (at least 2)')
+    if args.log_sample < 1:
+        parser.error('--log-sample must be at least 1')
+
+    # server in the same process is not sharded and does not replicate
+    args.shard, args.shards, args.replicate, args.standby = 0, 1, False, False
+
+    if args.transport == TRANSPORT_MEMORY:
+        log_handler = init_logging(args.log_level, args.log_sample, open(devnull, 'w') if args.quiet else None)
+        stop_server = start_server(args)
+    else:
+        log_handler = stop_server = None
+
+    try:
+        report, failed_bots, elapsed = run_load(args)
+    finally:
+        if stop_server is not None:
+            stop_server()
+        if log_handler is not None:
+            log_handler.close()  # server log is written before report
+
+    print_report(report, failed_bots, elapsed)
+    if failed_bots:
+        sys.exit(1)
@@ -4,12 +4,14 @@
 
 # Imports----------------------------------------------------------------------
 from argparse import ArgumentParser  # Parsing command line arguments
+from os import environ
 from os.path import abspath, sep
 from sys import path, argv
 
-from server.main import __info, ___VER, server_main
+from server.main import __info, ___VER, server_main, run_shards
+from server.loop_main import loop_server_main
 from common import DEFAULT_MQ_INET_ADDR,\
-    DEFAULT_MQ_PORT
+    DEFAULT_MQ_PORT, DEFAULT_PREFETCH_COUNT, LOG_LEVELS
 
 # Main method -----------------------------------------------------------------
 if __name__ == '__main__':
@@ -31,7 +33,69 @@ if __name__ == '__main__':
                         default=DEFAULT_MQ_PORT)
     parser.add_argument('-n', '--name', type=str, \
                         help='Name of Game Server')
+    parser.add_argument('-q', '--single-queue', action='store_true', \
+                        help='Receive all RPC-s from one queue (method in message header) '\
+                        'instead of queue per method')
+    parser.add_argument('--prefetch', type=int, \
+                        help='Number of RPC requests delivered before acknowledging, '\
+                        'defaults to %d' % DEFAULT_PREFETCH_COUNT, \
+                        default=DEFAULT_PREFETCH_COUNT)
+    parser.add_argument('-w', '--workers', type=int, \
+                        help='Number of threads handling RPC-s (0 handles them on connection thread), '\
+                        'defaults to 0', \
+                        default=0)
+    parser.add_argument('-l', '--io-loop', action='store_true', \
+                        help='Run server in one thread using IO loop of pika SelectConnection '\
+                        '(--workers is ignored)')
+    parser.add_argument('-b', '--binary', action='store_true', \
+                        help='Publish game and session messages in compact msgpack format '\
+                        '(clients need msgpack installed, RPC responses use format of request)')
+    parser.add_argument('-s', '--shards', type=int, \
+                        help='Number of processes sharing game sessions of server (by consistent hash of '\
+                        'session name), defaults to 1', \
+                        default=1)
+    parser.add_argument('--shard', type=int, \
+                        help='Index of shard to run (for running shards on different hosts), '\
+                        'all shards are started if not given')
+    parser.add_argument('-d', '--data-dir', type=str, \
+                        help='Directory for saving game sessions, so they are restored after restart '\
+                        '(sessions are kept only in memory if not given)')
+    parser.add_argument('-r', '--replicate', action='store_true', \
+                        help='Publish changes of game sessions for standby server')
+    parser.add_argument('--standby', action='store_true', \
+                        help='Run as hot standby of server with same name, taking over when it stops '\
+                        'announcing itself')
+    parser.add_argument('--replication-secret', type=str, \
+                        help='Secret shared by server and its standby for signing replication records, '\
+                        'defaults to BATTLESHIP_REPLICATION_SECRET environment variable', \
+                        default=environ.get('BATTLESHIP_REPLICATION_SECRET'))
+    parser.add_argument('-m', '--metrics-port', type=int, \
+                        help='Serve metrics at http://127.0.0.1:PORT/metrics (shards use following ports), '\
+                        'metrics are not served if not given')
+    parser.add_argument('--stats-interval', type=float, \
+                        help='Seconds between publishing metrics to <name>.stats topic, '\
+                        'defaults to 0 (not published)', \
+                        default=0)
+    parser.add_argument('--log-level', choices=LOG_LEVELS, \
+                        help='Lowest level of logged records, defaults to info (debug logs every request)', \
+                        default='info')
+    parser.add_argument('--log-sample', type=int, \
+                        help='Log only every N-th debug and info record of each message, defaults to 1 (all)', \
+                        default=1)
     args = parser.parse_args()
 
+    if (args.replicate or args.standby) and (args.io_loop or args.shards > 1):
+        parser.error('--replicate and --standby can not be used with --io-loop or --shards')
+    if (args.replicate or args.standby) and not args.replication_secret:
+        parser.error('--replicate and --standby need --replication-secret')
+    if args.log_sample < 1:
+        parser.error('--log-sample must be at least 1')
+
     # Run Server main method
-    server_main(args)
+    main = loop_server_main if args.io_loop else server_main
+
+    if args.shards > 1 and args.shard is None:
+        run_shards(args, main)
+    else:
+        args.shard = args.shard or 0
+        main(args)
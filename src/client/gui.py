@@ -1,10 +1,17 @@
 import tkMessageBox
 import ttk
 import re
+from bisect import bisect_left
+from Queue import Queue, Empty
 from protocol import *
 from gui_helpers import *
 
 
+RESPONSE_POLL_INTERVAL = 20  # milliseconds between checking whether response to asynchronous call has arrived
+SERVER_WATCH_INTERVAL = 500  # milliseconds between checking announcements of connected server
+SERVER_LOST_TIME = 2  # seconds without announcements after which server is considered gone
+
+
 class RootWindow(Tkinter.Tk, object):
     """
     The main GUI window.
@@ -19,6 +26,8 @@ class RootWindow(Tkinter.Tk, object):
         self.player_name = None
         self.game_name = None
         self.protocol("WM_DELETE_WINDOW", self.on_exit)
+        self.gui_tasks = Queue()  # callbacks of listeners waiting to be run in GUI thread
+        self.run_gui_tasks()
 
         # Setup all the frames
         self.server_selection_frame = ServerSelectionFrame(self)
@@ -26,13 +35,17 @@ class RootWindow(Tkinter.Tk, object):
         self.game_setup_frame = GameSetupFrame(self)
         self.game_frame = GameFrame(self)
 
-        # Setup connections
-        self.rpc = RPCClient(args, self)
-        self.global_listener = GlobalListener(args, self.server_selection_frame.update_servers_list)
+        # Setup connections, all of them share one connection to RabbitMQ
+        self.connection_manager = ConnectionManager(args)
+        self.rpc = RPCClient(self.connection_manager, args, self)
+        self.global_listener = GlobalListener(self.connection_manager,
+                                              self.in_gui(self.server_selection_frame.update_servers_list))
         self.server_listener = None
         self.game_listener = None
         self.player_listener = None
         self.player_announcements = None
+        self.server_watch = None  # id of scheduled watch_server call
+        self.server_lost = False
 
 
         # Show the first frame
@@ -63,6 +76,8 @@ class RootWindow(Tkinter.Tk, object):
         if self.player_announcements is not None:
             self.player_announcements.exit()
 
+        self.connection_manager.exit()
+
         self.destroy()
 
     def show_frame(self, new_frame):
@@ -88,6 +103,7 @@ class RootWindow(Tkinter.Tk, object):
         """
 
         self.rpc.server_name = server_name
+        self.rpc.set_shard_count(1)  # connect goes to queue shared by shards, response tells the number of shards
 
         response = self.rpc.connect(user=nickname)
 
@@ -99,14 +115,71 @@ class RootWindow(Tkinter.Tk, object):
             self.player_name = nickname
             self.show_frame(self.lobby_frame)
 
-            self.lobby_frame.update_games_list(response['sessions'])
+            self.rpc.set_shard_count(response.get('shards', 1))
+            self.lobby_frame.clear_games_list()
             self.server_listener = ServerListener('{0}.sessions.info'.format(self.rpc.server_name),
-                                                  self.connection_args, self.lobby_frame.update_games_list)
+                                                  self.connection_manager,
+                                                  self.in_gui(self.lobby_frame.apply_games_delta))
+            # every shard has its own sessions list, response has first page of list of shard handling connect
+            for shard in range(response.get('shards', 1)):
+                if shard != response.get('shard', 0):
+                    self.lobby_frame.request_games_list(shard)
+                else:
+                    self.lobby_frame.request_games_list(shard, first_page=response)
             # Also start announcing player activity to server
-            self.player_announcements = PlayerAnnouncements(self.player_name, self.connection_args)
+            self.player_announcements = PlayerAnnouncements(self.player_name, self.rpc,
+                                                            self.connection_args.heartbeat_interval)
             self.player_announcements.start()
+
+            # Also start watching that server is still there
+            if self.server_watch is not None:
+                self.after_cancel(self.server_watch)
+            self.server_lost = False
+            self.server_watch = self.after(SERVER_WATCH_INTERVAL, self.watch_server)
             return True
 
+    def watch_server(self):
+        """
+        Check announcements of the server. If they come back after server has been gone (e.g. standby server took
+        over), connect to the server again.
+        """
+
+        self.server_watch = None
+        if self.player_name is None:  # left server
+            return
+
+        last_seen = self.global_listener.servers.get(self.rpc.server_name, 0)
+
+        if time.time() - last_seen > SERVER_LOST_TIME:
+            if not self.server_lost:
+                LOG.warning('Server %s stopped announcing itself' % self.rpc.server_name)
+            self.server_lost = True
+        elif self.server_lost:
+            self.server_lost = False
+            self.reconnect_server()
+
+        self.server_watch = self.after(SERVER_WATCH_INTERVAL, self.watch_server)
+
+    def reconnect_server(self):
+        """
+        Connect again to server that came back, sessions list is asked again as changes were missed meanwhile.
+        """
+
+        def on_response(response):
+            # server that took over knows players of game sessions, so our name can already be taken by us
+            if response['err']:
+                LOG.warning('Reconnecting to server: %s' % response['err'])
+
+            self.lobby_frame.clear_games_list()
+            shard_count = self.rpc.shard_ring.shard_count if self.rpc.shard_ring is not None else 1
+            for shard in range(shard_count):
+                self.lobby_frame.request_games_list(shard)
+
+            if self.game_name is not None:
+                self.game_frame.add_message('Reconnected to server')
+
+        self.call_async('connect', on_response, user=self.player_name)
+
     def leave_server(self):
         """
         Leave the server and return to the server_selection_frame
@@ -156,7 +229,8 @@ class RootWindow(Tkinter.Tk, object):
             self.game_size = game_size
             self.game_setup_frame.join_game(game_size, response['map'], owner=True)
             self.game_listener = GameListener('{0}.{1}.info'.format(self.rpc.server_name, self.game_name),
-                                              self.connection_args, self.game_setup_frame.update_players_list)
+                                              self.connection_manager,
+                                              self.in_gui(self.game_setup_frame.update_players_list))
 
             self.game_setup_frame.update_players_list(joined=self.player_name)
             self.game_setup_frame.update_players_list(owner=self.player_name)
@@ -165,23 +239,35 @@ class RootWindow(Tkinter.Tk, object):
 
     def join_game(self, game_name, game_size):
         """
-        Join a game on the server.
+        Join a game on the server. Window is not blocked while waiting for the server, joined_game is called
+        with the response.
 
         Args:
             game_name (str): Name of the game
             game_size (int): Max number of players
+        """
+
+        self.call_async('join_session', lambda response: self.joined_game(game_name, game_size, response),
+                        user=self.player_name, sname=game_name, delta=True)
+
+    def joined_game(self, game_name, game_size, response):
+        """
+        Show the game after server has responded to join request.
+
+        Args:
+            game_name (str): Name of the game
+            game_size (int): Max number of players
+            response (dict[str, object]): Response from the server
 
         Returns:
             bool: True if operation was a success, False on error
         """
 
-        response = self.rpc.join_session(user=self.player_name, sname=game_name)
-
         if response['err']:
             tkMessageBox.showerror('Error', response['err'])
             return False
 
-        elif 'battlefield' in response:
+        elif 'battlefield' in response or 'shots' in response:
 
             # Lets reconnect to the game
 
@@ -190,15 +276,20 @@ class RootWindow(Tkinter.Tk, object):
             self.game_size = game_size
 
             self.game_listener = GameListener('{0}.{1}.info'.format(self.rpc.server_name, self.game_name),
-                                              self.connection_args, self.game_frame.update_game_info)
+                                              self.connection_manager, self.in_gui(self.game_frame.update_game_info))
 
             self.player_listener = PlayerListener('{0}.{1}.{2}'.format(
                     self.rpc.server_name, self.game_name, self.player_name),
-                    self.connection_args, self.game_frame.update_player_info)
+                    self.connection_manager, self.in_gui(self.game_frame.update_player_info))
 
             players_list = [{'name': player_name} for player_name in response['players_list']]
 
-            self.game_frame.reconnect_game(response['players_list'], response['next'], response['battlefield'], response['map'], self.game_size)
+            if 'shots' in response:  # server sent only our ships and shot history
+                battlefield = battlefield_from_delta(self.game_size, response['ships'], response['shots'])
+            else:
+                battlefield = response['battlefield']
+
+            self.game_frame.reconnect_game(response['players_list'], response['next'], battlefield, response['map'], self.game_size)
 
         else:
             self.show_frame(self.game_setup_frame)
@@ -207,7 +298,8 @@ class RootWindow(Tkinter.Tk, object):
             self.game_size = game_size
             self.game_setup_frame.join_game(game_size, response['map'])
             self.game_listener = GameListener('{0}.{1}.info'.format(self.rpc.server_name, self.game_name),
-                                              self.connection_args, self.game_setup_frame.update_players_list)
+                                              self.connection_manager,
+                                              self.in_gui(self.game_setup_frame.update_players_list))
 
             # Update the players list with excisting players
             self.game_setup_frame.update_players_list(joined=self.player_name)
@@ -319,33 +411,89 @@ class RootWindow(Tkinter.Tk, object):
         self.game_listener.exit()
 
         self.game_listener = GameListener('{0}.{1}.info'.format(self.rpc.server_name, self.game_name),
-                                          self.connection_args, self.game_frame.update_game_info)
+                                          self.connection_manager, self.in_gui(self.game_frame.update_game_info))
 
         self.player_listener = PlayerListener('{0}.{1}.{2}'.format(
                 self.rpc.server_name, self.game_name, self.player_name),
-                self.connection_args, self.game_frame.update_player_info)
+                self.connection_manager, self.in_gui(self.game_frame.update_player_info))
 
         self.game_frame.start_game(players_list, next_player, my_ships, map_pieces, self.game_size)
 
     def shoot(self, x, y):
         """
-        Take a shot
+        Take a shot. Window is not blocked while waiting for the server, result is shown when response arrives.
 
         Args:
             x (int): x-coordinate
             y (int): y-coordinate
+        """
+
+        def on_response(response):
+            if response['err']:
+                tkMessageBox.showerror('Error', response['err'])
+            else:
+                self.game_frame.shot_result(x, y, response['hit'])
 
+        self.call_async('shoot', on_response, user=self.player_name, sname=self.game_name, coords=(y, x))
+
+    def in_gui(self, function):
+        """
+        Give callback for other threads (listeners), it runs the function in GUI thread as Tkinter is not thread safe.
+
+        Args:
+            function: Function to run in GUI thread
         Returns:
-            bool: True if operation was a success, False on error
+            Function that queues the call
         """
 
-        response = self.rpc.shoot(user=self.player_name, sname=self.game_name, coords=(y, x))
+        def queue_call(*args, **kwargs):
+            self.gui_tasks.put((function, args, kwargs))
 
-        if response['err']:
-            tkMessageBox.showerror('Error', response['err'])
-            return False
-        else:
-            return response['hit']
+        return queue_call
+
+    def run_gui_tasks(self):
+        """
+        Run callbacks queued by other threads, checks queue again a bit later.
+        """
+
+        self.after(RESPONSE_POLL_INTERVAL, self.run_gui_tasks)
+        while True:
+            try:
+                function, args, kwargs = self.gui_tasks.get_nowait()
+            except Empty:
+                return
+            function(*args, **kwargs)
+
+    def call_async(self, method_name, callback, **data):
+        """
+        Call method on the server without blocking the window. Callback is called with the response in GUI thread.
+
+        Args:
+            method_name (str): Name of the method
+            callback: Called with response dictionary
+            **data (dict[str, object]): Data to send to the server
+        """
+
+        self.wait_response(self.rpc.call_async(method_name, **data), callback)
+
+    def wait_response(self, future, callback):
+        """
+        Check (without blocking) whether response has arrived, if not check again a bit later.
+
+        Args:
+            future (RPCFuture): future response of the call
+            callback: Called with response dictionary
+        """
+
+        if not future.done():
+            self.after(RESPONSE_POLL_INTERVAL, self.wait_response, future, callback)
+            return
+
+        response = future.result()
+        if response.get('reconnect', False):
+            self.leave_game(connected=False)
+
+        callback(response)
 
 
 class ServerSelectionFrame(Tkinter.Frame, object):
@@ -462,7 +610,12 @@ class LobbyFrame(Tkinter.Frame, object):
         self.games_listbox.grid(row=3, column=3, rowspan=5)
 
         # Other varaibles
-        self.games_list = []
+        self.games = {}  # session name -> session info
+        self.game_names = []  # sorted session names, same order as in games_listbox
+        self.game_shards = {}  # session name -> index of server shard owning session
+        self.games_seq = {}  # shard -> sequence number of last sessions list change applied
+        self.resync_deltas = {}  # shard -> changes received while waiting for sessions list of shard
+        self.games_pages = {}  # shard -> pages of sessions list of shard received so far
 
     def leave_server(self):
         """
@@ -505,34 +658,143 @@ class LobbyFrame(Tkinter.Frame, object):
         else:
             self.join_game_button.configure(state=Tkinter.DISABLED)
 
-    def update_games_list(self, games_list):
+    def clear_games_list(self):
+        """
+        Forget games of previous server.
+        """
+
+        self.games, self.game_names, self.game_shards = {}, [], {}
+        self.games_seq, self.resync_deltas, self.games_pages = {}, {}, {}
+        self.games_listbox.delete(0, Tkinter.END)
+
+    def set_games_list(self, games_list, seq, shard=0):
         """
-        Update the list of games on this server.
+        Show the whole list of games on server (shard).
 
         Args:
-            games_list list[dict[str, object]]:
+            games_list list[dict[str, object]]: session infos
+            seq (int): sequence number of the list
+            shard (int): index of server shard the list is from
+        """
 
+        for game_name in [game_name for game_name, game_shard in self.game_shards.items() if game_shard == shard]:
+            self.remove_game(game_name)
+
+        for game in games_list:
+            self.put_game(game, shard)
+
+        self.games_seq[shard] = seq
+
+    def apply_games_delta(self, seq, op, session, shard=0):
         """
+        Apply change of games list received from server, games list is asked again if some changes are missed.
 
-        new_games_list = []
-        for new_game in games_list:
-            for game in self.games_list:
-                if new_game['session_name'] == game['session_name']:
-                    if new_game['player_count'] == 0:
-                        # Delete the game
-                        break
-                    else:
-                        new_games_list.append(new_game)
-                        break
-            else:
-                new_games_list.append(new_game)
+        Args:
+            seq (int): sequence number of the change
+            op (str): 'add', 'update' or 'remove'
+            session (dict[str, object]): session info (only session_name on remove)
+            shard (int): index of server shard that changed
+        """
 
-        self.games_list = new_games_list
+        if shard in self.resync_deltas:  # applied after list is received
+            self.resync_deltas[shard].append((seq, op, session))
+            return
 
-        self.games_listbox.delete(0, Tkinter.END)
-        for game in self.games_list:
-            game_name = '{0:<15} ({1}/{2})'.format(game['session_name'], game['player_count'], game['max_count'])
-            self.games_listbox.insert(Tkinter.END, game_name)
+        last_seq = self.games_seq.get(shard)
+
+        if last_seq is not None and seq <= last_seq:  # already in list
+            return
+
+        if last_seq is None or seq != last_seq + 1:
+            LOG.warning('Missed games list changes of shard %d before %d, asking for whole list' % (shard, seq))
+            self.request_games_list(shard)
+            self.resync_deltas[shard].append((seq, op, session))
+            return
+
+        self.remove_game(session['session_name'])
+        if op != 'remove':
+            self.put_game(session, shard)
+
+        self.games_seq[shard] = seq
+
+    def request_games_list(self, shard, first_page=None):
+        """
+        Ask games list of server shard page by page, changes received meanwhile are applied after it.
+
+        Args:
+            shard (int): index of server shard
+            first_page (dict[str, object]): already received first page of list (connect response)
+        """
+
+        self.resync_deltas[shard] = []
+        self.games_pages[shard] = []
+        if first_page is None:
+            self.request_games_page(shard)
+        else:
+            self.games_page_received(shard, first_page)
+
+    def request_games_page(self, shard, after=None):
+        """
+        Ask next page of games list of server shard.
+
+        Args:
+            shard (int): index of server shard
+            after (str): name of last session of previous page
+        """
+
+        self.parent.call_async('list_sessions', lambda response: self.games_page_received(shard, response),
+                               shard=shard, after=after)
+
+    def games_page_received(self, shard, response):
+        """
+        Ask next page of games list if there is more, otherwise show the list and apply changes received meanwhile.
+        Changes are applied from sequence number of the first page, so changes made while paging are not missed.
+
+        Args:
+            shard (int): index of server shard
+            response (dict[str, object]): list_sessions response
+        """
+
+        if shard not in self.games_pages:  # left server meanwhile
+            return
+
+        if response['err']:
+            LOG.warning('Could not get games list: %s' % response['err'])
+            del self.games_pages[shard]
+            self.resync_deltas.pop(shard, None)
+            self.games_seq.pop(shard, None)  # try again on next change
+            return
+
+        pages = self.games_pages[shard]
+        pages.append(response)
+        if response.get('more', False) and response['sessions']:
+            self.request_games_page(shard, response['sessions'][-1]['session_name'])
+            return
+
+        del self.games_pages[shard]
+        deltas = self.resync_deltas.pop(shard, [])
+        self.set_games_list([game for page in pages for game in page['sessions']], pages[0]['seq'], shard)
+        for seq, op, session in sorted(deltas):
+            self.apply_games_delta(seq, op, session, shard)
+
+    def put_game(self, game, shard):
+        index = bisect_left(self.game_names, game['session_name'])
+        self.games_listbox.insert(index, self.game_label(game))
+        self.game_names.insert(index, game['session_name'])
+        self.games[game['session_name']] = game
+        self.game_shards[game['session_name']] = shard
+
+    def remove_game(self, game_name):
+        if game_name in self.games:
+            index = bisect_left(self.game_names, game_name)
+            self.games_listbox.delete(index)
+            del self.game_names[index]
+            del self.games[game_name]
+            del self.game_shards[game_name]
+
+    @staticmethod
+    def game_label(game):
+        return '{0:<15} ({1}/{2})'.format(game['session_name'], game['player_count'], game['max_count'])
 
 
 class GameSetupFrame(BaseGameFrame):
@@ -849,7 +1111,19 @@ class GameFrame(BaseGameFrame):
             y (int): y-coordinate
         """
 
-        if self.parent.shoot(x, y):
+        self.parent.shoot(x, y)
+
+    def shot_result(self, x, y, hit):
+        """
+        Show result of the shot taken by the player.
+
+        Args:
+            x (int): x-coordinate
+            y (int): y-coordinate
+            hit (bool): True if shot hit a ship
+        """
+
+        if hit:
             self.game_field[y][x].make_ship()
 
     def update_game_info(self, next=None, shot=None, sunk=None, gameover=None,
@@ -5,6 +5,32 @@ SQUARE_BUFFER_SIZE = 1
 SQUARES_IN_A_ROW = 4
 
 
+def battlefield_from_delta(game_size, ships, shots):
+    """
+    Builds battlefield matrix (same as sent by server on reconnect) from own ships and shot history
+
+    Args:
+        game_size (int): Max number of players
+        ships (list[(int, int)]): coordinates of own ship squares
+        shots (list[(int, int)]): coordinates of all shot squares
+
+    Returns:
+        list[list[int]]: -1 - shot water or enemy square, 0 - water, 1 - ship, hit, 2 - ship
+    """
+
+    rows = game_size * SQUARE_SIDE_LENGTH + (game_size - 1) * SQUARE_BUFFER_SIZE
+    columns = SQUARES_IN_A_ROW * SQUARE_SIDE_LENGTH + (SQUARES_IN_A_ROW - 1) * SQUARE_BUFFER_SIZE
+    battlefield = [[0] * columns for _ in range(rows)]
+
+    for y, x in ships:
+        battlefield[y][x] = 2
+
+    for y, x in shots:
+        battlefield[y][x] = 1 if battlefield[y][x] in (1, 2) else -1
+
+    return battlefield
+
+
 class ValidatingEntry(Tkinter.Entry):
     """
     code taken from http://effbot.org/zone/tkinter-entry-validate.htm
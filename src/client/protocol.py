@@ -1,40 +1,315 @@
-import pika
-import json
 import uuid
 import time
-from threading import Thread, Timer
-from common import BaseListener
+from Queue import Queue, Empty
+from threading import Thread, Timer, Event, Lock, current_thread
+from common import LOG, HEARTBEAT_INTERVAL, HashRing, BasicProperties, get_content_type, get_transport, \
+    encode_message, decode_message, get_request_key, rpc_queue_prefix, get_threadsafe_callback_adder
 
 CONNECTION_TIMEOUT = 3
+TASK_WAIT_TIME = 0.05  # seconds I/O thread waits for messages before running tasks, if it can't be woken up
+IDLE_WAIT_TIME = 1  # seconds I/O thread waits for messages, when it is woken up for tasks handed over
 
 
-class RPCClient(object):
+class ConnectionManager(Thread):
 
-    def __init__(self, args, parent):
+    def __init__(self, args):
         """
-        This class handles the RPC part. Any method called on this is sent to the server and the response is given.
+        Holds the only connection to RabbitMQ of the client. RPC replies and all topic subscriptions are consumed
+        on channel of this connection by this (I/O) thread. Connection is not thread safe, so other threads
+        hand their work over to I/O thread, which is woken up to run it right away.
         """
+        super(ConnectionManager, self).__init__(name='ConnectionManager')
+        self.daemon = True
 
-        self.server_name = None
-
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=args.host, port=args.port))
+        self.connection = get_transport(args).connect()
 
         self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange='topic_server',
+                                      type='topic')
+
+        self.tasks = Queue()
+        self.tasks_scheduled = False  # I/O thread has been asked to run tasks and has not started yet
+        self.tasks_lock = Lock()
+        self.add_callback = get_threadsafe_callback_adder(self.connection)
+        self.close_callbacks = []  # called when I/O loop stops (e.g. connection is lost)
+        self.close_lock = Lock()
+        self._is_running = True
+        self.start()
+
+    def run(self):
+        try:
+            while self._is_running:
+                if self.add_callback is None:  # tasks are polled
+                    self.run_tasks()
+                    self.connection.process_data_events(time_limit=TASK_WAIT_TIME)
+                else:
+                    self.connection.process_data_events(time_limit=IDLE_WAIT_TIME)
+        finally:
+            with self.close_lock:
+                self._is_running = False
+                callbacks, self.close_callbacks = self.close_callbacks, []
+            try:
+                self.connection.close()
+            except Exception:
+                pass  # connection is lost already
+            for callback in callbacks:
+                callback()
+
+    def put_task(self, task):
+        """
+        Hand task over to I/O thread (from any thread) and wake it up.
+        """
+
+        self.tasks.put(task)
+
+        if self.add_callback is None:
+            return  # polled by I/O thread
+
+        with self.tasks_lock:  # one wake up is enough for everything queued before tasks are run
+            if self.tasks_scheduled:
+                return
+            self.tasks_scheduled = True
+        self.add_callback(self.run_tasks)
+
+    def run_tasks(self):
+        with self.tasks_lock:
+            self.tasks_scheduled = False
+
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except Empty:
+                return
+            task()
+
+    def execute(self, function, *args):
+        """
+        Run function on I/O thread and wait for the result.
+        """
+
+        if current_thread() is self:
+            return function(*args)
+
+        result = {}
+        done = Event()
+
+        def task():
+            try:
+                result['value'] = function(*args)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
+
+        if not self._is_running:
+            raise IOError('Connection to RabbitMQ is not running')
+
+        self.put_task(task)
+        if not done.wait(CONNECTION_TIMEOUT):  # I/O thread is stuck or stopped meanwhile
+            raise IOError('Connection to RabbitMQ is not running')
+
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """
+        Publish message from any thread (does not wait until it is sent).
+        """
+        self.put_task(lambda: self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                                         body=body, properties=properties))
+
+    def call_later(self, delay, function):
+        """
+        Call function on I/O thread after delay seconds (does not wait).
+        """
+        self.put_task(lambda: self.connection.add_timeout(delay, function))
+
+    def subscribe(self, callback, key=None):
+        """
+        Start consuming new exclusive queue.
+
+        Args:
+            callback: Called with (ch, method, props, body) for every message (on I/O thread)
+            key (str): Routing key to bind queue with in topic_server exchange, None for RPC reply queue
 
+        Returns:
+            (str, str): queue name and consumer tag, needed for unsubscribing
+        """
+        return self.execute(self._subscribe, callback, key)
+
+    def _subscribe(self, callback, key):
         result = self.channel.queue_declare(exclusive=True)
-        self.callback_queue = result.method.queue
+        queue_name = result.method.queue
+
+        if key is not None:
+            self.channel.queue_bind(exchange='topic_server',
+                                    queue=queue_name,
+                                    routing_key=key)
+
+        consumer_tag = self.channel.basic_consume(callback,
+                                                  queue=queue_name,
+                                                  no_ack=True)
+        return queue_name, consumer_tag
+
+    def unsubscribe(self, subscription):
+        """
+        Stop consuming queue and delete it (does not wait until it is done).
+
+        Args:
+            subscription ((str, str)): queue name and consumer tag returned by subscribe
+        """
+        self.put_task(lambda: self._unsubscribe(*subscription))
+
+    def _unsubscribe(self, queue_name, consumer_tag):
+        self.channel.basic_cancel(consumer_tag)
+        self.channel.queue_delete(queue=queue_name)
+
+    def add_close_callback(self, callback):
+        """
+        Call callback when I/O loop stops (on I/O thread), right away if it has stopped already.
+        """
+        with self.close_lock:
+            if self._is_running:
+                self.close_callbacks.append(callback)
+                return
+        callback()
+
+    def is_running(self):
+        return self._is_running
+
+    def exit(self):
+        self._is_running = False
+        self.put_task(lambda: None)  # wake up I/O thread to stop it
+
+
+class BaseListener(object):
+
+    def __init__(self, key, connection_manager, callback):
+        """
+        Baseclass for listeners, messages are consumed using shared connection of the client.
+
+        Args:
+            key (str): Name of rabbitmq key that to listen for
+            connection_manager (ConnectionManager): Connection of the client
+            callback: External callback function to call after reciveing from server(s).
+        """
+
+        self.external_callback = callback
+        self.connection_manager = connection_manager
+        self._is_running = True
+
+        self.subscription = connection_manager.subscribe(self.callback, key)
+
+    def exit(self):
+        self._is_running = False
+        self.connection_manager.unsubscribe(self.subscription)
+
+    def callback(self, ch, method, props, body):
+        """
+        Override this
+        """
+        pass
+
+
+class RPCFuture(object):
 
-        self.channel.basic_consume(self.on_response, no_ack=True,
-                                   queue=self.callback_queue)
+    def __init__(self, method_name):
+        """
+        Response of RPC call that may not have arrived yet.
+
+        Args:
+            method_name (str): Name of the called method
+        """
 
+        self.method_name = method_name
         self.response = None
-        self.corr_id = 0
+        self._done = Event()
+        self._callbacks = []
+        self._lock = Lock()
 
-        self.parent = parent
+    def set_response(self, response):
+        """
+        Set response of the call and run callbacks (only first response is used).
+
+        Args:
+            response (dict[str, object]): Response dictionary from the server
+        """
+
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.response = response
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback(response)
 
-        self.timer = None
-        self.keep_connection_open()
+    def add_done_callback(self, callback):
+        """
+        Call callback with response when it arrives (right away if it already has), callback is run on I/O thread.
+        """
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self.response)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response.
+
+        Args:
+            timeout (float): Seconds to wait at most, call times out then (also for callbacks), None waits forever
+        Returns:
+            dict[str, object]: Response dictionary from the server ({'err': ...} if call timed out)
+        """
+
+        if timeout is None or self._done.is_set():
+            self._done.wait()
+            return self.response
+
+        # timed wait of Python 2 polls with sleeps up to 50 ms, so wait is ended by timer instead
+        timer = Timer(timeout, self.set_response, [{'err': 'Connection timed out'}])
+        timer.daemon = True
+        timer.start()
+        self._done.wait()
+        timer.cancel()
+
+        return self.response
+
+
+class RPCClient(object):
+
+    def __init__(self, connection_manager, args, parent):
+        """
+        This class handles the RPC part. Any method called on this is sent to the server and the response is given.
+        Calls can be made also without waiting for the response (call_async), responses are matched to calls by
+        correlation id, so several calls can be in flight at the same time.
+        """
+
+        self.server_name = None
+        self.shard_ring = None  # HashRing of server shards, None if server is not sharded (or not known yet)
+        self.single_queue = args.single_queue  # all RPC-s to one server queue, method name in header
+        self.content_type = get_content_type(args.binary)  # server replies in same format
+
+        self.connection_manager = connection_manager
+        self.subscription = connection_manager.subscribe(self.on_response)
+        self.callback_queue = self.subscription[0]
+
+        self.pending = {}  # correlation id -> RPCFuture of calls waiting for response
+        """@type: dict[str, RPCFuture]"""
+        self.pending_lock = Lock()
+        self.last_call_time = 0  # server counts calls as player activity, see PlayerAnnouncements
+        connection_manager.add_close_callback(self.on_connection_closed)
+
+        self.parent = parent
 
     def __getattr__(self, method_name):
 
@@ -52,25 +327,8 @@ class RPCClient(object):
                 dict[str, object]: Response dictionary from the server
             """
 
-            self.response = None
-            message = json.dumps(data)
-            self.corr_id = str(uuid.uuid4())
-            self.channel.basic_publish(exchange='',
-                                       routing_key='{0}_rpc_{1}'.format(self.server_name, method_name),
-                                       properties=pika.BasicProperties(
-                                             reply_to=self.callback_queue,
-                                             correlation_id=self.corr_id,
-                                             ),
-                                       body=message)
-
-            start_time = time.time()
-            while self.response is None:
-                self.connection.process_data_events()
-
-                if start_time + CONNECTION_TIMEOUT < time.time():
-                    return {'err': 'Connection timed out'}
-
-            response = json.loads(self.response)
+            # bounded also here, timeout of call is run by I/O thread that may have stopped
+            response = self.call_async(method_name, **data).result(CONNECTION_TIMEOUT + 1)
 
             if response.get('reconnect', False):
                 self.parent.leave_game(connected=False)
@@ -79,34 +337,120 @@ class RPCClient(object):
 
         return remote_method
 
-    def on_response(self, ch, method, props, body):
-        if self.corr_id == props.correlation_id:
-            self.response = body
+    def call_async(self, method_name, callback=None, timeout=CONNECTION_TIMEOUT, **data):
+        """
+        Call method on the server without waiting for the response.
 
-    def exit(self):
-        self.timer.cancel()
-        self.connection.close()
+        Args:
+            method_name (str): Name of the method
+            callback: Called with response dictionary when response arrives or call times out (on I/O thread)
+            timeout (float): Seconds to wait for the response
+            **data (dict[str, object]): Data to send to the server
 
-    def keep_connection_open(self):
+        Returns:
+            RPCFuture: future response of the call
         """
-        To avoid connection timeout, we must call connection.process_data_events periodically
+
+        future = RPCFuture(method_name)
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        corr_id = str(uuid.uuid4())
+        with self.pending_lock:
+            self.pending[corr_id] = future
+        self.last_call_time = time.time()
+
+        # requests are sent straight to the shard owning them, server forwards them otherwise
+        prefix = rpc_queue_prefix(self.server_name, self.get_shard(data))
+
+        if self.single_queue:
+            routing_key = '{0}_rpc'.format(prefix)
+            headers = {'method': method_name}
+        else:
+            routing_key = '{0}_rpc_{1}'.format(prefix, method_name)
+            headers = None
+
+        self.connection_manager.publish(exchange='',
+                                        routing_key=routing_key,
+                                        properties=BasicProperties(
+                                              reply_to=self.callback_queue,
+                                              correlation_id=corr_id,
+                                              headers=headers,
+                                              content_type=self.content_type,
+                                              ),
+                                        body=encode_message(data, self.content_type))
+        self.connection_manager.call_later(timeout, lambda: self.on_timeout(corr_id))
+        if not self.connection_manager.is_running():  # closed before call was added to pending calls
+            self.on_connection_closed()
+
+        return future
+
+    def set_shard_count(self, shard_count):
+        """
+        Set number of server shards (given in connect response)
+
+        Args:
+            shard_count (int): number of shards, 1 if server is not sharded
         """
-        self.connection.process_data_events()
-        self.timer = Timer(10, self.keep_connection_open)
-        self.timer.start()
+        self.shard_ring = HashRing(shard_count) if shard_count > 1 else None
+
+    def get_shard(self, data):
+        """
+        Gives shard owning request (same way server does it), None if server is not sharded
+
+        Args:
+            data (dict[str, object]): Data to send to the server
+        Returns:
+            int: shard index
+        """
+
+        if self.shard_ring is None:
+            return None
+
+        if data.get('shard') is not None:
+            return data['shard']
+
+        key = get_request_key(data)
+        return self.shard_ring.get_shard(key) if key else None
+
+    def on_response(self, ch, method, props, body):
+        with self.pending_lock:
+            future = self.pending.pop(props.correlation_id, None)
+
+        if future is None:
+            LOG.warning('Response to unknown or timed out call (correlation id %s)' % props.correlation_id)
+        else:
+            future.set_response(decode_message(body, props.content_type))
+
+    def on_timeout(self, corr_id):
+        with self.pending_lock:
+            future = self.pending.pop(corr_id, None)
+
+        if future is not None:
+            future.set_response({'err': 'Connection timed out'})
+
+    def on_connection_closed(self):
+        with self.pending_lock:
+            futures, self.pending = self.pending.values(), {}
+
+        for future in futures:
+            future.set_response({'err': 'Connection lost'})
+
+    def exit(self):
+        self.connection_manager.unsubscribe(self.subscription)
 
 
 class GlobalListener(BaseListener):
 
-    def __init__(self, args, callback):
+    def __init__(self, connection_manager, callback):
         """
         Listen for servers announcing themselves.
         Calls callback with list of available server names.
         """
-        super(GlobalListener, self).__init__('*.info', args, callback, name='GlobalListener')
+        self.servers = {}
+        super(GlobalListener, self).__init__('*.info', connection_manager, callback)
 
         # And now the thread logic
-        self.servers = {}
         self.update_servers_list()
 
     def callback(self, ch, method, props, body):
@@ -123,68 +467,78 @@ class GlobalListener(BaseListener):
 
 class ServerListener(BaseListener):
 
-    def __init__(self, key, args, callback):
+    def __init__(self, key, connection_manager, callback):
         """
         Listen for anouncments about the server.
         """
-        super(ServerListener, self).__init__(key, args, callback, name='ServerListener')
+        super(ServerListener, self).__init__(key, connection_manager, callback)
 
     def callback(self, ch, method, props, body):
-        self.external_callback([json.loads(body)])
+        self.external_callback(**decode_message(body, props.content_type))
 
 
 class GameListener(BaseListener):
 
-    def __init__(self, key, args, callback):
+    def __init__(self, key, connection_manager, callback):
         """
         Listen for anouncments about the game.
         """
-        super(GameListener, self).__init__(key, args, callback, name='GameListener')
+        super(GameListener, self).__init__(key, connection_manager, callback)
 
     def callback(self, ch, method, props, body):
-        self.external_callback(**json.loads(body))
+        self.external_callback(**decode_message(body, props.content_type))
 
 
 class PlayerListener(BaseListener):
 
-    def __init__(self, key, args, callback):
+    def __init__(self, key, connection_manager, callback):
         """
         Listen for personal anouncments about the player.
         """
-        super(PlayerListener, self).__init__(key, args, callback, name='PlayerListener')
+        super(PlayerListener, self).__init__(key, connection_manager, callback)
 
     def callback(self, ch, method, props, body):
-        self.external_callback(**json.loads(body))
+        self.external_callback(**decode_message(body, props.content_type))
 
 
 class PlayerAnnouncements(Thread):
     """
-    Thread for sending server name to *.info queue, needed in order to check whether server is online or not
+    Thread for sending player heartbeats to <server>.players.activity, needed for server to know that player is
+    still online. RPC calls also count as heartbeats, so heartbeat is sent only after interval without calls
+    (unless server is sharded, then every shard needs heartbeats).
     """
-    def __init__(self, player_name, args):
+    def __init__(self, player_name, rpc, interval=HEARTBEAT_INTERVAL):
         """
-        Publish server's name after every second in order to show that server is active.
         @param player_name:
         @type player_name: str
-        @param args:
+        @param rpc: RPC client connected to the server
+        @type rpc: RPCClient
+        @param interval: seconds without RPC calls after which heartbeat is sent
+        @type interval: float
         """
         super(PlayerAnnouncements, self).__init__()
         self.player_name = player_name
-
-        # Set up the RabbitMQ stuff
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host, port=args.port))
-
-        self.channel = self.connection.channel()
-        self.channel.exchange_declare(exchange='topic_server',
-                                      type='topic')
+        self.rpc = rpc
+        self.routing_key = '{0}.players.activity'.format(rpc.server_name)
+        self.interval = interval
+        self.last_heartbeat_time = 0
         self._is_running = True
 
     def run(self):
         while self._is_running:
-            self.channel.basic_publish(exchange='topic_server', routing_key='players.activity',
-                                       body=self.player_name)
-            time.sleep(1)
+            last_activity_time = self.last_heartbeat_time
+            if self.rpc.shard_ring is None:  # with shards only shard handling RPC would know about it
+                last_activity_time = max(self.rpc.last_call_time, last_activity_time)
+
+            wait_time = last_activity_time + self.interval - time.time()
+
+            if wait_time <= 0:
+                self.rpc.connection_manager.publish(exchange='topic_server', routing_key=self.routing_key,
+                                                    body=self.player_name)
+                self.last_heartbeat_time = time.time()
+                wait_time = self.interval
+
+            time.sleep(wait_time)
 
     def exit(self):
         self._is_running = False
-        self.connection.close()
@@ -3,9 +3,27 @@ Common variables
 
 """
 # Imports----------------------------------------------------------------------
+import json
 import logging
+import socket
+import sys
+from collections import deque
+from copy import deepcopy
+from bisect import bisect
+from hashlib import md5
 from threading import Thread
-import pika
+from Queue import Queue, Full
+from loopback import LoopbackBroker, BasicProperties as LoopbackProperties, ChannelClosed as LoopbackChannelClosed
+
+try:
+    import pika  # optional, needed only for connecting to RabbitMQ
+except ImportError:
+    pika = None
+
+try:
+    import msgpack  # optional, enables compact binary wire format
+except ImportError:
+    msgpack = None
 
 # Logging----------------------------------------------------------------------
 
@@ -13,10 +31,427 @@ FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
 logging.basicConfig(level=logging.WARNING, format=FORMAT)  # Log only errors
 LOG = logging.getLogger()
 
+LOG_QUEUE_SIZE = 10000  # records waiting for writer thread, records logged while queue is full are dropped
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+def log_fields(**fields):
+    """
+    Gives extra argument of logging call that adds fields to structured record, e.g.
+    LOG.info("User connected", extra=log_fields(user=user_name))
+
+    Returns:
+        dict: extra argument of logging call
+    """
+
+    return {'fields': fields}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats record as usual and appends its fields as key=value pairs (sorted by key) to message
+    """
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        fields = getattr(record, 'fields', None)
+        if not fields:
+            return text
+
+        pairs = ' '.join('%s=%s' % (key, self.format_field(value)) for key, value in sorted(fields.items()))
+        message, newline, traceback = text.partition('\n')  # fields go before traceback
+        return message + ' ' + pairs + newline + traceback
+
+    @staticmethod
+    def format_field(value):
+        # strings are quoted only when pairs could not be split without quotes
+        if isinstance(value, basestring) and (value == '' or any(char in value for char in ' "=')):
+            return json.dumps(value)
+        return value
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes every n-th record below WARNING level of each message (records of the same message format string
+    are counted together), so that the first record of every message is kept. Warnings and errors always pass.
+    """
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.counts = {}  # message format string -> records seen
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1  # counts of concurrent records may collide, sampling stays approximate
+        return count % self.every == 0
+
+
+class AsyncLogHandler(logging.Handler):
+
+    def __init__(self, handler, queue_size=LOG_QUEUE_SIZE):
+        """
+        Hands records over to writer thread through bounded queue, so that logging thread never waits for I/O.
+        Records logged while queue is full are dropped and their count is logged when writer has emptied queue.
+
+        @param handler: handler writing records (e.g. StreamHandler with StructuredFormatter)
+        @type handler: logging.Handler
+        @param queue_size: records waiting for writer thread
+        @type queue_size: int
+        """
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.writer = Thread(target=self.write_records, name='LogWriter')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        # message and fields are formatted/copied now, arguments may be changed by the time writer gets to record
+        record.msg = record.getMessage()
+        record.args = None
+        if getattr(record, 'fields', None):
+            record.fields = deepcopy(record.fields)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def write_records(self):
+        name = logging.root.name
+        while True:
+            record = self.queue.get()
+            if record is not None:
+                name = record.name
+                self.handler.handle(record)
+
+            # records were dropped after those written so far (or before close)
+            if record is None or self.queue.empty():
+                self.write_dropped(name)
+            if record is None:
+                return
+
+    def write_dropped(self, name):
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            self.handler.handle(logging.makeLogRecord({'name': name, 'levelno': logging.WARNING,
+                                                       'levelname': 'WARNING',
+                                                       'msg': "Dropped %d log records" % dropped}))
+
+    def close(self):
+        """
+        Writes records still in queue and stops writer thread
+        """
+
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+def init_logging(level=logging.INFO, sample_every=1, stream=None):
+    """
+    Makes LOG write records asynchronously (see AsyncLogHandler) in structured format instead of writing
+    them synchronously to stderr. Records still in queue are written when logging shuts down at exit (or when
+    returned handler is closed).
+
+    Args:
+        level (int|str): lowest level of records logged (e.g. logging.INFO or 'debug')
+        sample_every (int): keep only every n-th record below WARNING of each message
+        stream (file): where records are written, defaults to stdout
+    Returns:
+        AsyncLogHandler: handler added to LOG
+    """
+
+    if isinstance(level, basestring):
+        level = getattr(logging, level.upper())
+
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(FORMAT))
+    handler = AsyncLogHandler(stream_handler)
+    if sample_every > 1:
+        handler.addFilter(SamplingFilter(sample_every))
+
+    for old_handler in LOG.handlers[:]:
+        LOG.removeHandler(old_handler)
+        old_handler.close()
+    LOG.addHandler(handler)
+    LOG.setLevel(level)
+
+    return handler
+
 # TCP related constants -------------------------------------------------------
 #
 DEFAULT_MQ_PORT = 5672
 DEFAULT_MQ_INET_ADDR = '127.0.0.1'
+DEFAULT_PREFETCH_COUNT = 1  # RPC requests delivered to server before acknowledging
+
+# Seconds listener waits for messages on socket before checking whether it should stop (messages are handled
+# as soon as they arrive, this only bounds how long exiting listener keeps running)
+LISTENER_WAIT_TIME = 1
+
+# Player heartbeats -----------------------------------------------------------
+#
+HEARTBEAT_INTERVAL = 1  # seconds between heartbeats of idle client (RPC-s also count as heartbeats)
+PLAYER_TIMEOUT = 5  # seconds after last heartbeat or RPC server considers player inactive
+
+# Wire format -----------------------------------------------------------------
+#
+# Content type of message body is sent in message properties, so receiver decodes every message in format sender
+# chose. JSON is used when content type is missing, msgpack only when it is installed.
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+SUPPORTED_CONTENT_TYPES = (None, CONTENT_TYPE_JSON) + ((CONTENT_TYPE_MSGPACK,) if msgpack is not None else ())
+
+
+def get_content_type(binary):
+    """
+    Gets content type to send messages with
+
+    Args:
+        binary (bool): True if compact binary format is preferred
+    Returns:
+        str: msgpack content type if binary format is asked for and available, JSON content type otherwise
+    """
+
+    if binary and msgpack is None:
+        LOG.warning('msgpack is not installed, falling back to JSON messages')
+
+    return CONTENT_TYPE_MSGPACK if binary and msgpack is not None else CONTENT_TYPE_JSON
+
+
+def encode_message(data, content_type=CONTENT_TYPE_JSON):
+    """
+    Serializes message body
+
+    Args:
+        data (object): message data (dicts, lists, strings and numbers)
+        content_type (str): content type to encode data with
+    Returns:
+        str: message body
+    """
+
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+
+    return json.dumps(data)
+
+
+def decode_message(body, content_type=None):
+    """
+    Deserializes message body
+
+    Args:
+        body (str): message body
+        content_type (str): content type from message properties, JSON if None
+    Returns:
+        object: message data
+    Raises:
+        ValueError: if body is invalid or content type is not supported
+    """
+
+    if content_type not in SUPPORTED_CONTENT_TYPES:
+        raise ValueError('Unsupported content type %s' % content_type)
+
+    if content_type == CONTENT_TYPE_MSGPACK:
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:  # msgpack raises different errors depending on version
+            raise ValueError(str(e))
+
+    return json.loads(body)
+
+
+# Sharding --------------------------------------------------------------------
+#
+# Server can run as several processes (shards), each owning game sessions whose names hash to it on HashRing.
+HASH_RING_REPLICAS = 64  # points of each shard on hash ring, more points spread sessions more evenly
+
+
+def rpc_queue_prefix(server_name, shard=None):
+    """
+    Gives prefix of RPC queue names (<prefix>_rpc or <prefix>_rpc_<method>)
+
+    Args:
+        server_name (str): Name of the server
+        shard (int): index of server shard, None for queues shared by all shards
+    Returns:
+        str: queue name prefix
+    """
+
+    if shard is None:
+        return server_name
+    return '%s.shard%d' % (server_name, shard)
+
+
+def ring_hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, shard_count, replicas=HASH_RING_REPLICAS):
+        """
+        Consistent hash ring of shards, adding shard moves only keys that hash to new shard.
+
+        Args:
+            shard_count (int): number of shards
+            replicas (int): points of each shard on ring
+        """
+        self.shard_count = shard_count
+        self.ring = sorted((ring_hash('%d:%d' % (shard, replica)), shard)
+                           for shard in range(shard_count) for replica in range(replicas))
+        self.hashes = [point_hash for point_hash, shard in self.ring]
+
+    def get_shard(self, key):
+        """
+        Gives shard owning key (first shard point after key on ring)
+
+        Args:
+            key (str): session or user name
+        Returns:
+            int: shard index
+        """
+        return self.ring[bisect(self.hashes, ring_hash(key)) % len(self.ring)][1]
+
+
+def get_request_key(data):
+    """
+    Gives key that decides which shard handles request: session name, user name for requests outside sessions
+
+    Args:
+        data (dict[str, object]): arguments of RPC request
+    Returns:
+        str: session or user name, None if request has neither
+    """
+
+    return data.get('sname') or data.get('user')
+
+
+# Transport -------------------------------------------------------------------
+#
+# Server and clients get their connections from transport. Every transport gives connections with the interface
+# of pika BlockingConnection (channel, process_data_events, add_timeout, close) and its channels.
+TRANSPORT_AMQP = 'amqp'  # RabbitMQ
+TRANSPORT_MEMORY = 'memory'  # broker inside the process, see loopback.py
+TRANSPORTS = (TRANSPORT_AMQP, TRANSPORT_MEMORY)
+
+# Properties of published messages, pika properties can be given to every transport
+BasicProperties = pika.BasicProperties if pika is not None else LoopbackProperties
+# Errors of broker refusing operation on channel (e.g. consuming queue that has exclusive consumer)
+CHANNEL_CLOSED_ERRORS = (LoopbackChannelClosed,) + ((pika.exceptions.ChannelClosed,) if pika is not None else ())
+
+
+class PikaTransport(object):
+
+    def __init__(self, host=DEFAULT_MQ_INET_ADDR, port=DEFAULT_MQ_PORT):
+        """
+        Connections to RabbitMQ at host and port
+        """
+        if pika is None:
+            raise ImportError('pika is not installed, only %s transport can be used' % TRANSPORT_MEMORY)
+        self.host = host
+        self.port = port
+
+    def connect(self):
+        return pika.BlockingConnection(pika.ConnectionParameters(host=self.host, port=self.port))
+
+
+class MemoryTransport(object):
+
+    def __init__(self, broker=None):
+        """
+        Connections to broker inside the process. Messages are routed in memory and their bodies and properties are
+        handed to consumers as they are, without copying or framing.
+
+        Args:
+            broker (LoopbackBroker): broker shared by connections, new broker if None
+        """
+        self.broker = broker if broker is not None else LoopbackBroker()
+
+    def connect(self):
+        return self.broker.connect()
+
+
+MEMORY_TRANSPORT = MemoryTransport()  # shared by server and clients running in the same process
+IOLOOP_READ = 0x0001  # pika.adapters.select_connection.READ
+
+
+def get_transport(args):
+    """
+    Gives transport chosen by command line arguments
+
+    Args:
+        args: command line arguments (transport, host, port), RabbitMQ is used if transport is not given
+    Returns:
+        PikaTransport|MemoryTransport: transport, its connect() gives new connection to message broker
+    """
+
+    if getattr(args, 'transport', TRANSPORT_AMQP) == TRANSPORT_MEMORY:
+        return MEMORY_TRANSPORT
+    return PikaTransport(args.host, args.port)
+
+
+def get_threadsafe_callback_adder(connection):
+    """
+    Gives function that schedules callback to be run by thread processing events of connection and wakes it up,
+    callable from any thread
+
+    Args:
+        connection (BlockingConnection): connection (pika BlockingConnection or loopback.LoopbackConnection)
+    Returns:
+        function: takes callback, None if connection thread can't be woken up (queued messages must be polled)
+    """
+
+    if hasattr(connection, 'add_callback_threadsafe'):  # pika 0.12 and later, loopback connection
+        return connection.add_callback_threadsafe
+
+    if hasattr(socket, 'socketpair') and hasattr(connection, '_impl'):  # pika 0.10 on Unix
+        return IOLoopWaker(connection).add_callback
+
+    return None
+
+
+class IOLoopWaker(object):
+
+    def __init__(self, connection):
+        """
+        Wakes up pika BlockingConnection (before 0.12, which has no add_callback_threadsafe) waiting in its IO loop
+        by writing to socket watched by the loop, callbacks are then run as connection timeouts
+
+        @param connection:
+        @type connection: BlockingConnection
+        """
+        self.connection = connection
+        self.callbacks = deque()
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        connection._impl.ioloop.add_handler(self.reader.fileno(), self.on_wake, IOLOOP_READ)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+        self.writer.send(b'x')
+
+    def on_wake(self, fileno, events, write_only=False):
+        try:
+            self.reader.recv(512)
+        except socket.error:
+            pass  # woken up already
+
+        while self.callbacks:
+            self.connection.add_timeout(0, self.callbacks.popleft())  # run by connection outside of IO loop poll
 
 
 class BaseListener(Thread):
@@ -33,7 +468,7 @@ class BaseListener(Thread):
         super(BaseListener, self).__init__(**kwargs)
 
         # Set up the RabbitMQ stuff
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host, port=args.port))
+        self.connection = get_transport(args).connect()
 
         channel = self.connection.channel()
 
@@ -57,12 +492,15 @@ class BaseListener(Thread):
         self.start()
 
     def run(self):
-        while self._is_running:
-            self.connection.process_data_events()
+        try:
+            while self._is_running:
+                # blocks until messages arrive (or wait time is over) instead of spinning
+                self.connection.process_data_events(time_limit=LISTENER_WAIT_TIME)
+        finally:
+            self.connection.close()  # connection is not thread safe, so it is closed by listener thread
 
     def exit(self):
         self._is_running = False
-        self.connection.close()
 
     def callback(self, ch, method, props, body):
         """
@@ -0,0 +1,347 @@
+# In-process stand-in for RabbitMQ: exchanges, queues and consumers living in one process. Mimics the part of
+# pika BlockingConnection and its channel used by server and clients, so they can be run without broker
+# (load tests, single host deployments). Message bodies and properties are handed over as they are, not copied.
+
+# Import
+import itertools
+import uuid
+from collections import deque, namedtuple
+from heapq import heappush, heappop
+from threading import Lock, Condition
+from time import time
+
+CONSUME_WAIT_TIME = 1  # seconds start_consuming waits for messages before checking whether it should stop
+
+DeclareOk = namedtuple('DeclareOk', 'queue message_count consumer_count')
+MethodFrame = namedtuple('MethodFrame', 'method')
+Deliver = namedtuple('Deliver', 'consumer_tag delivery_tag redelivered exchange routing_key')
+ACCESS_REFUSED = 403
+
+
+class ChannelClosed(Exception):
+    """
+    Broker refused operation (like pika.exceptions.ChannelClosed), args are reply code and reply text
+    """
+
+
+class BasicProperties(object):
+    """
+    Message properties given to consumers when publisher gives none (same defaults as pika.BasicProperties)
+    """
+    def __init__(self, content_type=None, headers=None, correlation_id=None, reply_to=None):
+        self.content_type = content_type
+        self.headers = headers
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+
+
+class LoopbackQueue(object):
+
+    def __init__(self, name, owner=None):
+        """
+        @param name: name of the queue
+        @type name: str
+        @param owner: connection of exclusive queue (queue is deleted when connection is closed)
+        @type owner: LoopbackConnection
+        """
+        self.name = name
+        self.owner = owner
+        self.messages = deque()  # (exchange, routing key, properties, body) published while nobody consumed
+        self.consumers = []  # (consumer tag, channel, callback), messages are given to them in turns
+        self.next_consumer = 0
+        self.exclusive_consumer = None  # tag of consumer that is the only one allowed to consume queue
+
+    def remove_consumers(self, removed):
+        """
+        Remove consumers for which removed((consumer tag, channel, callback)) is True
+        """
+        self.consumers = [consumer for consumer in self.consumers if not removed(consumer)]
+        if self.exclusive_consumer not in [consumer[0] for consumer in self.consumers]:
+            self.exclusive_consumer = None
+
+
+class LoopbackBroker(object):
+    """
+    Exchanges and queues shared by all loopback connections of the process. Default exchange ('') routes messages
+    to queue named by routing key, topic exchanges route by bindings (* matches one word, # zero or more words).
+    Messages are acknowledged on delivery, unacknowledged messages are not redelivered.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.queues = {}  # queue name -> LoopbackQueue
+        """@type: dict[str, LoopbackQueue]"""
+        self.exchanges = {'': 'direct'}  # exchange name -> type
+        self.bindings = {}  # exchange -> routing key -> names of queues, for keys without wildcards
+        """@type: dict[str, dict[str, set[str]]]"""
+        self.pattern_bindings = {}  # exchange -> (binding key split to words, queue name), keys with wildcards
+        """@type: dict[str, list[(list[str], str)]]"""
+        self.delivery_tags = itertools.count(1)
+
+    def connect(self):
+        """
+        Gives new connection to the broker, used like pika.BlockingConnection
+        """
+        return LoopbackConnection(self)
+
+    def declare_exchange(self, exchange, exchange_type):
+        with self.lock:
+            self.exchanges.setdefault(exchange, exchange_type)
+
+    def declare_queue(self, queue_name, owner=None):
+        """
+        Returns:
+            LoopbackQueue: declared queue (existing queue if there is one)
+        """
+        with self.lock:
+            if queue_name not in self.queues:
+                self.queues[queue_name] = LoopbackQueue(queue_name, owner)
+            return self.queues[queue_name]
+
+    def delete_queue(self, queue_name):
+        with self.lock:
+            self.queues.pop(queue_name, None)
+            for keys in self.bindings.values():
+                for queue_names in keys.values():
+                    queue_names.discard(queue_name)
+            for exchange, patterns in self.pattern_bindings.items():
+                self.pattern_bindings[exchange] = [(words, name) for words, name in patterns if name != queue_name]
+
+    def bind_queue(self, exchange, queue_name, routing_key):
+        with self.lock:
+            words = routing_key.split('.')
+            if '*' in words or '#' in words:
+                self.pattern_bindings.setdefault(exchange, []).append((words, queue_name))
+            else:
+                self.bindings.setdefault(exchange, {}).setdefault(routing_key, set()).add(queue_name)
+
+    def consume(self, queue_name, consumer_tag, channel, callback, exclusive=False):
+        with self.lock:
+            queue = self.queues[queue_name]
+            if queue.exclusive_consumer is not None or (exclusive and queue.consumers):
+                raise ChannelClosed(ACCESS_REFUSED, "ACCESS_REFUSED - queue '%s' in exclusive use" % queue_name)
+            queue.consumers.append((consumer_tag, channel, callback))
+            if exclusive:
+                queue.exclusive_consumer = consumer_tag
+            backlog, queue.messages = queue.messages, deque()
+
+        for message in backlog:
+            self.deliver(queue, *message)
+
+    def cancel(self, consumer_tag):
+        with self.lock:
+            for queue in self.queues.values():
+                queue.remove_consumers(lambda consumer: consumer[0] == consumer_tag)
+
+    def close_connection(self, connection):
+        """
+        Delete exclusive queues and consumers of closed connection
+        """
+
+        with self.lock:
+            exclusive_queues = [name for name, queue in self.queues.items() if queue.owner is connection]
+            for queue in self.queues.values():
+                queue.remove_consumers(lambda consumer: consumer[1].connection is connection)
+
+        for queue_name in exclusive_queues:
+            self.delete_queue(queue_name)
+
+    def publish(self, exchange, routing_key, properties, body):
+        """
+        Route message to queues, message is dropped if no queue gets it (like RabbitMQ does)
+        """
+
+        with self.lock:
+            if exchange == '':
+                queues = [self.queues[routing_key]] if routing_key in self.queues else []
+            else:
+                queue_names = set(self.bindings.get(exchange, {}).get(routing_key, ()))
+                patterns = self.pattern_bindings.get(exchange)
+                if patterns:
+                    words = routing_key.split('.')
+                    queue_names.update(name for pattern, name in patterns if topic_matches(pattern, words))
+                queues = [self.queues[name] for name in queue_names if name in self.queues]
+
+        for queue in queues:
+            self.deliver(queue, exchange, routing_key, properties, body)
+
+    def deliver(self, queue, exchange, routing_key, properties, body):
+        with self.lock:
+            if not queue.consumers:
+                queue.messages.append((exchange, routing_key, properties, body))
+                return
+            consumer_tag, channel, callback = queue.consumers[queue.next_consumer % len(queue.consumers)]
+            queue.next_consumer += 1
+            delivery_tag = next(self.delivery_tags)
+
+        # callback is run later by thread of consumer's connection
+        channel.connection.put_event(callback, channel, Deliver(consumer_tag, delivery_tag, False, exchange,
+                                                                routing_key), properties, body)
+
+
+def topic_matches(pattern, words):
+    """
+    Checks whether routing key matches binding key of topic exchange
+
+    Args:
+        pattern (list[str]): words of binding key, * matches one word and # zero or more words
+        words (list[str]): words of routing key
+    Returns:
+        bool: True if routing key matches
+    """
+
+    if not pattern:
+        return not words
+
+    if pattern[0] == '#':
+        return any(topic_matches(pattern[1:], words[i:]) for i in range(len(words) + 1))
+
+    return bool(words) and pattern[0] in ('*', words[0]) and topic_matches(pattern[1:], words[1:])
+
+
+class LoopbackConnection(object):
+    """
+    Connection to loopback broker. Like in pika BlockingConnection, consumer callbacks and timeouts are run by
+    the thread calling process_data_events (or start_consuming of channel), messages can be published from any
+    thread.
+    """
+    def __init__(self, broker):
+        """
+        @param broker: broker of the process
+        @type broker: LoopbackBroker
+        """
+        self.broker = broker
+        self.events = deque()  # (callback, channel, method, properties, body) waiting to be run
+        self.timeouts = []  # heap of (deadline, timeout id, callback)
+        self.timeout_ids = itertools.count()
+        self.condition = Condition()
+        self.is_open = True
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self):
+        return LoopbackChannel(self)
+
+    def put_event(self, *event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify()
+
+    def add_timeout(self, deadline, callback):
+        """
+        Call callback after deadline seconds (on thread processing events)
+
+        Returns:
+            int: timeout id for remove_timeout
+        """
+
+        with self.condition:
+            timeout_id = next(self.timeout_ids)
+            heappush(self.timeouts, (time() + deadline, timeout_id, callback))
+            self.condition.notify()
+        return timeout_id
+
+    def add_callback_threadsafe(self, callback):
+        """
+        Call callback as soon as possible on thread processing events (waking it up), like in pika 0.12 and later
+        """
+        self.add_timeout(0, callback)
+
+    def remove_timeout(self, timeout_id):
+        with self.condition:
+            self.timeouts = [timeout for timeout in self.timeouts if timeout[1] != timeout_id]
+            self.timeouts.sort()
+
+    def process_data_events(self, time_limit=0):
+        """
+        Run callbacks of delivered messages and timeouts that are due, waits up to time_limit seconds if there
+        are none
+        """
+
+        end_time = time() + (time_limit or 0)
+
+        while True:
+            with self.condition:
+                now = time()
+                due = []
+                while self.timeouts and self.timeouts[0][0] <= now:
+                    due.append(heappop(self.timeouts)[2])
+                events, self.events = self.events, deque()
+
+                if not due and not events:
+                    wait_until = min(end_time, self.timeouts[0][0]) if self.timeouts else end_time
+                    if wait_until <= now or not self.is_open:
+                        return
+                    self.condition.wait(wait_until - now)
+                    continue
+
+            for callback in due:
+                callback()
+            for callback, channel, method, properties, body in events:
+                callback(channel, method, properties, body)
+            return
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify()
+        self.broker.close_connection(self)
+
+
+class LoopbackChannel(object):
+
+    def __init__(self, connection):
+        """
+        Channel of loopback connection, has the same methods as BlockingConnection.channel (that are used)
+        """
+        self.connection = connection
+        self.broker = connection.broker
+        self.consumer_tags = itertools.count(1)
+        self._consuming = False
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def exchange_declare(self, exchange=None, type='direct', **kwargs):
+        self.broker.declare_exchange(exchange, type)
+
+    def queue_declare(self, queue='', exclusive=False, **kwargs):
+        queue_name = queue or 'amq.gen-%s' % uuid.uuid4().hex
+        declared = self.broker.declare_queue(queue_name, self.connection if exclusive else None)
+        return MethodFrame(DeclareOk(queue_name, len(declared.messages), len(declared.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        self.broker.bind_queue(exchange, queue, routing_key or queue)
+
+    def queue_delete(self, queue='', **kwargs):
+        self.broker.delete_queue(queue)
+
+    def basic_qos(self, **kwargs):
+        pass  # messages are acknowledged on delivery
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False, consumer_tag=None, **kwargs):
+        consumer_tag = consumer_tag or 'ctag%s.%d' % (id(self), next(self.consumer_tags))
+        self.broker.consume(queue, consumer_tag, self, consumer_callback, exclusive)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag='', **kwargs):
+        self.broker.cancel(consumer_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        self.broker.publish(exchange, routing_key, properties or BasicProperties(), body)
+        return True
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.connection.is_open:
+            self.connection.process_data_events(time_limit=CONSUME_WAIT_TIME)
+
+    def stop_consuming(self, consumer_tag=None):
+        self._consuming = False
+        with self.connection.condition:  # wake up start_consuming waiting for messages
+            self.connection.condition.notify()
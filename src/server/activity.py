@@ -0,0 +1,75 @@
+# Keeps track of when players were last seen (heartbeat or any RPC request), so inactive players can be found
+# without going through all known players
+
+# Import
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class LastSeenIndex(object):
+    """
+    Player names ordered by time they were last seen. Seeing player again moves it to the end, so players that
+    have timed out are always at the beginning and expiring them takes time only for expired players.
+    """
+    def __init__(self):
+        self.last_seen = OrderedDict()  # player name -> time last seen, oldest first
+        self.lock = Lock()  # players are seen by listener thread and RPC handling threads
+
+    def touch(self, player_name, now=None):
+        """
+        Mark player as seen
+
+        Args:
+            player_name (str): Name of the player(user)
+            now (float): time player was seen, current time if None
+        """
+
+        with self.lock:
+            self.last_seen.pop(player_name, None)  # re-inserting moves player to the end
+            self.last_seen[player_name] = time.time() if now is None else now
+
+    def expire(self, timeout, now=None):
+        """
+        Remove players that have not been seen during timeout
+
+        Args:
+            timeout (float): seconds after which player is inactive
+            now (float): current time, time.time() if None
+        Returns:
+            list[str]: names of expired players
+        """
+
+        last_seen_limit = (time.time() if now is None else now) - timeout
+        expired = []
+
+        with self.lock:
+            while self.last_seen:
+                player_name, last_seen = next(self.last_seen.iteritems())
+                if last_seen > last_seen_limit:
+                    break  # rest of the players were seen later
+                del self.last_seen[player_name]
+                expired.append(player_name)
+
+        return expired
+
+    def next_expiry(self, timeout):
+        """
+        Time when the next player expires (players seen later expire later)
+
+        Args:
+            timeout (float): seconds after which player is inactive
+        Returns:
+            float: expiry time of player seen longest ago, None if there are no players
+        """
+
+        with self.lock:
+            if not self.last_seen:
+                return None
+            return next(self.last_seen.itervalues()) + timeout
+
+    def __contains__(self, player_name):
+        return player_name in self.last_seen
+
+    def __len__(self):
+        return len(self.last_seen)
@@ -0,0 +1,327 @@
+# Micro-benchmarks of GameSession hot paths (shooting, ship placement, battlefield views) over a range of
+# max_players values with randomized fleets. Results can be saved as baseline and later compared against it.
+
+# Import
+import copy
+import gc
+import json
+import platform
+import random
+from collections import deque
+from timeit import default_timer
+import numpy as np
+from gamesession import GameSession, PlayerList, divide_map_pieces, PIECE_SIZE, PIECE_STRIDE, PIECES_IN_ROW
+
+DEFAULT_MAX_PLAYERS = (2, 4, 8, 16)
+DEFAULT_SEED = 0
+DEFAULT_REPEAT = 15  # measurements of each benchmark, fastest one is reported (least disturbed by other processes)
+# relative slowdown compared to baseline that is reported as regression, same code measured in two processes can
+# differ by more than half on a shared machine (memory layout, other processes), so only clear slowdowns are reported
+DEFAULT_TOLERANCE = 1.0
+ENVIRONMENT_KEYS = ('python', 'numpy', 'machine', 'seed')  # report fields that must match for comparable results
+FLEET = (4, 3, 3, 2, 2, 1)  # ship lengths each player places
+TARGET_TIME = 0.05  # seconds one measurement of benchmark should take at least
+
+
+def random_fleet(pieces, rnd):
+    """
+    Places fleet randomly on given map pieces, ships are straight lines and do not touch each other
+    (so group_ship_coordinates gives back the same ships)
+
+    Args:
+        pieces (list[int]): map pieces of player
+        rnd (random.Random): random generator
+    Returns:
+        list[[int,int]]: coordinates of all ship squares
+    """
+
+    taken = set()  # ship squares and squares next to them
+    coords = []
+
+    for length in FLEET:
+        while True:
+            piece_nr = rnd.choice(pieces)
+            horizontal = rnd.random() < 0.5
+            row = rnd.randrange(PIECE_SIZE if horizontal else PIECE_SIZE - length + 1)
+            column = rnd.randrange(PIECE_SIZE - length + 1 if horizontal else PIECE_SIZE)
+
+            x0 = piece_nr // PIECES_IN_ROW * PIECE_STRIDE + row
+            y0 = piece_nr % PIECES_IN_ROW * PIECE_STRIDE + column
+            ship = [(x0, y0 + i) if horizontal else (x0 + i, y0) for i in range(length)]
+
+            if not taken.intersection(ship):
+                break
+
+        for x, y in ship:
+            taken.update((x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+        coords.extend([x, y] for x, y in ship)
+
+    return coords
+
+
+def new_full_session(max_players, rnd):
+    """
+    Creates session where all players have joined and got map pieces
+
+    Args:
+        max_players (int): maximum count of players in game
+        rnd (random.Random): random generator
+    Returns:
+        (GameSession, dict[str, list[[int,int]]]): session with players owner, p1, p2, ... and fleet of each player
+    """
+
+    sess = GameSession("bench", max_players, "owner")
+    for i in range(1, max_players):
+        player = "p%d" % i
+        sess.players.append(player)
+        sess.assign_pieces(player)
+    fleets = dict((player, random_fleet(sess.get_map_pieces(player), rnd)) for player in sess.players)
+
+    return sess, fleets
+
+
+def new_started_game(max_players, rnd):
+    """
+    Creates session where all players have placed randomized fleets and game has started
+
+    Returns:
+        (GameSession, list[[int,int]]): started session and all squares inside map pieces in random order
+    """
+
+    sess, fleets = new_full_session(max_players, rnd)
+    for player in sess.players:
+        sess.place_ships(player, fleets[player])
+    sess.start_game()
+
+    shot_order = [[int(x), int(y)] for x, y in np.argwhere(sess.piece_squares)]
+    rnd.shuffle(shot_order)
+
+    return sess, shot_order
+
+
+def shoot(sess, shots):
+    """
+    Takes shots same way as rpc_requests.on_request_shoot (checking end of game after sinking ship)
+    """
+
+    for coords in shots:
+        if sess.check_shot(coords) == 2:
+            sess.check_end_game()
+
+
+def measure(setup, run, rounds):
+    """
+    Measures time of given number of runs, setup is not timed
+
+    Args:
+        setup (function): gives back state for run (called before every timed run)
+        run (function): timed function, gets state as argument
+        rounds (int): number of runs
+    Returns:
+        float: seconds taken by runs
+    """
+
+    total = 0.0
+    gc_enabled = gc.isenabled()
+    gc.disable()  # same as timeit, collections triggered by garbage of setup would be timed
+    try:
+        for i in range(rounds):
+            state = setup()
+            start = default_timer()
+            run(state)
+            total += default_timer() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return total
+
+
+def calibrate_rounds(setup, run):
+    """
+    Returns:
+        int: number of runs that takes at least TARGET_TIME
+    """
+
+    rounds = 1
+    while measure(setup, run, rounds) < TARGET_TIME:
+        rounds *= 2
+    return rounds
+
+
+def bench_divide_map_pieces(max_players, rnd):
+    return lambda: None, lambda state: divide_map_pieces(max_players, PIECES_IN_ROW), 1
+
+
+def bench_place_ships(max_players, rnd):
+    sess, fleets = new_full_session(max_players, rnd)
+
+    def run(state):
+        for player in sess.players:  # old placement of player is removed first
+            sess.place_ships(player, fleets[player])
+
+    return lambda: None, run, max_players
+
+
+def bench_check_shot(max_players, rnd):
+    # every player has cached view of battlefield (updated on every shot), like after reconnecting
+    game, shot_order = new_started_game(max_players, rnd)
+    for player in game.players:
+        game.get_player_battlefield(player)
+
+    return lambda: copy.deepcopy(game), lambda sess: shoot(sess, shot_order), len(shot_order)
+
+
+def bench_check_end_game(max_players, rnd):
+    # every player has lost, each call removes one of them and last call finds nobody
+    sess, shot_order = new_started_game(max_players, rnd)
+    players = list(sess.players)
+
+    def setup():
+        sess.players_lost = deque(players)
+        sess.players_alive = PlayerList(players)
+
+    def run(state):
+        for i in range(max_players + 1):
+            sess.check_end_game()
+
+    return setup, run, max_players + 1
+
+
+def bench_get_player_battlefield(max_players, rnd):
+    # half of squares shot, views are not cached (first request after ship placement or reconnect)
+    sess, shot_order = new_started_game(max_players, rnd)
+    shoot(sess, shot_order[:len(shot_order) // 2])
+
+    def setup():
+        sess.player_views = {}
+
+    def run(state):
+        for player in sess.players:
+            sess.get_player_battlefield(player)
+
+    return setup, run, max_players
+
+
+def bench_get_player_battlefield_cached(max_players, rnd):
+    sess, shot_order = new_started_game(max_players, rnd)
+    shoot(sess, shot_order[:len(shot_order) // 2])
+
+    def run(state):
+        for player in sess.players:
+            sess.get_player_battlefield(player)
+
+    return lambda: None, run, max_players
+
+
+# name, benchmark(max_players, rnd) giving setup, timed run (see measure) and number of operations done by one run
+BENCHMARKS = [('divide_map_pieces', bench_divide_map_pieces),
+              ('place_ships', bench_place_ships),
+              ('check_shot', bench_check_shot),
+              ('check_end_game', bench_check_end_game),
+              ('get_player_battlefield', bench_get_player_battlefield),
+              ('get_player_battlefield_cached', bench_get_player_battlefield_cached)]
+
+
+def run_benchmarks(max_players_values=DEFAULT_MAX_PLAYERS, seed=DEFAULT_SEED, repeat=DEFAULT_REPEAT, names=None):
+    """
+    Runs benchmarks, same seed gives same map pieces, fleets and shooting order
+
+    Args:
+        max_players_values (list[int]): max_players values of benchmarked sessions
+        seed (int): seed of random generators
+        repeat (int): number of measurements of each benchmark, fastest one is reported
+        names (list[str]): names of benchmarks to run, all if None
+    Returns:
+        dict[str, object]: 'results' - benchmark name -> max_players (as str) -> seconds per operation,
+            environment info and parameters
+    """
+
+    results = {}
+    cases = []  # (name, max_players, setup, run, operations in one run, runs in one measurement)
+
+    for name, benchmark in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        results[name] = {}
+        for max_players in max_players_values:
+            random.seed(seed * 1000 + max_players)  # divide_map_pieces uses module random
+            rnd = random.Random(seed * 1000 + max_players)
+            setup, run, ops = benchmark(max_players, rnd)
+            cases.append((name, str(max_players), setup, run, ops, calibrate_rounds(setup, run)))
+
+    # measurements of benchmarks take turns, so a slow period of machine (other processes, CPU frequency) can not
+    # hit all measurements of one benchmark
+    for i in range(repeat):
+        for name, max_players, setup, run, ops, rounds in cases:
+            time = measure(setup, run, rounds) / (rounds * ops)
+            results[name][max_players] = min(results[name].get(max_players, time), time)
+
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'seed': seed,
+            'repeat': repeat,
+            'results': results}
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results to baseline, only benchmarks present in both are compared
+
+    Args:
+        results (dict[str, dict[str, float]]): benchmark name -> max_players -> seconds per operation
+        baseline (dict[str, dict[str, float]]): same for baseline
+        tolerance (float): relative slowdown that is not yet regression
+    Returns:
+        list[(str, str, float, float, bool)]: benchmark name, max_players, baseline time, time, is regression
+    """
+
+    comparison = []
+
+    for name in sorted(results):
+        for max_players in sorted(results[name], key=int):
+            if max_players not in baseline.get(name, {}):
+                continue
+            baseline_time = baseline[name][max_players]
+            time = results[name][max_players]
+            comparison.append((name, max_players, baseline_time, time, time > baseline_time * (1 + tolerance)))
+
+    return comparison
+
+
+def environment_differences(report, baseline):
+    """
+    Returns:
+        list[(str, object, object)]: environment key, value in baseline and value in report for differing keys
+    """
+    return [(key, baseline.get(key), report[key]) for key in ENVIRONMENT_KEYS if baseline.get(key) != report[key]]
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(report, path):
+    with open(path, 'w') as baseline_file:
+        json.dump(report, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return '%.2f us' % (seconds * 1e6)
+    return '%.2f ms' % (seconds * 1e3)
+
+
+def print_results(results):
+    for name in sorted(results):
+        for max_players in sorted(results[name], key=int):
+            print "%-30s %4s players %12s/op" % (name, max_players, format_time(results[name][max_players]))
+
+
+def print_comparison(comparison):
+    for name, max_players, baseline_time, time, regression in comparison:
+        print "%-30s %4s players %12s/op baseline %12s/op %+7.1f%%%s" % (
+            name, max_players, format_time(time), format_time(baseline_time),
+            (time / baseline_time - 1) * 100, "  REGRESSION" if regression else "")
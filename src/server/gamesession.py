@@ -2,9 +2,97 @@
 
 # Import
 import random
+from collections import deque
+import numpy as np
+from common import LOG, log_fields
 
+# Battlefield layout: each map piece is 5x5 squares with 1 buffer square after it, 4 pieces in a row
+PIECE_SIZE = 5
+PIECE_STRIDE = PIECE_SIZE + 1
+PIECES_IN_ROW = 4
+FIELD_COLUMNS = PIECES_IN_ROW * PIECE_STRIDE - 1  # 20 squares + 3 buffer columns
 
-class GameSession:
+
+class PlayerList(list):
+    """
+    List of player names (each name only once) with O(1) membership check, keeps order of players (turn order).
+    Serialized to JSON as ordinary list.
+    """
+
+    def __init__(self, players=()):
+        super(PlayerList, self).__init__()
+        self._members = set()
+        self.extend(players)
+
+    def __contains__(self, player):
+        return player in self._members
+
+    def __reduce__(self):
+        return PlayerList, (list(self),)
+
+    def append(self, player):
+        if player not in self._members:
+            self._members.add(player)
+            super(PlayerList, self).append(player)
+
+    def extend(self, players):
+        for player in players:
+            self.append(player)
+
+    def __iadd__(self, players):
+        self.extend(players)
+        return self
+
+    def insert(self, idx, player):
+        if player not in self._members:
+            self._members.add(player)
+            super(PlayerList, self).insert(idx, player)
+
+    def remove(self, player):
+        if player not in self._members:
+            raise ValueError("%s not in players list" % player)
+        self._members.remove(player)
+        super(PlayerList, self).remove(player)
+
+    def pop(self, idx=-1):
+        player = super(PlayerList, self).pop(idx)
+        self._members.discard(player)
+        return player
+
+    def __setitem__(self, idx, value):
+        super(PlayerList, self).__setitem__(idx, value)
+        self._members = set(self)
+
+    def __delitem__(self, idx):
+        super(PlayerList, self).__delitem__(idx)
+        self._members = set(self)
+
+    def __setslice__(self, i, j, players):
+        self.__setitem__(slice(i, j), players)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+
+class Ship(object):
+
+    def __init__(self, ship_id, owner, coords):
+        """
+        Ship registry entry, keeps count of ship parts that are not hit yet
+
+        Args:
+            ship_id (int): id of ship (unique in game session)
+            owner (str): name of the player who placed the ship
+            coords (list[[int,int]]): coordinates of all ship squares
+        """
+
+        self.ship_id = ship_id
+        self.owner = owner
+        self.coords = coords
+        self.hits_left = len(coords)
+
+
+class GameSession(object):
 
     def __init__(self, session_name, max_players, owner):
 
@@ -12,22 +100,55 @@ class GameSession:
         self.max_players = max_players  # maximum count of players
         self.owner = owner  # owner of given session (can start game)
         self.in_game = False  # is game currently on going or in lobby
-        self.players = [owner]  # players joined in session
-        self.players_ready = []  # can't start before all players ready (owner doesn't matter)
+        self.players = PlayerList([owner])  # players joined in session (in turn order)
+        self.players_ready = PlayerList()  # can't start before all players ready (owner doesn't matter)
         # self.map_size = [(6*max_players - 1), (20+3)]  # players-1 buffer rows,
         # 3 buffer columns between pieces
+        self.map_pieces_assigned = [owner] + [None]*(max_players-1)  # which map piece is assigned to who
+        self.piece_owner = []  # owner of each map piece by piece number (None if not assigned)
+        self.player_pieces_idx = {}  # player name -> index of player's pieces in map_pieces
+        """@type: dict[str, int]"""
         self.map_pieces = divide_map_pieces(max_players, 4)  # map pieces divided into 4 (each player 4 random squares)
-        self.map_pieces_assigned = [owner] + [None]*(max_players-1)  # which map piece is assigned to who (add to dict?)
-        self.battlefield = [x[:] for x in [[0] * (20 + 3)] * (max_players * 6 - 1)]  # init ship placement matrix
+        self.battlefield = new_battlefield(max_players)  # init ship placement matrix
         # 5 lines for each player + 1 for buffer between player pieces
-        self.ships_placed = []  # players who have placed ships, needed in order to start game
+        self.piece_grid = new_piece_grid(max_players)  # map piece number of each square (buffers included)
+        self.piece_squares = new_piece_squares_mask(max_players)  # True for squares inside map pieces
+        self.ship_grid = new_ship_grid(max_players)  # ship id of each square, -1 if there is no ship
+        self.ships = {}  # ship registry, ship id -> Ship
+        """@type: dict[int, Ship]"""
+        self.next_ship_id = 0
+        self.ship_squares_left = {}  # player name -> count of player's ship squares not hit yet
+        """@type: dict[str, int]"""
+        self.players_lost = deque()  # players whose last ship square got hit, not yet removed from players_alive
+        self.shots = []  # coordinates of shot squares in order of shooting, sent to reconnecting users as delta
+        self.player_views = {}  # player name -> cached battlefield showing only player's ships, updated on shots
+        """@type: dict[str, numpy.ndarray]"""
+        self.ships_placed = PlayerList()  # players who have placed ships, needed in order to start game
         self.next_shot_by = owner  # player who is shooting atm (or going to)
-        self.players_active = []  # name of players who are communicating actively with server
-        self.players_alive = []  # player names that still have ships left
+        self.players_active = PlayerList()  # name of players who are communicating actively with server
+        self.players_alive = PlayerList()  # player names that still have ships left
         # where the ships are (-1, 0, 1, 2) 2 for healthy ship part,
         # 1 for hit ship and 0 for empty spot, should server take also into account what spot is shot?
         # So if player reconnects he can get the info about what spot is shot already. -1 for shot empty spot
 
+    @property
+    def map_pieces(self):
+        """
+        list[list[int]]: map pieces divided between players, setting it rebuilds piece ownership lookups
+        """
+        return self._map_pieces
+
+    @map_pieces.setter
+    def map_pieces(self, map_pieces):
+        self._map_pieces = map_pieces
+        self.player_views = {}
+        self.piece_owner = [None] * (self.max_players * PIECES_IN_ROW)
+        self.player_pieces_idx = {}
+
+        for idx, user_name in enumerate(self.map_pieces_assigned):
+            if user_name is not None:
+                self.set_pieces_owner(idx, user_name)
+
     def info(self):
         """
         Gives back dictionary containing game session info
@@ -40,10 +161,76 @@ class GameSession:
                      'in_game': self.in_game,
                      'player_count': len(self.players),
                      'max_count': self.max_players,
-                     'ready': self.players_ready,
-                     'map': self.map_pieces_assigned}
+                     'ready': list(self.players_ready),  # copies, info is compared to earlier info
+                     'map': list(self.map_pieces_assigned)}
         return dict_info
 
+    def to_dict(self):
+        """
+        Gives back state of game session as plain data (lists, dicts, strings and numbers), so it can be encoded
+        as JSON or msgpack. Cached player views and lookups built from map pieces are not included.
+
+        Returns:
+            dict[str, object]: state of game session, GameSession.from_dict makes session of it
+        """
+        return {'session_name': self.session_name,
+                'max_players': self.max_players,
+                'owner': self.owner,
+                'in_game': self.in_game,
+                'players': list(self.players),
+                'players_ready': list(self.players_ready),
+                'map_pieces_assigned': list(self.map_pieces_assigned),
+                'map_pieces': self.map_pieces,
+                'battlefield': self.battlefield.tolist(),
+                'ship_grid': self.ship_grid.tolist(),
+                'ships': [[ship.ship_id, ship.owner, ship.coords, ship.hits_left] for ship in self.ships.values()],
+                'next_ship_id': self.next_ship_id,
+                'ship_squares_left': self.ship_squares_left,
+                'players_lost': list(self.players_lost),
+                'shots': self.shots,
+                'ships_placed': list(self.ships_placed),
+                'next_shot_by': self.next_shot_by,
+                'players_active': list(self.players_active),
+                'players_alive': list(self.players_alive)}
+
+    @staticmethod
+    def from_dict(state):
+        """
+        Makes game session of state given by GameSession.to_dict
+
+        Args:
+            state (dict[str, object]): state of game session
+        Returns:
+            GameSession: game session in given state
+        Raises:
+            KeyError, TypeError, ValueError: if state is incomplete or invalid
+        """
+        sess = GameSession(state['session_name'], int(state['max_players']), state['owner'])
+        shape = sess.battlefield.shape
+
+        sess.in_game = bool(state['in_game'])
+        sess.players = PlayerList(state['players'])
+        sess.players_ready = PlayerList(state['players_ready'])
+        sess.map_pieces_assigned = list(state['map_pieces_assigned'])
+        sess.map_pieces = [list(pieces) for pieces in state['map_pieces']]  # rebuilds piece lookups
+        sess.battlefield = np.array(state['battlefield'], dtype=np.int8).reshape(shape)
+        sess.ship_grid = np.array(state['ship_grid'], dtype=np.int32).reshape(shape)
+        sess.ships = {}
+        for ship_id, owner, coords, hits_left in state['ships']:
+            ship = Ship(int(ship_id), owner, [list(coord) for coord in coords])
+            ship.hits_left = int(hits_left)
+            sess.ships[ship.ship_id] = ship
+        sess.next_ship_id = int(state['next_ship_id'])
+        sess.ship_squares_left = dict(state['ship_squares_left'])
+        sess.players_lost = deque(state['players_lost'])
+        sess.shots = [list(coords) for coords in state['shots']]
+        sess.ships_placed = PlayerList(state['ships_placed'])
+        sess.next_shot_by = state['next_shot_by']
+        sess.players_active = PlayerList(state['players_active'])
+        sess.players_alive = PlayerList(state['players_alive'])
+
+        return sess
+
     def check_shot(self, coords):
         """
         checks whether given square was a hit
@@ -56,21 +243,44 @@ class GameSession:
         x = coords[0]
         y = coords[1]
 
-        result = self.battlefield[x][y]
+        result = self.battlefield[x, y]
 
         if result == 0:  # no ship, not shot
-            self.battlefield[x][y] = -1
+            self.battlefield[x, y] = -1
+            self.record_shot(x, y)
             return 0
         elif result == 2:  # ship, not shot
-            self.battlefield[x][y] = 1
+            self.battlefield[x, y] = 1
+            self.record_shot(x, y)
+            ship = self.ships[self.ship_grid[x, y]]
+            ship.hits_left -= 1
+            self.ship_squares_left[ship.owner] -= 1
+            if self.ship_squares_left[ship.owner] == 0 and self.in_game:
+                self.players_lost.append(ship.owner)
             if self.check_ship_sunk(x, y):
                 return 2
             else:
                 return 1
         else:
-            print("Square [%d,%d] was already shot" % (x, y))
+            LOG.debug("Square was already shot", extra=log_fields(session=self.session_name, coords=[x, y]))
             return 0  # miss, however spot was already shot
 
+    def record_shot(self, x, y):
+        """
+        Adds shot to shot history and updates cached player views of battlefield
+
+        Args:
+            x (int): x coordinate of battlefield (row number)
+            y (int): y coordinate of battlefield (column number)
+        """
+
+        self.shots.append([x, y])
+
+        owner = self.get_piece_owner(self.piece_grid[x, y])
+        for user_name, view in self.player_views.items():
+            # opponents see every shot square as -1 (ship or not)
+            view[x, y] = self.battlefield[x, y] if user_name == owner else -1
+
     def check_end_game(self):
         """
         Checks who are still in game, if only one player then game over.
@@ -79,38 +289,20 @@ class GameSession:
             str: player name if some one just lost a game, else None
         """
 
-        max_x = len(self.battlefield)
-        max_y = len(self.battlefield[0])
-
-        list_players_left = []
-
-        for x in range(0, max_x):
-            for y in range(0, max_y):
-                if self.battlefield[x][y] == 2:
-                    owner = self.get_ship_owner([x, y])
-                    if owner not in list_players_left:
-                        list_players_left.append(owner)
+        while self.players_lost:
+            player = self.players_lost.popleft()
+            if player in self.players_alive:  # in this case all of player's ships have been destroyed
+                self.players_alive.remove(player)
+                return player
 
-        if list_players_left != len(self.players_alive):
-            for player in self.players_alive:
-                if player not in list_players_left:  # in this case all of player's ships have been destroyed
-                    self.players_alive.remove(player)
-                    return player
-        else:
-            return None
+        return None
 
     def check_ship_sunk(self, x, y):
-        # check whether ship is sunk or not
-
-        ship_coords = self.get_ship_coordinates([x, y])
+        # check whether ship is sunk or not (all ship parts been shot at)
 
-        for coords in ship_coords:
-            value = self.battlefield[coords[0]][coords[1]]
-            if value == 2:
-                return False  # at least one part of ship is unbroken
+        ship = self.get_ship([x, y])
 
-        # All ship parts been shot at
-        return True
+        return ship is not None and ship.hits_left == 0
 
     def get_next_player(self):
         """
@@ -138,63 +330,32 @@ class GameSession:
 
     def get_ship_coordinates(self, coords):
         """
-        Gets all coordinates of given ship, atm not checked whether given coordinate has ship.
+        Gets all coordinates of given ship from ship registry.
 
         Args:
-            coords:
+            coords ([int,int]): coordinates of any ship square
         Returns:
-            list[[int,int]]: list of coordinates containing ship coordinates
+            list[[int,int]]: list of coordinates containing ship coordinates (only given coordinates if no ship)
         """
 
-        field_length_x = self.max_players * 6 - 1
-        field_length_y = 20 + 3
-        x = coords[0]
-        y = coords[1]
+        ship = self.get_ship(coords)
 
+        if ship is None:
+            return [list(coords)]
 
-        ship_coords = [coords]
+        return ship.coords
 
-        for i in range(1, 5):  # max length of ship is 5 (each square is 5X5)
-            if (y - i) >= 0:  # check up
-                spot_info = self.battlefield[x][y - i]
-                if spot_info == 2 or spot_info == 1:
-                    ship_coords.append([x, y-i])
-                else:
-                    break
-            else:
-                break
-
-        for i in range(1, 4):  # max length of ship is 4
-            if (y + i) < field_length_y:  # check down (y must be smaller than field width)
-                spot_info = self.battlefield[x][y + i]
-                if spot_info == 2 or spot_info == 1:
-                    ship_coords.append([x, y+i])
-                else:
-                    break
-            else:
-                break
-
-        for i in range(1, 4):  # max length of ship is 4
-            if (x - i) >= 0:  # check left
-                spot_info = self.battlefield[x - i][y]
-                if spot_info == 2 or spot_info == 1:
-                    ship_coords.append([x-i, y])
-                else:
-                    break
-            else:
-                break
-
-        for i in range(1, 4):  # max length of ship is 4
-            if (x + i) < field_length_x:  # check right (x must be smaller than field height)
-                spot_info = self.battlefield[x + i][y]
-                if spot_info == 2 or spot_info == 1:
-                    ship_coords.append([x+i, y])
-                else:
-                    break
-            else:
-                break
+    def get_ship(self, coords):
+        """
+        Gets ship placed on given square
 
-        return ship_coords  # if no 2-s found around ship, then ship is sunk
+        Args:
+            coords ([int,int]): coordinates of square
+        Returns:
+            Ship: ship on given square, None if there is no ship
+        """
+
+        return self.ships.get(self.ship_grid[coords[0], coords[1]])
 
     def assign_pieces(self, user_name):
         """
@@ -209,15 +370,33 @@ class GameSession:
         if None in self.map_pieces_assigned:
             idx = self.map_pieces_assigned.index(None)
             self.map_pieces_assigned[idx] = user_name
+            self.set_pieces_owner(idx, user_name)
             return self.map_pieces[idx]
         else:
             return []
 
     def unassign_pieces(self, user_name):
 
-        if user_name in self.map_pieces_assigned:
-            idx = self.map_pieces_assigned.index(user_name)
+        idx = self.player_pieces_idx.pop(user_name, None)
+
+        if idx is not None:
             self.map_pieces_assigned[idx] = None
+            self.player_views.pop(user_name, None)
+            for piece_nr in self.map_pieces[idx]:
+                self.piece_owner[piece_nr] = None
+
+    def set_pieces_owner(self, idx, user_name):
+        """
+        Updates piece ownership lookups after map pieces have been assigned to player
+
+        Args:
+            idx (int): index of assigned pieces in map_pieces
+            user_name (str): Name of the player (user)
+        """
+
+        self.player_pieces_idx[user_name] = idx
+        for piece_nr in self.map_pieces[idx]:
+            self.piece_owner[piece_nr] = user_name
 
     def check_ready(self, owner):
         """
@@ -252,13 +431,16 @@ class GameSession:
         if err != "":
             return err
 
-        ship_map = self.battlefield
+        # Add ships to map and register them
+        for ship_coords in group_ship_coordinates(coords):
+            ship = Ship(self.next_ship_id, user_name, ship_coords)
+            self.ships[ship.ship_id] = ship
+            self.next_ship_id += 1
 
-        # Add ships to map
-        for coord in coords:
-            ship_map[coord[0]][coord[1]] = 2
-
-        self.battlefield = ship_map
+            xs, ys = np.asarray(ship_coords, dtype=np.intp).T
+            self.battlefield[xs, ys] = 2
+            self.ship_grid[xs, ys] = ship.ship_id
+            self.ship_squares_left[user_name] += ship.hits_left
 
         if user_name not in self.ships_placed:
             self.ships_placed.append(user_name)
@@ -275,25 +457,21 @@ class GameSession:
             str: error messages
         """
 
-        ship_map = self.battlefield
-
-        if user_name in self.map_pieces_assigned:
-            idx = self.map_pieces_assigned.index(user_name)
-        else:
+        if user_name not in self.player_pieces_idx:
             return "No pieces of map are assigned to user %s" % user_name
 
-        pieces = self.map_pieces[idx]
-
-        # clear player assigned map pieces
-        for p in pieces:  # piece 0 - 0..4, 6..10, 12..16, 18..22
-            column_start = p % 4 * 6  # 4 pieces in row, 5 elements + 1 in piece (1 buffer element)
-            row_start = p // 4 * 6  # divided by 4 pieces in row
+        pieces = self.get_map_pieces(user_name)
 
-            for i in range(column_start, column_start+5):  # 5 elements in piece
-                for j in range(row_start, row_start+5):
-                    ship_map[j][i] = 0
+        # clear player assigned map pieces (buffer squares between pieces are left untouched)
+        mask = self.get_pieces_mask(pieces) & self.piece_squares
+        self.battlefield[mask] = 0
 
-        self.battlefield = ship_map
+        # unregister ships placed on cleared pieces
+        for ship_id in np.unique(self.ship_grid[mask]):
+            self.ships.pop(ship_id, None)
+        self.ship_grid[mask] = -1
+        self.ship_squares_left[user_name] = 0
+        self.player_views = {}  # ship placement changed, views must be rebuilt
 
         return ""
 
@@ -309,20 +487,26 @@ class GameSession:
         x = coords[0]
         y = coords[1]
 
-        piece_nr = self.get_piece_nr(x,y)
-
-        owner_of_square = None
-
-        for pieces in self.map_pieces:
-            if piece_nr in pieces:
-                idx = self.map_pieces.index(pieces)
-                owner_of_square = self.map_pieces_assigned[idx]
+        owner_of_square = self.get_piece_owner(self.get_piece_nr(x, y))
 
         if owner_of_square is None:
-            print("ERR: Piece is not assigned to anyone!!")
+            LOG.error("Map piece is not assigned to anyone",
+                      extra=log_fields(session=self.session_name, coords=[x, y], piece=self.get_piece_nr(x, y)))
 
         return owner_of_square
 
+    def get_piece_owner(self, piece_nr):
+        """
+        returns to who given map piece is assigned to
+
+        Args:
+            piece_nr (int): number of map piece
+        Returns:
+            str: player name, to who this piece belongs to (None if not assigned)
+        """
+
+        return self.piece_owner[piece_nr]
+
     def clean_player_info(self, user_name):
         """
         Removes all player info from server. Player ship placement, ready status, player from players list, unassign
@@ -355,29 +539,36 @@ class GameSession:
              list[int]: containing indexes of player map pieces
         """
 
-        if user_name in self.map_pieces_assigned:
-            idx = self.map_pieces_assigned.index(user_name)
-            return self.map_pieces[idx]
+        if user_name in self.player_pieces_idx:
+            return self.map_pieces[self.player_pieces_idx[user_name]]
         else:
             return []
 
     def start_game(self):
         self.in_game = True
-        self.players_alive = self.players[:]
-        self.players_active = self.players[:]
+        self.players_alive = PlayerList(self.players)
+        self.players_active = PlayerList(self.players)
+        # players without any ships lose right away
+        self.players_lost = deque(player for player in self.players if self.ship_squares_left.get(player, 0) == 0)
 
     def reset_session(self):
         """
         Resets ship placement, battlefield and in game info
         """
         self.in_game = False
-        self.players_ready = []
-        self.battlefield = [x[:] for x in [[0] * (20 + 3)] * (self.max_players * 6 - 1)]
-        self.ships_placed = []
+        self.players_ready = PlayerList()
+        self.battlefield = new_battlefield(self.max_players)
+        self.ship_grid = new_ship_grid(self.max_players)
+        self.ships = {}
+        self.ship_squares_left = {}
+        self.players_lost = deque()
+        self.shots = []
+        self.player_views = {}
+        self.ships_placed = PlayerList()
         self.next_shot_by = self.owner
-        self.players = self.players_active[:]
-        self.players_active = []
-        self.players_alive = []
+        self.players = self.players_active
+        self.players_active = PlayerList()
+        self.players_alive = PlayerList()
 
     def get_player_battlefield(self, user_name):
         """
@@ -389,25 +580,50 @@ class GameSession:
              list[list[int]]: matrix of battlefield, meant for reconnecting user
         """
 
-        map_pieces = self.get_map_pieces(user_name)
-        player_battlefield = [x[:] for x in [[]] * (self.max_players * 6 - 1)]
+        player_battlefield = self.player_views.get(user_name)
+
+        if player_battlefield is None:
+            player_battlefield = self.battlefield.copy()
+
+            # replace 1 with -1 and 2 with 0 only if they are not on player piece (hide opponent ships and hits)
+            hidden = ~self.get_pieces_mask(self.get_map_pieces(user_name))
+            player_battlefield[hidden & (player_battlefield == 1)] = -1
+            player_battlefield[hidden & (player_battlefield == 2)] = 0
+
+            self.player_views[user_name] = player_battlefield  # kept up to date by record_shot
 
-        # go through battlefield, replace 1 with -1 and 2 with 0 only if they are not on player piece
-        for x in range(0, len(self.battlefield)):
-            for y in range(0, len(self.battlefield[0])):
-                piece_nr = self.get_piece_nr(x, y)
-                if piece_nr in map_pieces:  # player map piece, can show ships and stuff
-                    player_battlefield[x].append(self.battlefield[x][y])
-                else:  # opponents map pieces, hide ships and hits
-                    value = self.battlefield[x][y]
-                    if value == 1:
-                        value = -1
-                    elif value == 2:
-                        value = 0
+        return player_battlefield.tolist()
 
-                    player_battlefield[x].append(value)
+    def get_player_battlefield_delta(self, user_name):
+        """
+        Gives back compact alternative to get_player_battlefield: user ships and shot history.
+        Size depends on number of ships and shots, not on battlefield size.
 
-        return player_battlefield
+        Args:
+            user_name (str) : Name of player (user)
+        Returns:
+             dict[str, list[[int,int]]]: 'ships' - coordinates of user ship squares,
+                'shots' - coordinates of shot squares in order of shooting
+        """
+
+        ships = [coords for ship in self.ships.values() if ship.owner == user_name for coords in ship.coords]
+
+        return {'ships': ships, 'shots': self.shots}
+
+    def get_pieces_mask(self, pieces):
+        """
+        Gives back boolean matrix marking squares that belong to given map pieces
+
+        Args:
+            pieces (list[int]): map piece numbers
+        Returns:
+            numpy.ndarray: boolean matrix of battlefield size
+        """
+
+        selected = np.zeros(len(self.piece_owner), dtype=bool)
+        selected[list(pieces)] = True
+
+        return selected[self.piece_grid]
 
     @staticmethod
     def get_piece_nr(x, y):
@@ -422,11 +638,12 @@ class GameSession:
         """
 
         # get which piece from row, 0th, 1st, 2nd, 3rd
-        piece_nr_row = y // 6  # divided by 6 because each piece have 6 squares (except last)
+        piece_nr_row = y // PIECE_STRIDE  # divided by 6 because each piece have 6 squares (except last)
         # get on which column player assigned piece is (6 squares per piece)
-        piece_nr_column = x // 6
+        piece_nr_column = x // PIECE_STRIDE
 
-        piece_nr = piece_nr_column * 4 + piece_nr_row  # every column has 4 pieces (column nr start from zero)
+        piece_nr = piece_nr_column * PIECES_IN_ROW + piece_nr_row  # every column has 4 pieces
+        # (column nr start from zero)
         # and then added piece number of row
 
         return piece_nr
@@ -457,3 +674,91 @@ def divide_map_pieces(number_of_players, pieces_per_player):
         divided_pieces.append(temp_list)
 
     return divided_pieces
+
+
+def new_battlefield(number_of_players):
+    """
+    Creates empty battlefield matrix, 5 rows for each player + 1 buffer row between player pieces
+
+    Args:
+        number_of_players (int): maximum count of players in game
+    Returns:
+        numpy.ndarray: int8 matrix filled with zeros (-1, 0, 1, 2 are used as square values)
+    """
+
+    return np.zeros((number_of_players * PIECE_STRIDE - 1, FIELD_COLUMNS), dtype=np.int8)
+
+
+def new_piece_grid(number_of_players):
+    """
+    Creates matrix containing map piece number of every battlefield square (same as GameSession.get_piece_nr)
+
+    Args:
+        number_of_players (int): maximum count of players in game
+    Returns:
+        numpy.ndarray: int matrix of battlefield size
+    """
+
+    rows = np.arange(number_of_players * PIECE_STRIDE - 1) // PIECE_STRIDE * PIECES_IN_ROW
+    columns = np.arange(FIELD_COLUMNS) // PIECE_STRIDE
+
+    return np.add.outer(rows, columns)
+
+
+def new_piece_squares_mask(number_of_players):
+    """
+    Creates boolean matrix marking squares that are inside map pieces (False for buffer squares)
+
+    Args:
+        number_of_players (int): maximum count of players in game
+    Returns:
+        numpy.ndarray: boolean matrix of battlefield size
+    """
+
+    rows, columns = np.indices((number_of_players * PIECE_STRIDE - 1, FIELD_COLUMNS))
+
+    return (rows % PIECE_STRIDE < PIECE_SIZE) & (columns % PIECE_STRIDE < PIECE_SIZE)
+
+
+def new_ship_grid(number_of_players):
+    """
+    Creates matrix for ship ids of battlefield squares
+
+    Args:
+        number_of_players (int): maximum count of players in game
+    Returns:
+        numpy.ndarray: int matrix of battlefield size filled with -1 (no ship)
+    """
+
+    return np.full((number_of_players * PIECE_STRIDE - 1, FIELD_COLUMNS), -1, dtype=np.int32)
+
+
+def group_ship_coordinates(coords):
+    """
+    Groups ship squares into ships, squares next to each other (not diagonally) belong to the same ship
+
+    Args:
+        coords (list[list[int]]): x and y coordinates of all ships
+    Returns:
+        list[list[[int,int]]]: list of ships, each containing sorted coordinates of its squares
+    """
+
+    squares_left = set((coord[0], coord[1]) for coord in coords)
+    ships = []
+
+    while squares_left:
+        stack = [squares_left.pop()]
+        ship_coords = []
+
+        while stack:
+            x, y = stack.pop()
+            ship_coords.append([x, y])
+
+            for neighbour in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if neighbour in squares_left:
+                    squares_left.remove(neighbour)
+                    stack.append(neighbour)
+
+        ships.append(sorted(ship_coords))
+
+    return ships
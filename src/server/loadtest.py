@@ -0,0 +1,391 @@
+# Load generator - bots playing battleship through server RPC-s the same way client does (connect, create or
+# join session, place ships, get ready, start game, shoot in turns), measuring latency and throughput of every
+# RPC method. Server is run in the same process on memory transport, or bots connect to server behind RabbitMQ.
+
+# Import
+import math
+import random
+import sys
+import uuid
+from collections import deque
+from threading import Thread, Condition
+from timeit import default_timer
+import rpc_requests
+from main import init_connection_to_mq
+from persistence import SessionStore
+from benchmark import random_fleet
+from gamesession import PIECE_SIZE, PIECE_STRIDE, PIECES_IN_ROW
+from common import HashRing, BasicProperties, get_content_type, get_transport, encode_message, decode_message, \
+    get_request_key, rpc_queue_prefix
+
+DEFAULT_BOTS = 20
+DEFAULT_PLAYERS = 2  # bots in one game session
+DEFAULT_GAMES = 3  # games played in each session
+DEFAULT_TIMEOUT = 10  # seconds bot waits for RPC response or its turn before giving up
+PERCENTILES = (50, 99)
+
+
+class LoadTestError(Exception):
+    pass
+
+
+class LoadStats(object):
+    """
+    RPC latencies of all bots, bots record their calls from their own threads
+    """
+    def __init__(self):
+        self.latencies = {}  # method name -> list of seconds
+        """@type: dict[str, list[float]]"""
+        self.errors = {}  # method name -> number of calls that timed out or got error response
+        self.condition = Condition()
+
+    def record(self, method_name, latency, ok=True):
+        with self.condition:
+            self.latencies.setdefault(method_name, []).append(latency)
+            if not ok:
+                self.errors[method_name] = self.errors.get(method_name, 0) + 1
+
+    def report(self, elapsed):
+        """
+        Gives latency percentiles and throughput of every RPC method
+
+        Args:
+            elapsed (float): seconds load test ran
+        Returns:
+            dict[str, dict[str, float]]: method name ('total' for all methods) -> 'calls', 'errors', 'throughput'
+                (calls per second), 'mean' and 'p50', 'p99' (latencies in seconds)
+        """
+
+        with self.condition:
+            latencies = dict((method_name, sorted(values)) for method_name, values in self.latencies.items())
+            errors = dict(self.errors)
+
+        latencies['total'] = sorted(latency for values in latencies.values() for latency in values)
+        errors['total'] = sum(errors.values())
+
+        report = {}
+        for method_name, values in latencies.items():
+            if not values:
+                continue
+            report[method_name] = {'calls': len(values),
+                                   'errors': errors.get(method_name, 0),
+                                   'throughput': len(values) / elapsed,
+                                   'mean': sum(values) / len(values)}
+            for percent in PERCENTILES:
+                report[method_name]['p%d' % percent] = percentile(values, percent)
+
+        return report
+
+
+def percentile(values, percent):
+    """
+    Gives nearest-rank percentile
+
+    Args:
+        values (list[float]): sorted values
+        percent (float): 0-100
+    Returns:
+        float: smallest value that is not less than percent of values
+    """
+
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+class LoadGame(object):
+
+    def __init__(self, session_name, player_count):
+        """
+        Game session played by bots, bots wait here for session to be created and for each other to get ready
+        (owner starts game when all others are ready).
+        """
+        self.session_name = session_name
+        self.player_count = player_count
+        self.created = False
+        self.ready_count = 0  # ready calls of other players than owner in all games of session
+        self.condition = Condition()
+
+    def set_created(self):
+        with self.condition:
+            self.created = True
+            self.condition.notify_all()
+
+    def add_ready(self):
+        with self.condition:
+            self.ready_count += 1
+            self.condition.notify_all()
+
+    def wait(self, predicate, timeout, what):
+        end_time = default_timer() + timeout
+
+        with self.condition:
+            while not predicate():
+                remaining = end_time - default_timer()
+                if remaining <= 0:
+                    raise LoadTestError("Timed out waiting for %s in session %s" % (what, self.session_name))
+                self.condition.wait(remaining)
+
+    def wait_created(self, timeout):
+        self.wait(lambda: self.created, timeout, "creation")
+
+    def wait_ready(self, game_nr, timeout):
+        self.wait(lambda: self.ready_count >= (self.player_count - 1) * (game_nr + 1), timeout, "players")
+
+
+class Bot(Thread):
+
+    def __init__(self, name, game, is_owner, connection, args, stats):
+        """
+        Bot playing games in session, uses its own connection like every client does
+
+        @param name: user name
+        @type name: str
+        @param game: session bot creates or joins
+        @type game: LoadGame
+        @param is_owner: does bot create session (and start games)
+        @type is_owner: bool
+        @param connection: connection given by transport
+        @param stats: where RPC latencies are recorded
+        @type stats: LoadStats
+        """
+        super(Bot, self).__init__(name=name)
+        self.daemon = True
+        self.user_name = name
+        self.game = game
+        self.is_owner = is_owner
+        self.server_name = args.name
+        self.single_queue = args.single_queue
+        self.content_type = get_content_type(args.binary)
+        self.games = args.games
+        self.timeout = args.timeout
+        self.stats = stats
+        self.random = random.Random('%d:%s' % (args.seed, name))
+        self.shard_ring = None
+        self.error = None
+
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.exchange_declare(exchange='topic_server', type='topic')
+
+        self.callback_queue = self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.basic_consume(self.on_response, queue=self.callback_queue, no_ack=True)
+        self.corr_id = None
+        self.response = None
+
+        self.messages = deque()  # messages of game session, oldest first
+        self.map_pieces = []
+        self.shots = set()  # squares shot in current game
+
+    def run(self):
+        try:
+            self.play()
+        except LoadTestError as e:
+            self.error = str(e)
+            print >> sys.stderr, "Bot %s stopped: %s" % (self.user_name, self.error)
+        finally:
+            self.connection.close()
+
+    def play(self):
+        session_name = self.game.session_name
+
+        rsp = self.call('connect', user=self.user_name)
+        if rsp.get('shards', 1) > 1:
+            self.shard_ring = HashRing(rsp['shards'])
+
+        if self.is_owner:
+            rsp = self.call('create_session', user=self.user_name, sname=session_name,
+                            player_count=self.game.player_count)
+            self.game.set_created()
+        else:
+            self.game.wait_created(self.timeout)
+            rsp = self.call('join_session', user=self.user_name, sname=session_name)
+
+        if rsp['err']:
+            raise LoadTestError(rsp['err'])
+        self.map_pieces = rsp['map']
+
+        queue_name = self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='topic_server', queue=queue_name,
+                                routing_key='%s.%s.info' % (self.server_name, session_name))
+        self.channel.basic_consume(self.on_game_message, queue=queue_name, no_ack=True)
+
+        for game_nr in range(self.games):
+            self.play_game(game_nr)
+
+        self.call('leave_session', user=self.user_name, sname=session_name)
+        self.call('disconnect', user=self.user_name)
+
+    def play_game(self, game_nr):
+        session_name = self.game.session_name
+
+        self.call('send_ship_placement', user=self.user_name, sname=session_name,
+                  coords=random_fleet(self.map_pieces, self.random))
+
+        if self.is_owner:
+            self.game.wait_ready(game_nr, self.timeout)
+            self.call('start_game', user=self.user_name, sname=session_name)
+        else:
+            self.call('ready', user=self.user_name, sname=session_name)
+            self.game.add_ready()
+
+        self.shots = set()
+        targets = self.get_targets()
+
+        while True:
+            msg = self.next_message()
+
+            if 'shot' in msg:
+                self.shots.add(tuple(msg['shot']))
+            if msg.get('active') is False:  # game over, session is back in lobby
+                return
+            if msg.get('next') == self.user_name:
+                while targets and targets[-1] in self.shots:
+                    targets.pop()
+                if not targets:
+                    raise LoadTestError("No squares left to shoot")
+                self.call('shoot', user=self.user_name, sname=session_name, coords=list(targets.pop()))
+
+    def get_targets(self):
+        """
+        Gives squares of map pieces of other players in random order
+        """
+
+        pieces = [piece_nr for piece_nr in range(self.game.player_count * PIECES_IN_ROW)
+                  if piece_nr not in self.map_pieces]
+        targets = [(piece_nr // PIECES_IN_ROW * PIECE_STRIDE + row, piece_nr % PIECES_IN_ROW * PIECE_STRIDE + column)
+                   for piece_nr in pieces for row in range(PIECE_SIZE) for column in range(PIECE_SIZE)]
+        self.random.shuffle(targets)
+
+        return targets
+
+    def call(self, method_name, **data):
+        """
+        Call RPC method and wait for response (like RPCClient), latency is recorded
+
+        Returns:
+            dict[str, object]: Response dictionary from the server
+        """
+
+        self.corr_id = uuid.uuid4().hex
+        self.response = None
+
+        shard = self.shard_ring.get_shard(get_request_key(data)) if self.shard_ring is not None else None
+        prefix = rpc_queue_prefix(self.server_name, shard)
+        if self.single_queue:
+            routing_key = '%s_rpc' % prefix
+            headers = {'method': method_name}
+        else:
+            routing_key = '%s_rpc_%s' % (prefix, method_name)
+            headers = None
+
+        start = default_timer()
+        self.channel.basic_publish(exchange='', routing_key=routing_key,
+                                   properties=BasicProperties(reply_to=self.callback_queue,
+                                                              correlation_id=self.corr_id,
+                                                              headers=headers,
+                                                              content_type=self.content_type),
+                                   body=encode_message(data, self.content_type))
+
+        while self.response is None:
+            remaining = start + self.timeout - default_timer()
+            if remaining <= 0:
+                self.stats.record(method_name, default_timer() - start, ok=False)
+                raise LoadTestError("%s timed out" % method_name)
+            self.connection.process_data_events(time_limit=remaining)
+
+        self.stats.record(method_name, default_timer() - start, ok=not self.response.get('err'))
+
+        return self.response
+
+    def next_message(self):
+        end_time = default_timer() + self.timeout
+
+        while not self.messages:
+            remaining = end_time - default_timer()
+            if remaining <= 0:
+                raise LoadTestError("Timed out waiting for turn in session %s" % self.game.session_name)
+            self.connection.process_data_events(time_limit=remaining)
+
+        return self.messages.popleft()
+
+    def on_response(self, ch, method, props, body):
+        if props.correlation_id == self.corr_id:  # responses to timed out calls are ignored
+            self.response = decode_message(body, props.content_type)
+
+    def on_game_message(self, ch, method, props, body):
+        self.messages.append(decode_message(body, props.content_type))
+
+
+def run_load(args):
+    """
+    Runs bots until they have played all their games
+
+    Args:
+        args: command line arguments (name, bots, players, games, seed, timeout, single_queue, binary, transport,
+              host, port)
+    Returns:
+        (dict[str, dict[str, float]], int, float): LoadStats report, number of failed bots and seconds elapsed
+    """
+
+    transport = get_transport(args)
+    stats = LoadStats()
+    run_id = uuid.uuid4().hex[:6]  # names don't collide with earlier runs against the same server
+    bots = []
+
+    for game_nr in range(args.bots // args.players):
+        game = LoadGame('load-%s-%d' % (run_id, game_nr), args.players)
+        for player_nr in range(args.players):
+            bots.append(Bot('bot-%s-%d-%d' % (run_id, game_nr, player_nr), game, player_nr == 0,
+                            transport.connect(), args, stats))
+
+    start = default_timer()
+    for bot in bots:
+        bot.start()
+    for bot in bots:
+        bot.join()
+    elapsed = default_timer() - start
+
+    return stats.report(elapsed), sum(1 for bot in bots if bot.error is not None), elapsed
+
+
+def start_server(args):
+    """
+    Starts server consuming RPC-s on its own thread in this process (player activity is not checked)
+
+    Args:
+        args: command line arguments (name, transport, workers, prefetch, single_queue, binary)
+    Returns:
+        function: stops server
+    """
+
+    channel, connection, worker_pool = init_connection_to_mq(args)
+
+    rpc_requests.restore_sessions(SessionStore(), channel if worker_pool is None else worker_pool.channel)
+    rpc_requests.TURN_SCHEDULER.start()
+
+    thread = Thread(target=channel.start_consuming, name='Server')
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        channel.stop_consuming()
+        thread.join()
+        if worker_pool is not None:
+            worker_pool.exit()
+            for worker in worker_pool.workers:
+                worker.join()
+        rpc_requests.TURN_SCHEDULER.exit()
+        rpc_requests.TURN_SCHEDULER.join()
+        connection.close()
+
+    return stop
+
+
+def print_report(report, failed_bots, elapsed):
+    print "%-22s %8s %7s %10s %10s %10s %10s" % ('method', 'calls', 'errors', 'mean ms', 'p50 ms', 'p99 ms',
+                                                   'calls/s')
+    for method_name in sorted(report, key=lambda name: (name == 'total', name)):
+        result = report[method_name]
+        print "%-22s %8d %7d %10.3f %10.3f %10.3f %10.1f" % (method_name, result['calls'], result['errors'],
+                                                               result['mean'] * 1e3, result['p50'] * 1e3,
+                                                               result['p99'] * 1e3, result['throughput'])
+    print "%.2f seconds, %d bots failed" % (elapsed, failed_bots)
@@ -0,0 +1,159 @@
+# Alternative server main - runs RPC handling, server announcements, player activity checks and turn timeouts
+# in one thread, using IO loop of pika SelectConnection and its timers instead of separate threads
+
+# Import------------------------------------------------------------------------
+import pika
+import time
+import rpc_requests
+from main import get_rpc_queues, open_session_store, start_metrics_server, get_stats
+from common import LOG, get_content_type, init_logging, log_fields, PLAYER_TIMEOUT
+
+ANNOUNCEMENT_INTERVAL = 1  # seconds between publishing server name to <server>.info
+ACTIVITY_CHECK_INTERVAL = 1  # max seconds between checking player activity
+TURN_CHECK_INTERVAL = 1  # maximum seconds between checking turn deadlines
+
+
+def loop_server_main(args):
+    """
+    Call this method to set up and start server running in single IO loop
+    """
+
+    log_handler = init_logging(args.log_level, args.log_sample)
+    server = LoopServer(args)
+
+    try:
+        server.run()
+    except (KeyboardInterrupt, SystemExit):
+        LOG.info("Shutting down...")
+    finally:
+        server.stop()
+        log_handler.close()  # shard processes exit without running exit handlers of logging
+
+
+class LoopServer(object):
+
+    def __init__(self, args):
+        """
+        Server using pika SelectConnection. Every step of connection setup is done in callback of previous step,
+        periodic tasks are scheduled with connection.add_timeout.
+        """
+
+        self.args = args
+        self.server_name = args.name  # server name should be unique
+        rpc_requests.SERVER_NAME = self.server_name  # add server name also to rpc_request variables
+        rpc_requests.TOPIC_CONTENT_TYPE = get_content_type(args.binary)
+        rpc_requests.set_shard(args.shard, args.shards)
+
+        self.connection = None
+        self.channel = None
+        self.metrics_server = None
+
+    def run(self):
+        self.connection = pika.SelectConnection(pika.ConnectionParameters(host=self.args.host, port=self.args.port),
+                                                on_open_callback=self.on_connection_open)
+        self.connection.ioloop.start()
+
+    def stop(self):
+        rpc_requests.STORE.exit()
+        if self.metrics_server is not None:
+            self.metrics_server.exit()
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+            self.connection.ioloop.start()  # run until connection is closed
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+
+        # using exchange topic_server to send information about server and game sessions of server
+        channel.exchange_declare(self.on_exchange_declared, exchange='topic_server', type='topic')
+
+    def on_exchange_declared(self, frame):
+        # Requests are handled one at a time anyway, prefetch lets broker send them without waiting for ack
+        self.channel.basic_qos(prefetch_count=self.args.prefetch)
+
+        # Restore game sessions saved before restart and start saving them
+        rpc_requests.restore_sessions(open_session_store(self.args, self.channel), self.channel)
+
+        # Create queues for RPC and assign consumption method for them
+        for queue_name, handler in get_rpc_queues(self.args):
+            self.channel.queue_declare(None, queue=queue_name)
+            # locks are not contended in one thread, but session store takes them for snapshots
+            self.channel.basic_consume(rpc_requests.with_request_lock(handler), queue=queue_name)
+
+        # Queue for players announcing themselves
+        self.channel.queue_declare(self.on_activity_queue_declared, exclusive=True)
+
+        self.announce_server()
+        self.check_player_activity()
+        self.check_turn_times()
+
+        # Serve metrics over HTTP (from its own thread) and publish them to <server>.stats if asked
+        self.metrics_server = start_metrics_server(self.args)
+        if self.args.stats_interval > 0:
+            self.connection.add_timeout(self.args.stats_interval, self.announce_stats)
+
+        LOG.info("Server is up and running", extra=log_fields(server=self.server_name, shard=self.args.shard + 1,
+                                                              shards=self.args.shards))
+
+    def on_activity_queue_declared(self, frame):
+        queue_name = frame.method.queue
+
+        self.channel.queue_bind(None, queue=queue_name, exchange='topic_server',
+                                routing_key='%s.players.activity' % self.server_name)
+        self.channel.basic_consume(self.on_player_activity, queue=queue_name, no_ack=True)
+
+    def on_player_activity(self, ch, method, props, body):
+        rpc_requests.PLAYER_ACTIVITY.touch(body)
+
+    def announce_server(self):
+        """
+        Publish server's name to *.info queue in order to show that server is active.
+        """
+
+        self.channel.basic_publish(exchange='topic_server', routing_key='%s.info' % self.server_name,
+                                   body=self.server_name)
+        self.connection.add_timeout(ANNOUNCEMENT_INTERVAL, self.announce_server)
+
+    def announce_stats(self):
+        """
+        Publish snapshot of server metrics to <server>.stats
+        """
+
+        rpc_requests.publish_to_topic(self.channel, '%s.stats' % self.server_name, get_stats(self.args))
+        self.connection.add_timeout(self.args.stats_interval, self.announce_stats)
+
+    def check_player_activity(self):
+        """
+        Removes players whose heartbeats have expired, next check is scheduled for the next expiry.
+        """
+
+        expired_players = rpc_requests.PLAYER_ACTIVITY.expire(PLAYER_TIMEOUT)
+        if expired_players:
+            rpc_requests.check_player_activity(expired_players, self.channel)
+
+        next_expiry = rpc_requests.PLAYER_ACTIVITY.next_expiry(PLAYER_TIMEOUT)
+
+        if next_expiry is None:
+            delay = ACTIVITY_CHECK_INTERVAL
+        else:
+            delay = min(max(next_expiry - time.time(), 0), ACTIVITY_CHECK_INTERVAL)
+
+        self.connection.add_timeout(delay, self.check_player_activity)
+
+    def check_turn_times(self):
+        """
+        Times out player turns using rpc_requests.TURN_SCHEDULER (its thread is not started),
+        next check is scheduled for the earliest turn deadline.
+        """
+
+        next_deadline = rpc_requests.TURN_SCHEDULER.run_pending()
+
+        if next_deadline is None:
+            delay = TURN_CHECK_INTERVAL
+        else:  # turns started later have later deadlines, so waking up for the earliest one is enough
+            delay = min(max(next_deadline - time.time(), 0), TURN_CHECK_INTERVAL)
+
+        self.connection.add_timeout(delay, self.check_turn_times)
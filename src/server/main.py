@@ -1,11 +1,19 @@
 # Main client - set up connection and MQ-s and start sending information about server activity to "topic_server"
 
 # Import------------------------------------------------------------------------
-import pika
+import os
 import time
-from threading import Thread, Timer
+from copy import copy
+from multiprocessing import Process
+from threading import Thread, Event
 import rpc_requests
-from common import BaseListener
+from workers import RPCWorkerPool
+from persistence import REPLICATION_EXCHANGE, SessionStore, FileSessionStore, ReplicatingSessionStore, \
+    replication_key
+from standby import StandbyServer, FAILOVER_TIMEOUT
+from metrics import METRICS, MetricsServer
+from common import BaseListener, LOG, get_content_type, get_transport, init_logging, log_fields, rpc_queue_prefix, \
+    CHANNEL_CLOSED_ERRORS, PLAYER_TIMEOUT, LISTENER_WAIT_TIME
 
 
 # Info-------------------------------------------------------------------------
@@ -28,75 +36,255 @@ def server_main(args):
 
     player_listener = None
     server_announcements_thread = None
+    stats_announcements_thread = None
+    metrics_server = None
     connection = None
+    worker_pool = None
+    log_handler = init_logging(args.log_level, args.log_sample)
 
     # Initialize connection with mq
     try:
-        channel, connection = init_connection_to_mq(args)
+        replicated_sessions, channel, connection, worker_pool = take_over_rpc_queues(args)
+
+        if worker_pool is not None:
+            channel = worker_pool.channel  # other threads must publish through connection thread
 
         # Start announcing server name to topic_server (so client could check whether server is online)
         server_announcements_thread = ServerAnnouncements(args.name, channel)
         server_announcements_thread.start()
 
+        # Serve metrics over HTTP and publish them to <server>.stats if asked
+        metrics_server = start_metrics_server(args)
+        if args.stats_interval > 0:
+            stats_announcements_thread = StatsAnnouncements(args, channel)
+            stats_announcements_thread.start()
+
         player_listener = PlayerListener(args, channel, rpc_requests.check_player_activity)
 
-        print "Server %s is up and running" % args.name
+        # Restore game sessions saved before restart and start saving them
+        rpc_requests.restore_sessions(open_session_store(args, channel), channel, replicated_sessions)
+
+        # Start timing out player turns of all game sessions
+        rpc_requests.TURN_SCHEDULER.start()
+
+        LOG.info("Server is up and running", extra=log_fields(server=args.name, shard=args.shard + 1,
+                                                              shards=args.shards))
 
         # Start consuming client RPC-s
         channel.start_consuming()
     except (KeyboardInterrupt, SystemExit):
         # On Windows we don't make it to here :(
-        print('Shutting down...')
+        LOG.info("Shutting down...")
     finally:
         if server_announcements_thread is not None:
             server_announcements_thread.exit()
+        if stats_announcements_thread is not None:
+            stats_announcements_thread.exit()
+        if metrics_server is not None:
+            metrics_server.exit()
         if player_listener is not None:
             player_listener.exit()
+        if worker_pool is not None:
+            worker_pool.exit()
+        rpc_requests.TURN_SCHEDULER.exit()
+        rpc_requests.STORE.exit()
         if connection is not None:
             connection.close()
+        log_handler.close()  # shard processes exit without running exit handlers of logging
+
+
+def run_shards(args, main):
+    """
+    Run every shard of server in its own process and wait until they finish
+
+    Args:
+        args: command line arguments, shard is set for each process
+        main (function): server main function (server_main or loop_server_main)
+    """
+
+    processes = []
+
+    for shard in range(args.shards):
+        shard_args = copy(args)
+        shard_args.shard = shard
+        process = Process(target=main, args=(shard_args,), name='%s.shard%d' % (args.name, shard))
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        # shards get interrupt too and shut down themselves
+        for process in processes:
+            process.join()
+
+
+def start_metrics_server(args):
+    """
+    Starts HTTP server giving metrics at http://127.0.0.1:<port>/metrics, every shard uses next port after
+    previous shard
+
+    Args:
+        args: command line arguments (metrics_port, shard)
+    Returns:
+        MetricsServer: started server, None if metrics port is not given
+    """
+
+    if args.metrics_port is None:
+        return None
+
+    metrics_server = MetricsServer(METRICS, args.metrics_port + args.shard)
+    LOG.info("Serving metrics", extra=log_fields(shard=args.shard,
+                                                 url='http://127.0.0.1:%d/metrics' % metrics_server.port))
+    return metrics_server
+
+
+def get_stats(args):
+    """
+    Gives message published to <server>.stats
+
+    Returns:
+        dict[str, object]: server name, shard index and snapshot of metrics
+    """
+    return {'server': args.name, 'shard': args.shard, 'time': time.time(), 'metrics': METRICS.snapshot()}
+
+
+def open_session_store(args, channel):
+    """
+    Gives store for persisting game sessions
+
+    Args:
+        args: command line arguments (data_dir, shards, shard, replicate, standby, replication_secret)
+        channel: channel for publishing replication records
+    Returns:
+        SessionStore: store writing to data directory (every shard has its own), store keeping nothing if
+                      data directory is not given. Records are also published for standby server if asked.
+    """
+
+    if args.data_dir is None:
+        store = SessionStore()
+    elif args.shards > 1:
+        store = FileSessionStore(os.path.join(args.data_dir, 'shard%d' % args.shard))
+    else:
+        store = FileSessionStore(args.data_dir)
+
+    if args.replicate or args.standby:  # standby that took over replicates to next standby
+        store = ReplicatingSessionStore(store, channel, args.name, args.replication_secret)
+
+    return store
+
+
+def take_over_rpc_queues(args):
+    """
+    Connect to MQ once server gets RPC queues for itself. Server with replication consumes them as exclusive consumer
+    (see standby.py), standby replicates sessions until primary is gone and retries when primary still has the queues.
+
+    Returns:
+        tuple: replicated sessions of standby (or None), channel, connection, worker pool
+    """
+
+    rpc_queue_names = [queue_name for queue_name, handler in get_rpc_queues(args)]
+    while True:
+        replicated_sessions = None
+        if args.standby:  # RPC queues are not consumed before primary server is gone
+            replicated_sessions = StandbyServer(args, rpc_queue_names).wait_for_takeover()
+
+        try:
+            channel, connection, worker_pool = init_connection_to_mq(args)
+            return replicated_sessions, channel, connection, worker_pool
+        except CHANNEL_CLOSED_ERRORS as e:
+            LOG.warning("RPC queues are consumed by other server", extra=log_fields(server=args.name, err=str(e)))
+            if not args.standby:
+                time.sleep(FAILOVER_TIMEOUT)
 
 
 def init_connection_to_mq(args):
     """
-    Create new connection with MQ and declare queues for RPC and topic exchange
+    Create new connection with MQ (RabbitMQ or memory transport) and declare queues for RPC and topic exchange
     """
 
     server_name = args.name  # server name should be unique
     rpc_requests.SERVER_NAME = server_name  # add server name also to rpc_request variables
+    rpc_requests.TOPIC_CONTENT_TYPE = get_content_type(args.binary)
+    rpc_requests.set_shard(args.shard, args.shards)
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        host=args.host, port=args.port))
+    connection = get_transport(args).connect()
 
     channel = connection.channel()
 
-    # Create queues for RPC
-    channel.queue_declare(queue='%s_rpc_connect' % server_name)
-    channel.queue_declare(queue='%s_rpc_disconnect' % server_name)
-    channel.queue_declare(queue='%s_rpc_create_session' % server_name)
-    channel.queue_declare(queue='%s_rpc_join_session' % server_name)
-    channel.queue_declare(queue='%s_rpc_leave_session' % server_name)
-    channel.queue_declare(queue='%s_rpc_ready' % server_name)
-    channel.queue_declare(queue='%s_rpc_send_ship_placement' % server_name)
-    channel.queue_declare(queue='%s_rpc_start_game' % server_name)
-    channel.queue_declare(queue='%s_rpc_shoot' % server_name)
-
-    channel.basic_qos(prefetch_count=1)
-
-    # Assign consumption method for rcp queues
-    channel.basic_consume(rpc_requests.on_request_connect, queue='%s_rpc_connect' % server_name)
-    channel.basic_consume(rpc_requests.on_request_disconnect, queue='%s_rpc_disconnect' % server_name)
-    channel.basic_consume(rpc_requests.on_request_create_session, queue='%s_rpc_create_session' % server_name)
-    channel.basic_consume(rpc_requests.on_request_join_session, queue='%s_rpc_join_session' % server_name)
-    channel.basic_consume(rpc_requests.on_request_leave_session, queue='%s_rpc_leave_session' % server_name)
-    channel.basic_consume(rpc_requests.on_request_ready, queue='%s_rpc_ready' % server_name)
-    channel.basic_consume(rpc_requests.on_request_send_ship_placement, queue='%s_rpc_send_ship_placement' % server_name)
-    channel.basic_consume(rpc_requests.on_request_start_game, queue='%s_rpc_start_game' % server_name)
-    channel.basic_consume(rpc_requests.on_request_shoot, queue='%s_rpc_shoot' % server_name)
+    # how many requests can be delivered before acknowledging, every worker should have something to do
+    channel.basic_qos(prefetch_count=max(args.prefetch, args.workers))
+
+    if args.workers > 0:
+        # run handlers on worker threads instead of connection thread
+        worker_pool = RPCWorkerPool(connection, channel, args.workers)
+        wrap = lambda handler: worker_pool.wrap(rpc_requests.with_request_lock(handler))
+    else:
+        worker_pool = None
+        wrap = rpc_requests.with_request_lock  # player activity checks are run on other thread
+
+    # Create queues for RPC and assign consumption method for them, with replication only one server may consume them
+    try:
+        for queue_name, handler in get_rpc_queues(args):
+            channel.queue_declare(queue=queue_name)
+            channel.basic_consume(wrap(handler), queue=queue_name, exclusive=args.replicate or args.standby)
+    except CHANNEL_CLOSED_ERRORS:
+        if worker_pool is not None:
+            worker_pool.exit()
+        connection.close()
+        raise
 
     # using exchange topic_server to send information about server and game sessions of server
     channel.exchange_declare(exchange='topic_server', type='topic')
 
-    return channel, connection
+    if args.replicate or args.standby:
+        # standby servers ask for all sessions when they start
+        channel.exchange_declare(exchange=REPLICATION_EXCHANGE, type='topic')
+        sync_queue = channel.queue_declare(exclusive=True).method.queue
+        channel.queue_bind(exchange=REPLICATION_EXCHANGE, queue=sync_queue,
+                           routing_key='%s.sync' % replication_key(args.name))
+        sync_handler = rpc_requests.on_replication_sync  # takes session locks itself
+        if worker_pool is not None:
+            sync_handler = worker_pool.wrap(sync_handler)
+        channel.basic_consume(sync_handler, queue=sync_queue, no_ack=True)
+
+    return channel, connection, worker_pool
+
+
+def get_rpc_queues(args):
+    """
+    Gives back RPC queue names of server and handlers consuming them
+
+    Args:
+        args: command line arguments (name, single_queue, shards, shard)
+    Returns:
+        list[(str, function)]: queue names and RPC request handlers
+    """
+
+    if args.single_queue:
+        # One queue for all RPC-s, method is given in message header
+        handlers = [('_rpc', None, rpc_requests.dispatch_request)]
+    else:
+        # Queue for each RPC method
+        handlers = [('_rpc_%s' % method_name, method_name, handler)
+                    for method_name, handler in sorted(rpc_requests.RPC_HANDLERS.items())]
+
+    if args.shards > 1:
+        # Shard consumes queues shared by all shards (used by clients before they know about shards) and its own
+        # queues, requests owned by other shards are forwarded to their own queues
+        prefixes = [rpc_queue_prefix(args.name), rpc_queue_prefix(args.name, args.shard)]
+
+        def route(handler, suffix):
+            return rpc_requests.with_shard_routing(handler, lambda shard: rpc_queue_prefix(args.name, shard) + suffix)
+    else:
+        prefixes = [rpc_queue_prefix(args.name)]
+        route = lambda handler, suffix: handler
+
+    return [(prefix + suffix,
+             rpc_requests.with_content_check(route(rpc_requests.with_player_activity(
+                 rpc_requests.with_persistence(handler, method_name)), suffix)))
+            for prefix in prefixes for suffix, method_name, handler in handlers]
 
 
 class ServerAnnouncements(Thread):
@@ -126,31 +314,63 @@ class ServerAnnouncements(Thread):
         self._is_running = False
 
 
+class StatsAnnouncements(Thread):
+    """
+    Thread publishing snapshot of server metrics to <server>.stats periodically
+    """
+    def __init__(self, args, channel):
+        """
+        @param args: command line arguments (name, shard, stats_interval)
+        @param channel:
+        @type channel: BlockingConnection.channel
+        """
+        super(StatsAnnouncements, self).__init__(name='StatsAnnouncements')
+        self.daemon = True
+        self.args = args
+        self.channel = channel
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.args.stats_interval):
+            rpc_requests.publish_to_topic(self.channel, '%s.stats' % self.args.name, get_stats(self.args))
+
+    def exit(self):
+        self.stopped.set()
+
+
 class PlayerListener(BaseListener):
 
     def __init__(self, args, channel, callback):
         """
-        Listen for players announcing themselves.
-        Calls callback with list of active player names.
+        Listen for players of this server announcing themselves (<server>.players.activity).
+        Calls callback with list of player names that have timed out.
         """
-        super(PlayerListener, self).__init__('players.activity', args, callback, name='PlayerListener')
+        self.channel = channel  # thread is started by BaseListener, so it is set before
 
-        # And now the thread logic
-        self.players = {}
-        self.channel = channel
-        self.update_players_activity()
+        super(PlayerListener, self).__init__('%s.players.activity' % args.name, args, callback,
+                                             name='PlayerListener')
+
+    def run(self):
+        # expired players are checked by listener thread between waiting for heartbeats, no timer threads needed
+        try:
+            while self._is_running:
+                self.update_players_activity()
+
+                next_expiry = rpc_requests.PLAYER_ACTIVITY.next_expiry(PLAYER_TIMEOUT)
+                if next_expiry is None:
+                    wait_time = LISTENER_WAIT_TIME
+                else:  # wake up when the player seen longest ago expires
+                    wait_time = min(max(next_expiry - time.time(), 0), LISTENER_WAIT_TIME)
+
+                self.connection.process_data_events(time_limit=wait_time)
+        finally:
+            self.connection.close()
 
     def callback(self, ch, method, props, body):
-        self.players[body] = time.time()
+        rpc_requests.PLAYER_ACTIVITY.touch(body)
 
     def update_players_activity(self):
-        current_time = time.time()
-        active_players = []
-        for player_name, last_seen in self.players.items():
-            if last_seen > (current_time - 5):
-                active_players.append(player_name)
-
-        self.external_callback(active_players, self.channel)
+        expired_players = rpc_requests.PLAYER_ACTIVITY.expire(PLAYER_TIMEOUT)
 
-        if self._is_running:
-            Timer(1, self.update_players_activity).start()
+        if expired_players:
+            self.external_callback(expired_players, self.channel)
@@ -0,0 +1,347 @@
+# Server metrics - counters, gauges and latency histograms of hot paths, exposed in Prometheus text format on local
+# HTTP endpoint and as snapshot published to <server>.stats topic
+
+# Import
+from bisect import bisect_left
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from threading import Thread, Lock
+from timeit import default_timer
+
+# upper bounds of histogram buckets in seconds, last bucket (+Inf) is implicit
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Counter(object):
+    """
+    Value that only goes up (requests, errors)
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down (requests in flight, scheduled turns)
+    """
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class FunctionGauge(object):
+    """
+    Gauge whose value is read from function when metrics are collected (size of registries etc.)
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self.function()
+
+    def snapshot(self):
+        return self.function()
+
+
+class Histogram(object):
+    """
+    Counts of observed values (latencies in seconds) in buckets, with sum and count of all values
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Gives context manager observing time spent in it
+        """
+        return Timer(self)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            yield name + '_bucket', labels + (('le', format_value(bound)),), cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, count
+
+    def quantile(self, q):
+        """
+        Estimates quantile of observed values by upper bound of bucket it falls into
+
+        Args:
+            q (float): 0-1
+        Returns:
+            float: upper bound of bucket (inf if quantile is in last bucket), None if nothing was observed
+        """
+
+        with self.lock:
+            counts, count = list(self.counts), self.count
+
+        if count == 0:
+            return None
+
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return bound
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(default_timer() - self.start)
+
+
+class MetricFamily(object):
+
+    def __init__(self, name, help_text, metric_type, label_names, factory):
+        """
+        Metrics with the same name and different label values
+
+        @param name: metric name
+        @type name: str
+        @param help_text: description of metric
+        @type help_text: str
+        @param metric_type: counter, gauge or histogram
+        @type metric_type: str
+        @param label_names: names of labels
+        @type label_names: tuple[str]
+        @param factory: creates metric for new label values
+        @type factory: function
+        """
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self.factory = factory
+        self.children = OrderedDict()  # label values -> metric
+        self.lock = Lock()
+
+    def labels(self, *label_values):
+        """
+        Gives metric with given label values (created on first use), callers should keep it for hot paths
+        """
+
+        with self.lock:
+            metric = self.children.get(label_values)
+            if metric is None:
+                metric = self.children[label_values] = self.factory()
+            return metric
+
+    def samples(self):
+        with self.lock:
+            children = self.children.items()
+
+        for label_values, metric in children:
+            for sample in metric.samples(self.name, tuple(zip(self.label_names, label_values))):
+                yield sample
+
+    def snapshot(self):
+        with self.lock:
+            children = self.children.items()
+
+        if not self.label_names:
+            return children[0][1].snapshot() if children else None
+
+        return dict((','.join(label_values), metric.snapshot()) for label_values, metric in children)
+
+
+class MetricsRegistry(object):
+    """
+    All metrics of the server process
+    """
+    def __init__(self):
+        self.families = OrderedDict()  # metric name -> MetricFamily
+        """@type: dict[str, MetricFamily]"""
+        self.lock = Lock()
+
+    def register(self, name, help_text, metric_type, label_names, factory):
+        """
+        Registers metric family, gives the only metric of family if it has no labels
+        """
+
+        family = MetricFamily(name, help_text, metric_type, tuple(label_names), factory)
+        with self.lock:
+            self.families[name] = family
+
+        return family if label_names else family.labels()
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(name, help_text, 'counter', label_names, Counter)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.register(name, help_text, 'gauge', label_names, Gauge)
+
+    def gauge_function(self, name, help_text, function):
+        return self.register(name, help_text, 'gauge', (), lambda: FunctionGauge(function))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(name, help_text, 'histogram', label_names, lambda: Histogram(buckets))
+
+    def render(self):
+        """
+        Gives all metrics in Prometheus text exposition format
+
+        Returns:
+            str: metrics text
+        """
+
+        with self.lock:
+            families = self.families.values()
+
+        lines = []
+        for family in families:
+            lines.append('# HELP %s %s' % (family.name, family.help_text))
+            lines.append('# TYPE %s %s' % (family.name, family.metric_type))
+            for name, labels, value in family.samples():
+                if labels:
+                    name += '{%s}' % ','.join('%s="%s"' % (label, escape_label(label_value))
+                                              for label, label_value in labels)
+                lines.append('%s %s' % (name, format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Gives current values of all metrics, histograms as count, sum and estimated p50 and p99
+
+        Returns:
+            dict[str, object]: metric name -> value (or label values joined with commas -> value)
+        """
+
+        with self.lock:
+            families = self.families.values()
+
+        return dict((family.name, family.snapshot()) for family in families)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def timed(function, duration, in_flight=None, errors=None):
+    """
+    Wraps function to observe its latency, count calls in progress and calls that raised exception
+
+    Args:
+        function (function): function to wrap (e.g. RPC request handler)
+        duration (Histogram): latency histogram
+        in_flight (Gauge): calls in progress
+        errors (Counter): calls that raised exception
+    Returns:
+        function: wrapped function
+    """
+
+    def timed_function(*args, **kwargs):
+        if in_flight is not None:
+            in_flight.inc()
+        start = default_timer()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            if errors is not None:
+                errors.inc()
+            raise
+        finally:
+            duration.observe(default_timer() - start)
+            if in_flight is not None:
+                in_flight.dec()
+
+    return timed_function
+
+
+class MetricsServer(Thread):
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        """
+        HTTP server giving metrics of registry at /metrics (Prometheus text format), only local connections
+        are accepted unless other host is given.
+
+        @param registry: metrics to serve
+        @type registry: MetricsRegistry
+        @param port: port to listen on
+        @type port: int
+        """
+        super(MetricsServer, self).__init__(name='MetricsServer')
+        self.daemon = True
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes are not logged
+
+        self.httpd = HTTPServer((host, port), MetricsHandler)
+        self.port = self.httpd.server_address[1]  # port chosen by system if 0 was given
+        self.start()
+
+    def run(self):
+        self.httpd.serve_forever(poll_interval=0.5)
+
+    def exit(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+METRICS = MetricsRegistry()  # metrics of this server process
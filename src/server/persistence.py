@@ -0,0 +1,446 @@
+# Persists game sessions, so server can be restarted without losing games. Changes of sessions are appended to
+# write-ahead log (WAL) and sessions are snapshotted periodically, after which older part of log is dropped.
+
+# Import
+import cPickle as pickle
+import hashlib
+import hmac
+import os
+import struct
+from threading import Thread, Event, Lock
+from gamesession import GameSession
+from common import CONTENT_TYPE_JSON, BasicProperties, encode_message, decode_message
+
+SYNC_INTERVAL = 0.1  # seconds between flushing and fsyncing log (records logged meanwhile are synced together)
+SNAPSHOT_INTERVAL = 60  # seconds between snapshots of all sessions
+RECORD_HEADER = struct.Struct('<I')  # length of pickled record
+# Replication records are published to their own exchange, broker permissions should let only servers write to it.
+# Records are plain data signed with secret shared by servers, standby never unpickles what it gets from broker.
+REPLICATION_EXCHANGE = 'replication'
+REPLICATION_CONTENT_TYPE = CONTENT_TYPE_JSON
+
+
+class SessionStore(object):
+    """
+    Session store that does not persist anything (sessions are kept only in memory).
+    Base class of persistent stores, methods are called by rpc_requests holding lock of the session.
+    """
+
+    def log_session(self, sess):
+        """
+        Log whole state of session (after less frequent changes: creation, joining, ship placement etc.)
+
+        Args:
+            sess (GameSession): Instance of GameSession
+        """
+        pass
+
+    def log_shot(self, sess, coords):
+        """
+        Log shot taken in session (replayed with replay_shot)
+
+        Args:
+            sess (GameSession): Instance of GameSession
+            coords ([int,int]): coordinates of shot
+        """
+        pass
+
+    def log_turn(self, sess):
+        """
+        Log change of player whose turn it is (turn time out)
+
+        Args:
+            sess (GameSession): Instance of GameSession
+        """
+        pass
+
+    def log_delete(self, session_name):
+        """
+        Log deleting of session
+
+        Args:
+            session_name (str): Name of game session
+        """
+        pass
+
+    def restore(self):
+        """
+        Gives back sessions stored before restart
+
+        Returns:
+            dict[str, GameSession]: session name -> session
+        """
+        return {}
+
+    def start(self, get_sessions):
+        """
+        Start syncing log and taking snapshots in background
+
+        Args:
+            get_sessions (function): gives list of (session, session lock) pairs for snapshots
+        """
+        pass
+
+    def exit(self):
+        pass
+
+
+class FileSessionStore(SessionStore, Thread):
+    """
+    Session store keeping log and snapshot in directory. Log records are written to file buffer by request handling
+    threads and flushed and fsynced in background thread, so shot handling never waits for disk.
+    """
+
+    def __init__(self, directory, sync_interval=SYNC_INTERVAL, snapshot_interval=SNAPSHOT_INTERVAL):
+        """
+        @param directory: directory for log and snapshot files (created if missing)
+        @type directory: str
+        """
+        super(FileSessionStore, self).__init__(name='FileSessionStore')
+        self.daemon = True
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.log_path = os.path.join(directory, 'sessions.wal')
+        self.old_log_path = os.path.join(directory, 'sessions.wal.old')  # log being snapshotted
+        self.snapshot_path = os.path.join(directory, 'sessions.snapshot')
+
+        self.sync_interval = sync_interval
+        self.snapshot_interval = snapshot_interval
+
+        self.lock = Lock()  # for log file and sequence numbers
+        self.seq = 0  # sequence number of last log record
+        self.session_seqs = {}  # session name -> sequence number of last log record of session
+        self.log_file = None
+        self.unsynced = False
+        self.records_since_snapshot = 0
+
+        self.get_sessions = None
+        self.stopped = Event()
+
+    def log_session(self, sess):
+        self.append(sess.session_name, 'session', sess)
+
+    def log_shot(self, sess, coords):
+        self.append(sess.session_name, 'shot', tuple(coords))
+
+    def log_turn(self, sess):
+        self.append(sess.session_name, 'turn', sess.next_shot_by)
+
+    def log_delete(self, session_name):
+        if session_name in self.session_seqs:  # nothing to delete if session was never logged
+            self.append(session_name, 'delete', None)
+            with self.lock:
+                del self.session_seqs[session_name]
+
+    def append(self, session_name, kind, data):
+        """
+        Write log record (session sequence number, session name, kind, data) to log file buffer
+        """
+
+        with self.lock:
+            self.seq += 1
+            self.session_seqs[session_name] = self.seq
+            record = pickle.dumps((self.seq, session_name, kind, data), pickle.HIGHEST_PROTOCOL)
+            self.log_file.write(RECORD_HEADER.pack(len(record)) + record)
+            self.unsynced = True
+            self.records_since_snapshot += 1
+
+    def restore(self):
+        """
+        Load latest snapshot and replay log records written after it
+        """
+
+        sessions = {}
+        session_seqs = {}
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                for session_seq, pickled_session in pickle.load(snapshot_file):
+                    sess = pickle.loads(pickled_session)
+                    sessions[sess.session_name] = sess
+                    session_seqs[sess.session_name] = session_seq
+                    self.seq = max(self.seq, session_seq)
+
+        # old log exists if server stopped while taking snapshot
+        for log_path in (self.old_log_path, self.log_path):
+            for seq, session_name, kind, data in read_log(log_path):
+                self.seq = max(self.seq, seq)
+                if seq <= session_seqs.get(session_name, 0):
+                    continue  # already in snapshot
+                session_seqs[session_name] = seq
+                apply_record(sessions, session_name, kind, data)
+
+        self.session_seqs = dict((session_name, session_seqs[session_name]) for session_name in sessions)
+
+        # everything restored goes to new snapshot, so logs are not needed anymore
+        self.write_snapshot([(session_seqs[session_name], pickle.dumps(sess, pickle.HIGHEST_PROTOCOL))
+                             for session_name, sess in sessions.items()])
+        for log_path in (self.old_log_path, self.log_path):
+            if os.path.exists(log_path):
+                os.remove(log_path)
+
+        return sessions
+
+    def start(self, get_sessions):
+        self.get_sessions = get_sessions
+        self.log_file = open(self.log_path, 'ab')
+        Thread.start(self)  # SessionStore.start is first in MRO
+
+    def run(self):
+        waited = 0
+
+        while not self.stopped.wait(self.sync_interval):
+            self.sync()
+
+            waited += self.sync_interval
+            if waited >= self.snapshot_interval and self.records_since_snapshot:
+                self.snapshot()
+                waited = 0
+
+    def sync(self):
+        """
+        Flush and fsync records logged since last sync
+        """
+
+        with self.lock:
+            if not self.unsynced:
+                return
+            self.log_file.flush()
+            self.unsynced = False
+            fileno = self.log_file.fileno()
+
+        os.fsync(fileno)  # handlers can keep appending to buffer meanwhile
+
+    def snapshot(self):
+        """
+        Write all sessions to snapshot file. Log is rotated first, so records written during snapshot stay in
+        new log (records in snapshot are skipped on restore by their sequence numbers).
+        """
+
+        with self.lock:
+            self.log_file.close()
+            os.rename(self.log_path, self.old_log_path)
+            self.log_file = open(self.log_path, 'ab')
+            self.unsynced = False
+            self.records_since_snapshot = 0
+
+        snapshot = []
+        for sess, session_lock in self.get_sessions():
+            with session_lock:  # session is not changed while pickling, its sequence number matches state
+                with self.lock:
+                    session_seq = self.session_seqs.get(sess.session_name, 0)
+                snapshot.append((session_seq, pickle.dumps(sess, pickle.HIGHEST_PROTOCOL)))
+
+        self.write_snapshot(snapshot)
+        os.remove(self.old_log_path)
+
+    def write_snapshot(self, snapshot):
+        """
+        Replace snapshot file
+
+        Args:
+            snapshot (list[(int, str)]): sequence number of last log record and pickled session for every session
+        """
+
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temp_path, self.snapshot_path)  # replaces old snapshot atomically
+
+    def exit(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+            self.sync()
+            self.log_file.close()
+
+
+class ReplicatingSessionStore(SessionStore):
+    """
+    Session store publishing every log record to <server>.replication for standby server (see standby.py),
+    records are also given to another store (e.g. FileSessionStore).
+    """
+
+    def __init__(self, store, channel, server_name, secret):
+        """
+        @param store: store that is also given every record
+        @type store: SessionStore
+        @param channel: channel used to publish records to RabbitMQ
+        @type channel: BlockingConnection.channel
+        @param server_name: name of the server
+        @type server_name: str
+        @param secret: secret shared with standby server for signing records
+        @type secret: str
+        """
+        self.store = store
+        self.channel = channel
+        self.routing_key = replication_key(server_name)
+        self.secret = secret
+        self.lock = Lock()  # records must be published in the same order they are logged
+
+    def log_session(self, sess):
+        self.store.log_session(sess)
+        self.publish(sess.session_name, 'session', sess)
+
+    def log_shot(self, sess, coords):
+        self.store.log_shot(sess, coords)
+        self.publish(sess.session_name, 'shot', tuple(coords))
+
+    def log_turn(self, sess):
+        self.store.log_turn(sess)
+        self.publish(sess.session_name, 'turn', sess.next_shot_by)
+
+    def log_delete(self, session_name):
+        self.store.log_delete(session_name)
+        self.publish(session_name, 'delete', None)
+
+    def publish(self, session_name, kind, data):
+        with self.lock:
+            body, properties = encode_record(session_name, kind, data, self.secret)
+            self.channel.basic_publish(exchange=REPLICATION_EXCHANGE, routing_key=self.routing_key,
+                                       properties=properties, body=body)
+
+    def restore(self):
+        return self.store.restore()
+
+    def start(self, get_sessions):
+        self.store.start(get_sessions)
+
+    def exit(self):
+        self.store.exit()
+
+
+def replication_key(server_name):
+    """
+    Gives routing key of replication records of server, standby asks for all sessions with <key>.sync
+    """
+    return '%s.replication' % server_name
+
+
+def encode_record(session_name, kind, data, secret):
+    """
+    Encodes replication record as plain data (sessions with GameSession.to_dict) signed with shared secret
+
+    Args:
+        session_name (str): Name of game session
+        kind (str): 'session', 'shot', 'turn' or 'delete'
+        data (object): GameSession, shot coordinates or name of next player
+        secret (str): secret shared by servers
+    Returns:
+        (str, BasicProperties): message body and properties containing signature of body
+    """
+
+    if kind == 'session':
+        data = data.to_dict()
+
+    body = encode_message([session_name, kind, data], REPLICATION_CONTENT_TYPE)
+    return body, BasicProperties(content_type=REPLICATION_CONTENT_TYPE,
+                                 headers={'signature': sign_record(body, secret)})
+
+
+def decode_record(props, body, secret):
+    """
+    Checks signature of replication record and decodes it (see encode_record)
+
+    Args:
+        props (header_frame): used to get content type and signature of record
+        body (str): encoded record
+        secret (str): secret shared by servers
+    Returns:
+        (str, str, object): session name, kind and data of record (GameSession for 'session' records)
+    Raises:
+        ValueError: if record is not signed with shared secret or is invalid
+    """
+
+    signature = (props.headers or {}).get('signature')
+    try:
+        valid = hmac.compare_digest(str(signature), sign_record(body, secret))
+    except UnicodeError:
+        valid = False
+    if not valid:
+        raise ValueError('Invalid signature')
+
+    try:
+        session_name, kind, data = decode_message(body, props.content_type)
+        if kind == 'session':
+            data = GameSession.from_dict(data)
+    except (KeyError, TypeError) as e:
+        raise ValueError('Invalid record: %s' % e)
+
+    return session_name, kind, data
+
+
+def sign_record(body, secret):
+    """
+    Gives signature of replication record (HMAC-SHA256 with secret shared by servers)
+    """
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def read_log(log_path):
+    """
+    Reads log records, stops at incomplete record (server stopped while writing it)
+
+    Args:
+        log_path (str): path of log file
+    Returns:
+        generator: (sequence number, session name, kind, data) records
+    """
+
+    if not os.path.exists(log_path):
+        return
+
+    with open(log_path, 'rb') as log_file:
+        while True:
+            header = log_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            record = log_file.read(RECORD_HEADER.unpack(header)[0])
+            try:
+                yield pickle.loads(record)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                return
+
+
+def apply_record(sessions, session_name, kind, data):
+    """
+    Apply log record to restored sessions
+
+    Args:
+        sessions (dict[str, GameSession]): restored sessions
+        session_name (str): Name of game session
+        kind (str): 'session', 'shot', 'turn' or 'delete'
+        data (object): GameSession, shot coordinates or name of next player
+    """
+
+    if kind == 'session':
+        sessions[session_name] = data
+    elif kind == 'delete':
+        sessions.pop(session_name, None)
+    elif session_name in sessions:
+        if kind == 'shot':
+            replay_shot(sessions[session_name], data)
+        elif kind == 'turn':
+            sessions[session_name].next_shot_by = data
+
+
+def replay_shot(sess, coords):
+    """
+    Make same changes to session as taking shot in rpc_requests.on_request_shoot
+
+    Args:
+        sess (GameSession): Instance of GameSession
+        coords ([int,int]): coordinates of shot
+    """
+
+    if sess.check_shot(coords) == 2:  # sunk
+        player_lost = sess.check_end_game()
+        if player_lost is not None and len(sess.players_alive) == 1:
+            sess.reset_session()
+
+    if sess.in_game:
+        sess.get_next_player()
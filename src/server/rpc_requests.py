@@ -3,26 +3,66 @@
 
 # Import
 
-import json
-import pika
 from gamesession import *
-from threading import Thread, Lock
-from time import time, sleep
+from activity import LastSeenIndex
+from persistence import SessionStore
+from metrics import METRICS, timed
+from common import CONTENT_TYPE_JSON, SUPPORTED_CONTENT_TYPES, BasicProperties, LOG, encode_message, decode_message, \
+    HashRing, get_request_key, log_fields
+from bisect import bisect_right
+from heapq import heappush, heappop
+from threading import Thread, RLock, Condition
+from time import time
 
 # Variables
 
-connected_users = []
+connected_users = set()
 SESSIONS = {}
 """@type: dict[str, GameSession]"""
+USER_SESSIONS = {}  # user name -> name of session user last joined (reverse index of SESSIONS players)
+"""@type: dict[str, str]"""
 SERVER_NAME = "unnamed"
-TIMER_THREADS = {}
-"""@type: dict[str, CheckTurnTime]"""
-TIMER_LOCK = Lock()
+TOPIC_CONTENT_TYPE = CONTENT_TYPE_JSON  # format of topic messages, RPC responses use format of request
+TURN_TIME = 10  # seconds player has for taking a shot
+REGISTRY_LOCK = RLock()  # lock for SESSIONS, connected_users and USER_SESSIONS (taken after session lock)
+SESSION_LOCKS = {}  # session name -> RLock of existing session, requests of one session are handled one at a time
+"""@type: dict[str, RLock]"""
+SESSION_LIST = {}  # session name -> session info last published to <server>.sessions.info
+"""@type: dict[str, dict[str, object]]"""
+SESSION_LIST_SEQ = 0  # sequence number of last session list change, clients use it to detect missed changes
+SESSION_PAGE_SIZE = 100  # default number of sessions in list_sessions response
+SHARD_INDEX = 0  # index of this server process, when server runs as several shards
+SHARD_COUNT = 1
+SHARD_RING = None  # HashRing deciding which shard owns session (or user), None if server is not sharded
+"""@type: HashRing"""
+PLAYER_ACTIVITY = LastSeenIndex()  # heartbeats and RPC requests of players, see check_player_activity
+STORE = SessionStore()  # persistence of sessions, only in memory unless server is given data directory
+"""@type: SessionStore"""
+
+# Metrics of hot paths (see metrics.py), metrics with labels are looked up once here, not on every request
+RPC_DURATION = METRICS.histogram('battleship_rpc_duration_seconds', 'Time spent handling RPC request', ('method',))
+RPC_IN_FLIGHT = METRICS.gauge('battleship_rpc_in_flight', 'RPC requests being handled', ('method',))
+RPC_EXCEPTIONS = METRICS.counter('battleship_rpc_exceptions_total', 'RPC requests that raised exception', ('method',))
+PUBLISH_DURATION = METRICS.histogram('battleship_publish_duration_seconds', 'Time spent publishing message',
+                                     ('kind',))
+PUBLISHED_BYTES = METRICS.counter('battleship_published_bytes_total', 'Size of published message bodies', ('kind',))
+REPLY_DURATION, TOPIC_DURATION = PUBLISH_DURATION.labels('reply'), PUBLISH_DURATION.labels('topic')
+REPLY_BYTES, TOPIC_BYTES = PUBLISHED_BYTES.labels('reply'), PUBLISHED_BYTES.labels('topic')
+ACTIVITY_CHECK_DURATION = METRICS.histogram('battleship_player_activity_check_duration_seconds',
+                                            'Time spent removing inactive players')
+PLAYERS_EXPIRED = METRICS.counter('battleship_players_expired_total', 'Inactive players removed from server')
+TURN_TIMEOUT_DURATION = METRICS.histogram('battleship_turn_timeout_duration_seconds', 'Time spent timing out turn')
+TURN_TIMER_LAG = METRICS.histogram('battleship_turn_timer_lag_seconds',
+                                   'Time from turn deadline until turn timer handles it')
+TURN_TIMEOUTS = METRICS.counter('battleship_turn_timeouts_total', 'Turns players did not shoot in time')
+METRICS.gauge_function('battleship_sessions', 'Game sessions of server', lambda: len(SESSIONS))
+METRICS.gauge_function('battleship_connected_users', 'Users connected to server', lambda: len(connected_users))
+METRICS.gauge_function('battleship_players_tracked', 'Players whose activity is tracked', lambda: len(PLAYER_ACTIVITY))
 
 
 # RPC REQUEST HANDLERS
 
-def on_request_connect(ch, method, props, body):
+def on_request_connect(ch, method, props, data):
     """
     Client RPC request for connecting to game server
     Publishes response to request to MQ sent by client
@@ -31,76 +71,97 @@ def on_request_connect(ch, method, props, body):
         ch (channel): channel used to publish messages to RabbitMQ
         method (method_frame): used to get delivery tag for acknowledging
         props (header_frame): used to get reply_to routing key and correlation id
-        body (json.dumps): json data dumps containing arguments needed for given method
+        data (dict[str, object]): arguments needed for given method (decoded by with_request_lock)
     """
 
-    data = json.loads(body)
-
-    sessions = []
+    listing = {'sessions': [], 'seq': SESSION_LIST_SEQ, 'total': 0, 'more': False, 'shard': SHARD_INDEX}
     err = ""
 
     try:
         user_name = data['user']
 
-        print("%s requested connection" % user_name)
+        LOG.debug("Connection requested", extra=log_fields(user=user_name))
 
         if user_name == "info":  # username info is not allowed, because it is used as topic name.
             err = "Username \"info\" already taken."  # sending this as error to arise minimum number of questions
-            print("Player tried to take info as username - not allowed")
+            LOG.info("Connection refused", extra=log_fields(user=user_name, err=err))
         elif user_name == "":
             err = "Please insert name."
-            print(err)
-        elif user_name not in connected_users:
-            connected_users.append(user_name)
-
-            # Get sessions info
-            for key in SESSIONS.keys():
-                sessions.append(SESSIONS[key].info())
+            LOG.info("Connection refused", extra=log_fields(user=user_name, err=err))
+        elif reconnect_user(user_name):
+            # Get first page of sessions, client asks rest with list_sessions and later changes are received
+            # from <server>.sessions.info
+            listing = get_session_listing()
 
-            print("User \"%s\" connected successfully." % user_name)
+            LOG.info("User connected", extra=log_fields(user=user_name))
         else:
-            print("Username \"%s\" already taken" % user_name)
             err = "Username already taken."
+            LOG.info("Connection refused", extra=log_fields(user=user_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='connect', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'sessions': sessions})
+    listing['err'] = err
+    listing['shards'] = SHARD_COUNT  # client sends later requests straight to shard owning them
+    return publish(ch, method, props, listing)
 
 
-def on_request_disconnect(ch, method, props, body):
+def on_request_list_sessions(ch, method, props, data):
     """
-    Client RPC request for disconnecting from game server
+    Client RPC request for page of game sessions list (sorted by session name)
+    Publishes response to request to MQ sent by client
+
+    Args:
+        ch (channel): channel used to publish messages to RabbitMQ
+        method (method_frame): used to get delivery tag for acknowledging
+        props (header_frame): used to get reply_to routing key and correlation id
+        data (dict[str, object]): arguments needed for given method (decoded by with_request_lock)
     """
 
-    data = json.loads(body)
+    try:
+        listing = get_session_listing(max(int(data.get('offset', 0)), 0),
+                                      max(int(data.get('limit', SESSION_PAGE_SIZE)), 0),
+                                      data.get('prefix', ""), data.get('open_only', False), data.get('after'))
+        listing['err'] = ""
+    except (ValueError, TypeError) as e:
+        LOG.warning("Invalid request", extra=log_fields(method='list_sessions', err=str(e)))
+        listing = {'err': str(e)}
+
+    return publish(ch, method, props, listing)
+
+
+def on_request_disconnect(ch, method, props, data):
+    """
+    Client RPC request for disconnecting from game server
+    """
 
     try:
         user_name = data['user']
 
-        print("%s requested disconnecting" % user_name)
+        LOG.debug("Disconnection requested", extra=log_fields(user=user_name))
         err = ""
 
-        if user_name in connected_users:
-            connected_users.remove(user_name)
+        with REGISTRY_LOCK:
+            was_connected = user_name in connected_users
+            connected_users.discard(user_name)
 
-            print("User \"%s\" disconnected successfully." % user_name)
+        if was_connected:
+            LOG.info("User disconnected", extra=log_fields(user=user_name))
         else:
-            print("Username \"%s\" is not in connected users list" % user_name)
+            LOG.info("User was not connected", extra=log_fields(user=user_name))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='disconnect', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err})
+    return publish(ch, method, props, {'err': err})
 
 
-def on_request_create_session(ch, method, props, body):
+def on_request_create_session(ch, method, props, data):
     """
     Client RPC request for creating new game session
     """
-    data = json.loads(body)
     map_pieces = []
 
     try:
@@ -108,41 +169,40 @@ def on_request_create_session(ch, method, props, body):
         session_name = data['sname']
         player_count = data['player_count']
 
-        print("%s requested session creation" % user_name)
+        LOG.debug("Session creation requested", extra=log_fields(user=user_name, session=session_name))
 
         if session_name == "sessions":
             err = "Session name \"sessions\" is not allowed"
-            print(err)
+            LOG.info("Session creation refused", extra=log_fields(user=user_name, session=session_name, err=err))
         elif session_name not in SESSIONS:
             err = ""
             sess = GameSession(session_name, player_count, user_name)
-            SESSIONS[session_name] = sess
+            with REGISTRY_LOCK:
+                SESSIONS[session_name] = sess
+                USER_SESSIONS[user_name] = session_name
             map_pieces = sess.map_pieces[0]  # on creation owner gets automatically map pieces
 
-            ch.basic_publish(exchange='topic_server', routing_key='%s.sessions.info' % SERVER_NAME,
-                             body=json.dumps(sess.info()))
+            publish_session_update(ch, sess)
 
-            print("Session \"%s\" created successfully." % session_name)
+            LOG.info("Session created", extra=log_fields(user=user_name, session=session_name, players=player_count))
         else:
             err = "Session name \"%s\" is already taken" % session_name
-            print(err)
-        if user_name not in connected_users:
-            connected_users.append(user_name)
-            print "Put user %s back to users players list" % user_name
+            LOG.info("Session creation refused", extra=log_fields(user=user_name, session=session_name, err=err))
+        if reconnect_user(user_name):
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='create_session', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'map': map_pieces})
+    return publish(ch, method, props, {'err': err, 'map': map_pieces})
 
 
-def on_request_join_session(ch, method, props, body):
+def on_request_join_session(ch, method, props, data):
     """
     Client RPC request for joining available game session
     """
 
-    data = json.loads(body)
     map_pieces = []
 
     try:
@@ -150,22 +210,26 @@ def on_request_join_session(ch, method, props, body):
         session_name = data['sname']
         sess = SESSIONS[session_name]
         battlefield = []
+        delta = data.get('delta', False)  # client can ask for ships and shot history instead of full battlefield
 
-        print("%s joining to session %s" % (user_name, session_name))
+        LOG.debug("Join requested", extra=log_fields(user=user_name, session=session_name))
 
         if session_name in SESSIONS:
             err = ""
 
             # check whether spot in game session is free
-            players = sess.players[:]
+            players = sess.players
             max_count = sess.max_players
 
             if sess.in_game:
                 # check whether reconnecting user
                 if user_name in players:
-                    print("Player %s reconnects to session" % user_name)
+                    LOG.info("Player reconnected to session", extra=log_fields(user=user_name, session=session_name))
                     # set player back to active, so he could shoot, send back battlefield showing only his ships
-                    battlefield = sess.get_player_battlefield(user_name)
+                    if delta:
+                        battlefield = sess.get_player_battlefield_delta(user_name)
+                    else:
+                        battlefield = sess.get_player_battlefield(user_name)
                     map_pieces = sess.get_map_pieces(user_name)
                     if user_name not in sess.players_active:
                         sess.players_active.append(user_name)
@@ -174,43 +238,47 @@ def on_request_join_session(ch, method, props, body):
                                      {'msg': "%s reconnected to session" % user_name, 'joined': user_name})
                 else:
                     err = "Can't join to already started game."
-                    print(err)
+                    LOG.info("Join refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
             else:  # in session lobby
                 if len(players) >= max_count:
                     err = "Game session \"%s\" is full." % session_name
-                    print(err)
+                    LOG.info("Join refused", extra=log_fields(user=user_name, session=session_name, err=err))
                 else:
                     if user_name not in players:
                         players.append(user_name)
                         map_pieces = sess.assign_pieces(user_name)
-                        sess.players = players
+                        with REGISTRY_LOCK:
+                            USER_SESSIONS[user_name] = session_name
                         # send info about sessions to sessions lobby and game session lobby
-                        publish_to_topic(ch, '%s.sessions.info' % SERVER_NAME, sess.info())
+                        publish_session_update(ch, sess)
                         publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                          {'msg': "%s joined to session" % user_name, 'joined': user_name})
 
-                        print("User \"%s\" joined successfully to session %s." % (user_name, session_name))
+                        LOG.info("User joined session", extra=log_fields(user=user_name, session=session_name))
                     else:
                         err = "User with given name already in lobby"
-                        print(err)
+                        LOG.info("Join refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Join refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
-        if user_name not in connected_users:
-            connected_users.append(user_name)
-            print "Put user %s back to active users list" % user_name
+        if reconnect_user(user_name):
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='join_session', err="KeyError: %s" % e))
         err = str(e)
 
     # response to player
     if err == "" and sess.in_game:  # reconnecting user
-        publish(ch, method, props, {'err': err, 'map': map_pieces, 'battlefield': battlefield,
-                                    'next': sess.next_shot_by, 'players_list': sess.players})
+        rsp = {'err': err, 'map': map_pieces, 'next': sess.next_shot_by, 'players_list': list(sess.players)}
+        if delta:
+            rsp.update(battlefield)  # 'ships' and 'shots'
+        else:
+            rsp['battlefield'] = battlefield
+        return publish(ch, method, props, rsp)
 
     elif err == "" and user_name in sess.players:  # means player joined successfully
         other_players = sess.players[:]
@@ -218,26 +286,26 @@ def on_request_join_session(ch, method, props, body):
         if sess.owner in other_players:
             other_players.remove(sess.owner)
         else:
-            print("Owner not in players list?! (line 261)")
-        publish(ch, method, props, {'err': err, 'map': map_pieces, 'owner': sess.owner,
-                                    'players': other_players, 'ready': sess.players_ready})
+            LOG.warning("Session owner not in players list",
+                        extra=log_fields(session=sess.session_name, owner=sess.owner))
+        return publish(ch, method, props, {'err': err, 'map': map_pieces, 'owner': sess.owner,
+                                           'players': other_players, 'ready': list(sess.players_ready)})
     else:
-        publish(ch, method, props, {'err': err})
+        return publish(ch, method, props, {'err': err})
 
 
-def on_request_leave_session(ch, method, props, body):
+def on_request_leave_session(ch, method, props, data):
     """
     Client RPC request for leaving from current game session
     """
 
-    data = json.loads(body)
     reconnected = False
 
     try:
         user_name = data['user']
         session_name = data['sname']
 
-        print("%s leaving from session %s" % (user_name, session_name))
+        LOG.debug("Leave requested", extra=log_fields(user=user_name, session=session_name))
 
         if user_name in connected_users and session_name in SESSIONS:
             err = ""
@@ -249,12 +317,15 @@ def on_request_leave_session(ch, method, props, body):
 
                 # clean player info
                 sess.clean_player_info(user_name)
+                with REGISTRY_LOCK:
+                    USER_SESSIONS.pop(user_name, None)
                 # check whether owner and if then publish message about it
                 check_owner(sess, user_name, ch)
 
                 if sess.in_game:  # check if in-game and only one player left (then game is finished)
                     if len(sess.players) == 1:
-                        print "Game over, only one player left in game."
+                        LOG.info("Game over, only one player left",
+                                 extra=log_fields(session=session_name, winner=players[0]))
                         publish_to_topic(ch, '%s.%s.%s' % (SERVER_NAME, session_name, players[0]),  # message to winner
                                          {'msg': 'You won! (other players left)'})
                         publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
@@ -263,39 +334,39 @@ def on_request_leave_session(ch, method, props, body):
                                          'active': False})  # msg to session, back to lobby
 
                         sess.reset_session()
+                        publish_session_update(ch, sess)
                     else:  # otherwise send other players map where is no ships
                         map_empty = sess.get_map_pieces(user_name)
-                        print "%s ships removed, sending data to client." % user_name
+                        LOG.info("Ships of leaving player removed",
+                                 extra=log_fields(user=user_name, session=session_name))
                         publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                          {'msg': "%s ships removed" % user_name, 'empty_map': map_empty})
                 else:  # in lobby
                     leave_game_lobby(sess, user_name, ch)
                     # leaves game lobby and destroys it if no players left, also send messages to players
 
-                print("User \"%s\" left successfully from session %s." % (user_name, session_name))
+                LOG.info("User left session", extra=log_fields(user=user_name, session=session_name))
             else:
-                print("User was not in players list!")
-        elif user_name not in connected_users:
+                LOG.info("User was not in players list", extra=log_fields(user=user_name, session=session_name))
+        elif reconnect_user(user_name):
             err = "Timed out from game session!"
-            connected_users.append(user_name)
             reconnected = True
-            print "Put user %s back to players list" % user_name
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Leave refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='leave_session', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'reconnect': reconnected})
+    return publish(ch, method, props, {'err': err, 'reconnect': reconnected})
 
 
-def on_request_send_ship_placement(ch, method, props, body):
+def on_request_send_ship_placement(ch, method, props, data):
     """
     Client RPC request for sending ship placement to server. Containing coordinates of ships
     """
-    data = json.loads(body)
     err = ""
     reconnected = False
 
@@ -304,7 +375,7 @@ def on_request_send_ship_placement(ch, method, props, body):
         session_name = data['sname']
         coordinates = data['coords']
 
-        print("%s assigning ship coordinates" % user_name)
+        LOG.debug("Ship placement requested", extra=log_fields(user=user_name, session=session_name))
 
         if user_name in connected_users and session_name in SESSIONS:
             sess = SESSIONS[session_name]
@@ -320,42 +391,40 @@ def on_request_send_ship_placement(ch, method, props, body):
                     publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                      {'msg': "%s placed ships" % user_name})
 
-                    print("User \"%s\" ships successfully placed." % user_name)
+                    LOG.info("Ships placed", extra=log_fields(user=user_name, session=session_name))
                 else:
-                    print(err)
+                    LOG.info("Ship placement refused", extra=log_fields(user=user_name, session=session_name, err=err))
             else:
                 err = "User was not in players list!"
-                print(err)
+                LOG.info("Ship placement refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
-        elif user_name not in connected_users:
+        elif reconnect_user(user_name):
             err = "Timed out from game session!"
-            connected_users.append(user_name)
             reconnected = True
-            print "Put user %s back to players list" % user_name
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Ship placement refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='send_ship_placement', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'reconnect': reconnected})
+    return publish(ch, method, props, {'err': err, 'reconnect': reconnected})
 
 
-def on_request_ready(ch, method, props, body):
+def on_request_ready(ch, method, props, data):
     """
     Client RPC request for toggling ready state (player is ready to start or not)
     """
 
-    data = json.loads(body)
     reconnected = False
 
     try:
         user_name = data['user']
         session_name = data['sname']
 
-        print("%s is getting ready" % user_name)
+        LOG.debug("Ready state change requested", extra=log_fields(user=user_name, session=session_name))
         err = ""
 
         if user_name in connected_users and session_name in SESSIONS:
@@ -365,7 +434,7 @@ def on_request_ready(ch, method, props, body):
 
             if user_name not in sess.ships_placed:
                 msg = "Place ships before pressing ready."
-                print(msg)
+                LOG.info("Ready state change refused", extra=log_fields(user=user_name, session=session_name, err=msg))
             elif user_name in p_ready:
                 p_ready.remove(user_name)
                 msg = "%s is not ready anymore" % user_name
@@ -380,37 +449,36 @@ def on_request_ready(ch, method, props, body):
                              {'msg': msg, 'ready': user_name})
             # acknowledge client of player ready state
 
-            print("User \"%s\" set successfully ready state" % user_name)
-        elif user_name not in connected_users:
+            LOG.info("Ready state changed",
+                     extra=log_fields(user=user_name, session=session_name, ready=user_name in p_ready))
+        elif reconnect_user(user_name):
             err = "Timed out from game session!"
-            connected_users.append(user_name)
             reconnected = True
-            print "Put user %s back to players list" % user_name
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Ready state change refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='ready', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'reconnect': reconnected})
+    return publish(ch, method, props, {'err': err, 'reconnect': reconnected})
 
 
-def on_request_start_game(ch, method, props, body):
+def on_request_start_game(ch, method, props, data):
     """
     Client RPC request for starting game, checking if all players are ready to start game
     Publishes to topic_server about game starting
     """
 
-    data = json.loads(body)
     reconnected = False
 
     try:
         user_name = data['user']
         session_name = data['sname']
 
-        print("%s starting game on %s" % (user_name, session_name))
+        LOG.debug("Game start requested", extra=log_fields(user=user_name, session=session_name))
 
         if user_name in connected_users and session_name in SESSIONS:
             err = ""
@@ -419,65 +487,60 @@ def on_request_start_game(ch, method, props, body):
             # check whether user is sess owner
             if user_name != sess.owner:
                 err = "User is not session owner"
-                print(err)
+                LOG.info("Game start refused", extra=log_fields(user=user_name, session=session_name, err=err))
             elif sess.check_ready(user_name) and len(sess.players) > 1:  # check whether players ready and more than 1
                 # START GAME
                 sess.start_game()
                 # send info about sessions to sessions lobby and game session lobby
-                publish_to_topic(ch, '%s.sessions.info' % SERVER_NAME, sess.info())
+                publish_session_update(ch, sess)
                 publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                  {'msg': "%s started game and has first shot" % user_name,
                                   'active': sess.in_game, 'next': user_name})  # atm owner gets the first shot
 
                 # start timing out player turns if haven't got response from them in 10 seconds
-                thread_timer = CheckTurnTime(SERVER_NAME, ch, sess)
-                thread_timer.start()
-                TIMER_THREADS[session_name] = thread_timer
+                TURN_SCHEDULER.schedule(sess, ch)
 
-                print("User \"%s\" started game successfully on session %s." % (user_name, session_name))
+                LOG.info("Game started",
+                         extra=log_fields(user=user_name, session=session_name, players=len(sess.players)))
             else:
                 if len(sess.players) > 1:
                     err = "All players are not ready!"
                 else:
                     err = "Need more than one player to start."
-                print err
+                LOG.info("Game start refused", extra=log_fields(user=user_name, session=session_name, err=err))
                 publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                  {'msg': ("%s tried to start game - " % user_name) + err})
 
-        elif user_name not in connected_users:
+        elif reconnect_user(user_name):
             err = "Timed out from game session!"
-            connected_users.append(user_name)
             reconnected = True
-            print "Put user %s back to players list" % user_name
+            LOG.info("User put back to connected users", extra=log_fields(user=user_name))
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Game start refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='start_game', err="KeyError: %s" % e))
         err = str(e)
 
-    publish(ch, method, props, {'err': err, 'reconnect': reconnected})
+    return publish(ch, method, props, {'err': err, 'reconnect': reconnected})
 
 
-def on_request_shoot(ch, method, props, body):
+def on_request_shoot(ch, method, props, data):
     """
     Client RPC request for shooting, check if game session in game, player in list, then call shoot method
     """
 
-    data = json.loads(body)
-
     msg = ""
     reconnected = False
-    # Lock thread for assigning next player. Timer is reset by shooting.
-    TIMER_LOCK.acquire()
+    # Session lock (see with_request_lock) keeps turn timeout from assigning next player meanwhile.
 
     try:
         user_name = data['user']
         session_name = data['sname']
         coords = data['coords']
 
-        print("%s taking shot at %s on %s" % (user_name, str(coords), session_name))
+        LOG.debug("Shot requested", extra=log_fields(user=user_name, session=session_name, coords=coords))
 
         err = ""
         res = 0
@@ -487,18 +550,19 @@ def on_request_shoot(ch, method, props, body):
 
             if sess.next_shot_by == user_name:
 
-                TIMER_THREADS[session_name].turn_start_time = time()  # restart timer
+                TURN_SCHEDULER.schedule(sess, ch)  # restart timer
 
                 res = sess.check_shot(coords)  # 0-miss, 1-hit, 2-sunk (refactor to enum)
+                STORE.log_shot(sess, coords)  # rest of the changes are replayed from shot
 
                 if res == 0:
                     # shot missed
                     msg = "You missed."
-                    print("Shot missed")
+                    LOG.debug("Shot missed", extra=log_fields(user=user_name, session=session_name, coords=coords))
                 elif res == 1:
                     # shot hit
                     msg = "You hit a ship."
-                    print("Shot hit!")
+                    LOG.debug("Shot hit", extra=log_fields(user=user_name, session=session_name, coords=coords))
                 else:
                     # ship sunk
                     msg = "You hit and sunk a ship."
@@ -513,15 +577,16 @@ def on_request_shoot(ch, method, props, body):
                         publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                          {'msg': "%s lost game" % player_lost, 'gameover': player_lost})
                         publish_to_topic(ch, '%s.%s.%s' % (SERVER_NAME, session_name, player_lost),  # spectator info
-                                         {'msg': 'You lost! Spectator mode.', 'spec_field': sess.battlefield})
+                                         {'msg': 'You lost! Spectator mode.', 'spec_field': sess.battlefield.tolist()})
 
                         if len(sess.players_alive) == 1:  # if only one player alive
-                            print("Game over")
+                            LOG.info("Game over", extra=log_fields(session=session_name, winner=user_name))
                             publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, session_name),
                                              {'msg': "%s won the game" % user_name, 'gameover': user_name,
                                               'active': False})  # Back to lobby
                             # Reset session info
                             sess.reset_session()
+                            publish_session_update(ch, sess)
 
                 if sess.in_game:  # if still in game, select next player
 
@@ -532,29 +597,59 @@ def on_request_shoot(ch, method, props, body):
             else:
                 # it not given players turn to shoot
                 err = "It is not your turn to shoot"
-                print(err + " " + user_name)
+                LOG.info("Shot refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
-        elif user_name not in connected_users:
+        elif reconnect_user(user_name):
             err = "Timed out from game session!"
-            print(err)
-            connected_users.append(user_name)
+            LOG.info("Shot refused", extra=log_fields(user=user_name, session=session_name, err=err))
             reconnected = True
         else:
             err = "Session \"%s\" does not exist anymore" % session_name
-            print(err)
+            LOG.info("Shot refused", extra=log_fields(user=user_name, session=session_name, err=err))
 
     except KeyError as e:
-        print("KeyError: %s" % str(e))
+        LOG.warning("Invalid request", extra=log_fields(method='shoot', err="KeyError: %s" % e))
         err = str(e)
-    finally:
-        TIMER_LOCK.release()
 
     if res == 0:
         hit = False
     else:
         hit = True
 
-    publish(ch, method, props, {'err': err, 'msg': msg, 'hit': hit, 'reconnect': reconnected})
+    return publish(ch, method, props, {'err': err, 'msg': msg, 'hit': hit, 'reconnect': reconnected})
+
+
+def instrument_handler(method_name, handler):
+    """
+    Wraps RPC request handler to measure its latency, requests in flight and exceptions (labeled by method name)
+    """
+    return timed(handler, RPC_DURATION.labels(method_name), RPC_IN_FLIGHT.labels(method_name),
+                 RPC_EXCEPTIONS.labels(method_name))
+
+
+# Handler registry for single queue mode, method name -> handler (e.g. 'shoot' -> on_request_shoot)
+RPC_HANDLERS = dict((name[len('on_request_'):], instrument_handler(name[len('on_request_'):], handler))
+                    for name, handler in globals().items() if name.startswith('on_request_'))
+
+
+def dispatch_request(ch, method, props, data):
+    """
+    Client RPC request sent to single server queue, routes request to handler by "method" header
+
+    Args:
+        ch (channel): channel used to publish messages to RabbitMQ
+        method (method_frame): used to get delivery tag for acknowledging
+        props (header_frame): used to get reply_to routing key, correlation id and method header
+        data (dict[str, object]): arguments needed for given method (decoded by with_request_lock)
+    """
+
+    method_name = (props.headers or {}).get('method')
+
+    if method_name in RPC_HANDLERS:
+        return RPC_HANDLERS[method_name](ch, method, props, data)
+    else:
+        LOG.warning("Unknown RPC method", extra=log_fields(method=method_name))
+        return publish(ch, method, props, {'err': "Unknown method \"%s\"" % method_name})
 
 
 # HELPER FUNCTIONS
@@ -568,15 +663,25 @@ def publish(ch, method, props, rsp):
         method (method_frame): used to get delivery tag for acknowledging
         props (header_frame): used to get reply_to routing key and correlation id
         rsp (dict): dictionary containing response to client
+    Returns:
+        dict: response, RPC request handlers give it back so wrappers can see the outcome (see with_persistence)
     """
 
-    response = json.dumps(rsp)
+    # reply in format client used, JSON if server can't handle it
+    content_type = props.content_type if props.content_type in SUPPORTED_CONTENT_TYPES else CONTENT_TYPE_JSON
+
+    with REPLY_DURATION.time():
+        response = encode_message(rsp, content_type)
 
-    ch.basic_publish(exchange='',
-                     routing_key=props.reply_to,
-                     properties=pika.BasicProperties(correlation_id=props.correlation_id),
-                     body=response)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_publish(exchange='',
+                         routing_key=props.reply_to,
+                         properties=BasicProperties(correlation_id=props.correlation_id,
+                                                    content_type=content_type),
+                         body=response)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    REPLY_BYTES.inc(len(response))
+    return rsp
 
 
 def publish_to_topic(ch, key, rsp):
@@ -590,10 +695,87 @@ def publish_to_topic(ch, key, rsp):
         rsp (dict): dictionary containing response to client
     """
 
-    response = json.dumps(rsp)
+    with TOPIC_DURATION.time():
+        response = encode_message(rsp, TOPIC_CONTENT_TYPE)
+
+        ch.basic_publish(exchange='topic_server', routing_key=key,
+                         properties=BasicProperties(content_type=TOPIC_CONTENT_TYPE),
+                         body=response)
+
+    TOPIC_BYTES.inc(len(response))
+
+
+def publish_session_update(ch, sess):
+    """
+    Publish change of game session to <server>.sessions.info as delta of sessions list:
+    {'seq': sequence number, 'op': 'add'/'update'/'remove', 'session': session info (only name on remove),
+     'shard': index of shard (every shard has its own sequence numbers)}.
+    Nothing is published if session info has not changed since last delta.
+
+    Args:
+        ch (channel): channel used to publish messages to RabbitMQ
+        sess (GameSession): Instance of GameSession
+    """
+
+    global SESSION_LIST_SEQ
+
+    session_name = sess.session_name
+
+    # sequence numbers must be published in order, so it is done holding the lock
+    with REGISTRY_LOCK:
+        if SESSIONS.get(session_name) is sess:
+            info = sess.info()
+        else:  # session was deleted
+            info = None
+
+        listed_info = SESSION_LIST.get(session_name)
+
+        if info is None:
+            if listed_info is None:
+                return
+            op = 'remove'
+            del SESSION_LIST[session_name]
+            info = {'session_name': session_name}
+        elif listed_info is None:
+            op = 'add'
+            SESSION_LIST[session_name] = info
+        elif listed_info != info:
+            op = 'update'
+            SESSION_LIST[session_name] = info
+        else:
+            return
 
-    ch.basic_publish(exchange='topic_server', routing_key=key,
-                     body=response)
+        SESSION_LIST_SEQ += 1
+        publish_to_topic(ch, '%s.sessions.info' % SERVER_NAME,
+                         {'seq': SESSION_LIST_SEQ, 'op': op, 'session': info, 'shard': SHARD_INDEX})
+
+
+def get_session_listing(offset=0, limit=SESSION_PAGE_SIZE, prefix="", open_only=False, after=None):
+    """
+    Gives page of published sessions list, sorted by session name. Whole list is read page by page giving name
+    of last session of previous page as after (sessions added or removed meanwhile don't shift later pages).
+
+    Args:
+        offset (int): number of matching sessions to skip
+        limit (int): max number of sessions to give
+        prefix (str): give only sessions with names starting with prefix
+        open_only (bool): give only sessions that are not full and have not started game
+        after (str): give only sessions with names after this one
+    Returns:
+        dict[str, object]: {'sessions': list of session infos, 'seq': sequence number of sessions list,
+                            'total': number of matching sessions, 'more': True if there are sessions after
+                            the page, 'shard': index of this shard}
+    """
+
+    with REGISTRY_LOCK:
+        matching = [info for session_name, info in sorted(SESSION_LIST.items())
+                    if session_name.startswith(prefix) and
+                    not (open_only and (info['in_game'] or info['player_count'] >= info['max_count']))]
+        start = offset if after is None else bisect_right([info['session_name'] for info in matching], after)
+        start = min(start, len(matching))
+
+        return {'sessions': matching[start:start + limit], 'seq': SESSION_LIST_SEQ, 'total': len(matching),
+                'more': start + limit < len(matching), 'shard': SHARD_INDEX}
 
 
 def check_owner(sess, user_name, ch):
@@ -629,90 +811,499 @@ def leave_game_lobby(sess, user_name, ch):
     """
     if len(sess.players) == 0:  # no players left in session - delete session
         msg = "Game session %s is empty, session deleted" % sess.session_name
-        print(msg)
-        del SESSIONS[sess.session_name]  # only dict key deleted
+        LOG.info("Session deleted, no players left", extra=log_fields(session=sess.session_name))
+        with REGISTRY_LOCK:
+            del SESSIONS[sess.session_name]  # only dict key deleted
+            SESSION_LOCKS.pop(sess.session_name, None)  # requests waiting for it take lock again
     else:  # send message about leaving lobby
         publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, sess.session_name),
                          {'msg': "%s left from session" % user_name, 'left': user_name})
     # refresh sessions list
-    publish_to_topic(ch, '%s.sessions.info' % SERVER_NAME, sess.info())
+    publish_session_update(ch, sess)
 
     # delete empty session
     if len(sess.players) == 0:
         del sess
 
 
-def check_player_activity(players, ch):
+def check_player_activity(inactive_players, ch):
     """
+    Removes players who have not been seen for a while from server, game lobbies and turn order
 
     Args:
-        players (list[str]): List of active player(user)
+        inactive_players (list[str]): List of players(users) expired from PLAYER_ACTIVITY
         ch (BlockingConnection.channel): BlockingConnection channel to RabbitMQ
     """
 
-    for user in connected_users:
-        if user not in players:  # meaning player inactive
-            print "User %s is inactive" % user
-            print "Removed user %s from server" % user
-            connected_users.remove(user)  # remove user from server players list. So player could reconnect
-            for key in SESSIONS:  # check if user in any game session
-                sess = SESSIONS[key]
-                if user in sess.players:
-                    if sess.in_game:  # set player as inactive (so other players know and this player would be skipped)
-                        if user in sess.players_active:
-                            sess.players_active.remove(user)
-                            print("%s is inactive" % user)
-                            publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, sess.session_name),
-                                             {'msg': "%s is inactive" % user, 'inactive': True})
-                    else:  # remove player from game lobby
-                        # clean player info
-                        sess.clean_player_info(user)
-                        # check whether owner and if then publish message about it
-                        check_owner(sess, user, ch)
-                        leave_game_lobby(sess, user, ch)
-                        print("User %s kicked from lobby" % user)
-
-                    break  # user found
-
-
-class CheckTurnTime(Thread):
-    """
-    Thread for checking whether server have received response from player in time.
-    """
-    def __init__(self, server_name, channel, session):
+    with ACTIVITY_CHECK_DURATION.time():
+        with REGISTRY_LOCK:
+            inactive_users = [user for user in inactive_players if user in connected_users]
+
+        PLAYERS_EXPIRED.inc(len(inactive_users))
+
+        for user in inactive_users:
+            LOG.info("Inactive user removed from server", extra=log_fields(user=user))
+            with REGISTRY_LOCK:
+                connected_users.discard(user)  # remove user from server players list. So player could reconnect
+                sess = get_user_session(user)  # check if user in any game session
+            if sess is None:
+                continue
+
+            with get_session_lock(sess.session_name):
+                if user not in sess.players:  # left session before lock was acquired
+                    continue
+                if sess.in_game:  # set player as inactive (so other players know and this player would be skipped)
+                    if user in sess.players_active:
+                        sess.players_active.remove(user)
+                        LOG.info("Player inactive in game", extra=log_fields(user=user, session=sess.session_name))
+                        publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, sess.session_name),
+                                         {'msg': "%s is inactive" % user, 'inactive': True})
+                else:  # remove player from game lobby
+                    # clean player info
+                    sess.clean_player_info(user)
+                    with REGISTRY_LOCK:
+                        USER_SESSIONS.pop(user, None)
+                    # check whether owner and if then publish message about it
+                    check_owner(sess, user, ch)
+                    leave_game_lobby(sess, user, ch)
+                    LOG.info("Inactive user kicked from lobby", extra=log_fields(user=user, session=sess.session_name))
+
+                persist_session(sess.session_name)
+
+
+def get_session_lock(session_name):
+    """
+    Gets lock of game session, lock is created on first use. Locks are kept only for existing sessions (lock is
+    removed when session is deleted), sessions that don't exist (yet) are guarded by registry lock.
+
+    Args:
+        session_name (str): Name of game session
+    Returns:
+        RLock: lock for handling requests of given session, REGISTRY_LOCK if session does not exist
+    """
+
+    lock = SESSION_LOCKS.get(session_name)
+
+    if lock is None:
+        with REGISTRY_LOCK:
+            if session_name not in SESSIONS:
+                return REGISTRY_LOCK
+            lock = SESSION_LOCKS.setdefault(session_name, RLock())
+
+    return lock
+
+
+def decode_request(props, body):
+    """
+    Decodes arguments of RPC request
+
+    Args:
+        props (header_frame): used to get content type of request
+        body (str): encoded data containing arguments of request
+    Returns:
+        dict[str, object]: arguments of request, None if request can't be decoded
+    """
+
+    try:
+        data = decode_message(body, props.content_type)
+    except ValueError:
+        return None
+
+    return data if isinstance(data, dict) else None
+
+
+def with_request_lock(handler):
+    """
+    Wraps RPC request handler, so that it is called holding lock of game session the request is about, or registry
+    lock if request has no session name or session does not exist. Request is decoded here once and handler is
+    called with decoded arguments (None if request can't be decoded) instead of body.
+
+    Args:
+        handler (function): RPC request handler (on_request_* function)
+    Returns:
+        function: wrapped handler
+    """
+
+    def locked_handler(ch, method, props, body):
+        data = decode_request(props, body)
+        session_name = data.get('sname') if data is not None else None
+
+        while True:
+            lock = get_session_lock(session_name)
+            with lock:
+                # session may have been created or deleted while waiting, then its lock is not this one anymore
+                if get_session_lock(session_name) is lock:
+                    return handler(ch, method, props, data)
+
+    return locked_handler
+
+
+def with_content_check(handler):
+    """
+    Wraps RPC request handler, so that requests server can't decode (unsupported format or invalid data) are
+    answered with error
+
+    Args:
+        handler (function): RPC request handler
+    Returns:
+        function: wrapped handler
+    """
+
+    def checked_handler(ch, method, props, data):
+        if props.content_type not in SUPPORTED_CONTENT_TYPES:
+            LOG.warning("Unsupported content type", extra=log_fields(content_type=props.content_type))
+            publish(ch, method, props, {'err': "Unsupported content type \"%s\"" % props.content_type})
+        elif data is None:
+            LOG.warning("Invalid request", extra=log_fields(content_type=props.content_type))
+            publish(ch, method, props, {'err': "Invalid request"})
+        else:
+            return handler(ch, method, props, data)
+
+    return checked_handler
+
+
+def set_shard(shard_index, shard_count):
+    """
+    Make this server process one of shard_count shards, owning sessions (and users) hashing to shard_index
+
+    Args:
+        shard_index (int): index of this shard
+        shard_count (int): number of shards of server
+    """
+
+    global SHARD_INDEX, SHARD_COUNT, SHARD_RING
+
+    SHARD_INDEX = shard_index
+    SHARD_COUNT = shard_count
+    SHARD_RING = HashRing(shard_count) if shard_count > 1 else None
+
+
+def get_request_shard(data):
+    """
+    Gives index of shard owning request: shard given in request, shard of session or shard of user
+
+    Args:
+        data (dict[str, object]): arguments of RPC request
+    Returns:
+        int: shard index, SHARD_INDEX if server is not sharded or request has no key
+    """
+
+    if SHARD_RING is None:
+        return SHARD_INDEX
+
+    if data.get('shard') is not None:
+        return int(data['shard']) % SHARD_COUNT
+
+    key = get_request_key(data)
+    if not key:
+        return SHARD_INDEX
+
+    return SHARD_RING.get_shard(key)
+
+
+def with_shard_routing(handler, shard_queue):
+    """
+    Wraps RPC request handler, so that requests owned by other shards are forwarded to them
+    (reply_to and correlation id are kept, so owner replies to client directly)
+
+    Args:
+        handler (function): RPC request handler
+        shard_queue (function): gives name of RPC queue of shard with given index
+    Returns:
+        function: wrapped handler
+    """
+
+    def routing_handler(ch, method, props, data):
+        try:
+            shard = get_request_shard(data)
+        except (ValueError, TypeError):
+            shard = SHARD_INDEX
+
+        if shard == SHARD_INDEX:
+            return handler(ch, method, props, data)
+        else:
+            ch.basic_publish(exchange='', routing_key=shard_queue(shard), properties=props,
+                             body=encode_message(data, props.content_type))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    return routing_handler
+
+
+def with_player_activity(handler):
+    """
+    Wraps RPC request handler, so that every request counts as heartbeat of the player who sent it
+    (players making requests don't need to send separate heartbeats)
+
+    Args:
+        handler (function): RPC request handler
+    Returns:
+        function: wrapped handler
+    """
+
+    def touching_handler(ch, method, props, data):
+        user_name = data.get('user')
+
+        if user_name is not None:
+            PLAYER_ACTIVITY.touch(user_name)
+
+        return handler(ch, method, props, data)
+
+    return touching_handler
+
+
+def with_persistence(handler, method_name=None):
+    """
+    Wraps RPC request handler, so that session of request is logged to STORE after handler changed it (request
+    succeeded). Shots are logged by on_request_shoot itself as short records.
+
+    Args:
+        handler (function): RPC request handler
+        method_name (str): name of RPC method, taken from "method" header if None (single queue)
+    Returns:
+        function: wrapped handler
+    """
+
+    def persisting_handler(ch, method, props, data):
+        response = handler(ch, method, props, data)
+
+        # rejected requests have not changed session
+        if response is None or response.get('err') != "" or \
+                (method_name or (props.headers or {}).get('method')) == 'shoot':
+            return response
+
+        session_name = data.get('sname')
+        if session_name is not None:
+            persist_session(session_name)
+
+        return response
+
+    return persisting_handler
+
+
+def persist_session(session_name):
+    """
+    Log current state of session to STORE (deleting if session does not exist anymore), should be called holding
+    lock of the session
+
+    Args:
+        session_name (str): Name of game session
+    """
+
+    sess = SESSIONS.get(session_name)
+
+    if sess is None:
+        STORE.log_delete(session_name)
+    else:
+        STORE.log_session(sess)
+
+
+def get_sessions_with_locks():
+    """
+    Gives all sessions with their locks (for snapshots of STORE)
+
+    Returns:
+        list[(GameSession, RLock)]: sessions and session locks
+    """
+
+    with REGISTRY_LOCK:
+        return [(sess, get_session_lock(session_name)) for session_name, sess in SESSIONS.items()]
+
+
+def restore_sessions(store, ch, replicated_sessions=None):
+    """
+    Restore sessions from store, players of restored sessions are timed out as usual if they don't come back
+
+    Args:
+        store (SessionStore): store to restore sessions from and log changes to after that
+        ch (BlockingConnection.channel): channel for publishing turn time outs
+        replicated_sessions (dict[str, GameSession]): sessions taken over from primary server (standby only),
+                                                      these replace sessions restored from store
+    """
+
+    global STORE
+
+    STORE = store
+    sessions = store.restore()
+    sessions.update(replicated_sessions or {})
+
+    with REGISTRY_LOCK:
+        SESSIONS.update(sessions)
+
+        for session_name, sess in sessions.items():
+            SESSION_LIST[session_name] = sess.info()
+            for user_name in sess.players:
+                USER_SESSIONS[user_name] = session_name
+                connected_users.add(user_name)
+                PLAYER_ACTIVITY.touch(user_name)
+
+    for sess in sessions.values():
+        if sess.in_game:
+            TURN_SCHEDULER.schedule(sess, ch)
+
+    if sessions:
+        LOG.info("Restored %d game sessions", len(sessions))
+
+    store.start(get_sessions_with_locks)
+
+    for sess in (replicated_sessions or {}).values():
+        STORE.log_session(sess)  # store (and next standby) did not have these yet
+
+
+def on_replication_sync(ch, method, props, body):
+    """
+    Standby server asks for all sessions, they are logged to STORE that replicates them
+
+    Args:
+        ch (channel): channel used to publish messages to RabbitMQ
+        method (method_frame): not used
+        props (header_frame): not used
+        body (str): name of server standby is for
+    """
+
+    LOG.info("Standby server connected, replicating all sessions")
+
+    for sess, session_lock in get_sessions_with_locks():
+        with session_lock:
+            if SESSIONS.get(sess.session_name) is sess:  # not deleted meanwhile
+                STORE.log_session(sess)
+
+
+def get_user_session(user_name):
+    """
+    Gets game session where given user is player, using reverse index USER_SESSIONS
+
+    Args:
+        user_name (str): Name of the player(user)
+    Returns:
+        GameSession: Instance of GameSession, None if user is not in any session
+    """
+
+    with REGISTRY_LOCK:
+        sess = SESSIONS.get(USER_SESSIONS.get(user_name))
+
+        if sess is None or user_name not in sess.players:  # stale index entry (session deleted or reset)
+            USER_SESSIONS.pop(user_name, None)
+            return None
+
+    return sess
+
+
+def reconnect_user(user_name):
+    """
+    Adds user to connected users unless already connected (also puts back users removed by check_player_activity)
+
+    Args:
+        user_name (str): Name of the player(user)
+    Returns:
+        bool: True if user was not connected
+    """
+
+    with REGISTRY_LOCK:
+        if user_name in connected_users:
+            return False
+        connected_users.add(user_name)
+        return True
+
+
+class TurnScheduler(Thread):
+    """
+    Single thread timing out player turns of all game sessions. Turn deadlines are kept in heap, so scheduling and
+    timing out a turn costs O(log n) and thread wakes up only when the earliest deadline is reached.
+    """
+    def __init__(self, turn_time=TURN_TIME):
         """
-        Publish server's name after every second in order to show that server is active.
-        @param server_name:
-        @type server_name: str
-        @param channel:
-        @type channel: BlockingConnection.channel
-        @param session:
-        @type session: GameSession
+        @param turn_time: seconds player has for taking a shot
+        @type turn_time: int
         """
-        super(CheckTurnTime, self).__init__()
-        self.server_name = server_name
-        self.channel = channel
-        self.sess = session
-        self.turn_time = 10
+        super(TurnScheduler, self).__init__(name='TurnScheduler')
+        self.daemon = True
+        self.turn_time = turn_time
+        self.deadlines = []  # heap of (deadline, session name, turn number)
+        self.turns = {}  # session name -> (turn number, session, channel), older heap entries are skipped
+        """@type: dict[str, (int, GameSession, BlockingConnection.channel)]"""
+        self.turn_counter = 0
+        self.condition = Condition()
         self._is_running = True
-        self.turn_start_time = time()
+
+    def schedule(self, sess, ch):
+        """
+        Starts (or restarts) turn timer of game session
+
+        Args:
+            sess (GameSession): Instance of GameSession
+            ch (BlockingConnection.channel): channel for publishing turn time out
+        """
+
+        with self.condition:
+            self.turn_counter += 1
+            self.turns[sess.session_name] = (self.turn_counter, sess, ch)
+            heappush(self.deadlines, (time() + self.turn_time, sess.session_name, self.turn_counter))
+            self.condition.notify()
+
+    def run_pending(self):
+        """
+        Times out turns which deadline is reached
+
+        Returns:
+            float: time of next deadline, None if no turns are timed
+        """
+
+        expired = []
+
+        with self.condition:
+            now = time()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, session_name, turn = heappop(self.deadlines)
+                expired.append((deadline, session_name, turn))
+
+        for deadline, session_name, turn in expired:
+            with get_session_lock(session_name):  # lock session while assigning next player
+                with self.condition:
+                    timed_out = self.turns.get(session_name, (None,))[0] == turn  # turn was not restarted
+                if timed_out:
+                    TURN_TIMER_LAG.observe(time() - deadline)
+                    with TURN_TIMEOUT_DURATION.time():
+                        self.time_out_turn(session_name, turn)
+
+        with self.condition:
+            return self.deadlines[0][0] if self.deadlines else None
+
+    def time_out_turn(self, session_name, turn):
+        with self.condition:
+            if self.turns.get(session_name, (None,))[0] != turn:
+                return  # turn was restarted (shot taken) or game ended
+            turn, sess, ch = self.turns.pop(session_name)
+
+        if sess.in_game:
+            TURN_TIMEOUTS.inc()
+            LOG.info("Turn timed out",
+                     extra=log_fields(session=sess.session_name, user=sess.next_shot_by, seconds=self.turn_time))
+            current_player = sess.next_shot_by
+            next_player = sess.get_next_player()
+            STORE.log_turn(sess)
+            publish_to_topic(ch, '%s.%s.info' % (SERVER_NAME, sess.session_name),
+                             {'msg': "%s failed to take shot in time. %s's turn."
+                                     % (current_player, next_player), 'next': next_player})  # 'coords' not sent
+            self.schedule(sess, ch)
 
     def run(self):
         while self._is_running:
-            TIMER_LOCK.acquire()  # lock while assigning next player
-            if self.sess.in_game:
-                if (time() - self.turn_start_time) >= self.turn_time:
-                    print("Player didn't send response in time (10 seconds)")
-                    current_player = self.sess.next_shot_by
-                    next_player = self.sess.get_next_player()
-                    publish_to_topic(self.channel, '%s.%s.info' % (SERVER_NAME, self.sess.session_name),
-                                     {'msg': "%s failed to take shot in time. %s's turn."
-                                             % (current_player, next_player), 'next': next_player})  # 'coords' not sent
-                    self.turn_start_time = time()
-            else:
-                self._is_running = False
-                # remove also from dictionary
-                # remove dict key here, otherwise should check when game ended
-                del TIMER_THREADS[self.sess.session_name]
-            TIMER_LOCK.release()
-            sleep(1)  # no need to check very often
+            self.run_pending()
+
+            with self.condition:  # schedule() notifies, so new earlier deadline can't be missed
+                if not self._is_running:
+                    break
+                elif self.deadlines:
+                    self.condition.wait(max(self.deadlines[0][0] - time(), 0))
+                else:
+                    self.condition.wait()
+
+    def exit(self):
+        with self.condition:
+            self._is_running = False
+            self.condition.notify()
+
+
+TURN_SCHEDULER = TurnScheduler()
+METRICS.gauge_function('battleship_turns_scheduled', 'Game sessions with turn timer running',
+                       lambda: len(TURN_SCHEDULER.turns))
@@ -0,0 +1,94 @@
+# Hot standby server - keeps copy of game sessions of primary server (with same name) from its replication records
+# and takes over its RPC queues when primary stops announcing itself.
+#
+# Fencing: server and its standby consume RPC queues as exclusive consumers, so broker lets only one of them
+# consume. Standby takes over only when primary has stopped announcing itself and nobody consumes its RPC queues
+# (connection of primary is gone, a stalled primary keeps its connection and queues). If primary comes back before
+# standby gets the queues, the exclusive consume of standby is refused and it goes back to replicating.
+
+# Import
+import time
+from persistence import REPLICATION_EXCHANGE, apply_record, decode_record, replication_key
+from common import LOG, get_transport, log_fields
+
+FAILOVER_TIMEOUT = 2  # seconds without announcements of primary before standby checks whether it can take over
+STANDBY_WAIT_TIME = 0.1  # seconds standby waits for messages before checking announcements of primary
+
+
+class StandbyServer(object):
+
+    def __init__(self, args, rpc_queue_names):
+        """
+        Standby for server args.name. Listens for announcements of primary (<server>.info) and its replication
+        records (<server>.replication, signed with args.replication_secret).
+
+        Args:
+            args: command line arguments (name, replication_secret, transport, host, port)
+            rpc_queue_names (list[str]): RPC queues of server, standby takes over when nobody consumes them
+        """
+
+        self.server_name = args.name
+        self.secret = args.replication_secret
+        self.rpc_queue_names = rpc_queue_names
+        self.sessions = {}  # replicated game sessions
+        self.last_announcement = time.time()  # primary gets time to announce itself after standby starts
+
+        self.connection = get_transport(args).connect()
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange='topic_server', type='topic')
+        self.channel.exchange_declare(exchange=REPLICATION_EXCHANGE, type='topic')
+
+        queue_name = self.channel.queue_declare(exclusive=True).method.queue
+        self.channel.queue_bind(exchange='topic_server', queue=queue_name, routing_key='%s.info' % self.server_name)
+        self.channel.queue_bind(exchange=REPLICATION_EXCHANGE, queue=queue_name,
+                                routing_key=replication_key(self.server_name))
+        self.channel.basic_consume(self.on_message, queue=queue_name, no_ack=True)
+
+    def wait_for_takeover(self):
+        """
+        Replicate sessions of primary until it stops announcing itself and consuming its RPC queues
+
+        Returns:
+            dict[str, GameSession]: replicated sessions, session name -> session
+        """
+
+        # ask primary for all of its sessions, later changes are received as they happen
+        self.channel.basic_publish(exchange=REPLICATION_EXCHANGE,
+                                   routing_key='%s.sync' % replication_key(self.server_name), body=self.server_name)
+
+        LOG.info("Standby is waiting", extra=log_fields(server=self.server_name))
+
+        try:
+            while True:
+                self.connection.process_data_events(time_limit=STANDBY_WAIT_TIME)
+                if time.time() - self.last_announcement < FAILOVER_TIMEOUT:
+                    continue
+                if not self.rpc_queues_consumed():
+                    break
+                LOG.warning("Server stopped announcing itself but still consumes RPC queues",
+                            extra=log_fields(server=self.server_name))
+                self.last_announcement = time.time()  # check again after FAILOVER_TIMEOUT
+        finally:
+            self.connection.close()
+
+        LOG.info("Server stopped announcing itself, taking over", extra=log_fields(server=self.server_name,
+                                                                                   sessions=len(self.sessions)))
+        return self.sessions
+
+    def rpc_queues_consumed(self):
+        """
+        Checks whether some RPC queue of server has consumers (primary is still connected to broker)
+        """
+        return any(self.channel.queue_declare(queue=queue_name).method.consumer_count
+                   for queue_name in self.rpc_queue_names)
+
+    def on_message(self, ch, method, props, body):
+        if method.exchange == REPLICATION_EXCHANGE:
+            try:
+                session_name, kind, data = decode_record(props, body, self.secret)
+            except ValueError as e:
+                LOG.warning("Replication record refused", extra=log_fields(server=self.server_name, err=str(e)))
+                return
+            apply_record(self.sessions, session_name, kind, data)
+        else:  # announcement of primary
+            self.last_announcement = time.time()
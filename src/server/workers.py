@@ -0,0 +1,124 @@
+# Worker pool for running RPC request handlers on multiple threads,
+# publishes responses back through pika connection thread
+
+# Import
+from Queue import Queue, Empty
+from threading import Thread, Lock
+from common import LOG, get_threadsafe_callback_adder
+
+FLUSH_INTERVAL = 0.01  # seconds between sending queued messages if connection thread can't be woken up
+
+
+class ThreadSafeChannel(object):
+    """
+    Channel wrapper that can be used from any thread. BlockingConnection is not thread safe, so publishing and
+    acknowledging is queued and done by connection thread, which is woken up to send them right away.
+    """
+    def __init__(self, connection, channel):
+        """
+        @param connection:
+        @type connection: BlockingConnection
+        @param channel:
+        @type channel: BlockingConnection.channel
+        """
+        self.connection = connection
+        self.channel = channel
+        self.pending = Queue()
+        self.flush_scheduled = False  # connection thread has been asked to flush and has not started yet
+        self.lock = Lock()
+        self.add_callback = get_threadsafe_callback_adder(connection)
+
+        if self.add_callback is None:
+            self.connection.add_timeout(FLUSH_INTERVAL, self.flush)
+
+    def basic_publish(self, *args, **kwargs):
+        self.put((self.channel.basic_publish, args, kwargs))
+
+    def basic_ack(self, *args, **kwargs):
+        self.put((self.channel.basic_ack, args, kwargs))
+
+    def start_consuming(self):
+        self.channel.start_consuming()  # called by connection thread
+
+    def put(self, channel_call):
+        self.pending.put(channel_call)
+
+        if self.add_callback is None:
+            return  # flushed by timer
+
+        with self.lock:  # one wake up is enough for everything queued before flush starts
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.add_callback(self.flush)
+
+    def flush(self):
+        """
+        Send queued messages, called by connection thread
+        """
+        with self.lock:
+            self.flush_scheduled = False
+
+        while True:
+            try:
+                channel_method, args, kwargs = self.pending.get_nowait()
+            except Empty:
+                break
+            channel_method(*args, **kwargs)
+
+        if self.add_callback is None and self.connection.is_open:
+            self.connection.add_timeout(FLUSH_INTERVAL, self.flush)
+
+
+class RPCWorkerPool(object):
+    """
+    Runs RPC request handlers on worker threads. Handlers should be wrapped with rpc_requests.with_request_lock,
+    so requests of the same game session are run one at a time.
+    """
+    def __init__(self, connection, channel, worker_count):
+        """
+        @param connection:
+        @type connection: BlockingConnection
+        @param channel:
+        @type channel: BlockingConnection.channel
+        @param worker_count: number of worker threads
+        @type worker_count: int
+        """
+        self.channel = ThreadSafeChannel(connection, channel)
+        self.requests = Queue()
+        self.workers = [Thread(target=self.work, name='RPCWorker-%d' % i) for i in range(worker_count)]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def wrap(self, handler):
+        """
+        Gives back consumer callback that hands request over to worker threads
+
+        Args:
+            handler (function): RPC request handler (on_request_* function)
+        Returns:
+            function: callback for basic_consume
+        """
+
+        def on_request(ch, method, props, body):
+            self.requests.put((handler, method, props, body))
+
+        return on_request
+
+    def work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:  # exit
+                break
+
+            handler, method, props, body = request
+            try:
+                handler(self.channel, method, props, body)
+            except Exception:
+                LOG.exception("RPC handler failed")
+
+    def exit(self):
+        for _ in self.workers:
+            self.requests.put(None)
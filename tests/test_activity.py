@@ -0,0 +1,42 @@
+# Test player activity index
+
+from unittest import TestCase
+from server.activity import *
+
+
+class LastSeenIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = LastSeenIndex()
+        self.index.touch("p1", now=0)
+        self.index.touch("p2", now=1)
+        self.index.touch("p3", now=2)
+
+    def test_expire(self):
+        # test that only players not seen during timeout are expired
+        print("Testing expiring players")
+
+        self.assertEqual(self.index.expire(5, now=5), ["p1"])
+        self.assertEqual(self.index.expire(5, now=5), [])
+        self.assertEqual(self.index.expire(5, now=10), ["p2", "p3"])
+        self.assertEqual(len(self.index), 0)
+
+    def test_touch(self):
+        # test that seeing player again moves it to the end of expiry order
+        print("Testing seeing players again")
+
+        self.index.touch("p1", now=3)
+
+        self.assertEqual(self.index.expire(5, now=7), ["p2", "p3"])
+        self.assertTrue("p1" in self.index)
+        self.assertEqual(self.index.expire(5, now=8), ["p1"])
+
+    def test_next_expiry(self):
+        # test that next expiry is expiry time of player seen longest ago
+        print("Testing next expiry")
+
+        self.assertEqual(self.index.next_expiry(5), 5)
+        self.index.expire(5, now=6)
+        self.assertEqual(self.index.next_expiry(5), 7)
+        self.index.expire(5, now=7)
+        self.assertEqual(self.index.next_expiry(5), None)
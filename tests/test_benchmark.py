@@ -0,0 +1,56 @@
+# Test randomized fleets and baseline comparison of game session benchmarks
+
+import random
+from unittest import TestCase
+from server.gamesession import *
+from server.benchmark import *
+
+
+class BenchmarkTests(TestCase):
+
+    def test_random_fleet(self):
+        # test that random fleets are placed inside player's pieces and ships are not merged together
+        print("Testing random fleets")
+
+        sess, fleets = new_full_session(4, random.Random(0))
+
+        for player in sess.players:
+            self.assertEqual(sess.place_ships(player, fleets[player]), "")
+            pieces = sess.get_map_pieces(player)
+            self.assertTrue(all(GameSession.get_piece_nr(x, y) in pieces for x, y in fleets[player]))
+
+        self.assertEqual(len(sess.ships), 4 * len(FLEET))
+        self.assertEqual(sorted(ship.hits_left for ship in sess.ships.values()), sorted(FLEET * 4))
+
+    def test_same_seed(self):
+        # test that same seed gives same fleets and shooting order
+        print("Testing benchmark reproducibility")
+
+        random.seed(1)
+        sess, shot_order = new_started_game(3, random.Random(1))
+        random.seed(1)
+        sess2, shot_order2 = new_started_game(3, random.Random(1))
+
+        self.assertEqual(shot_order, shot_order2)
+        self.assertEqual(sess.map_pieces, sess2.map_pieces)
+        self.assertEqual(sess.battlefield.tolist(), sess2.battlefield.tolist())
+
+    def test_compare_results(self):
+        # test that only slowdown over tolerance is regression and benchmarks missing from baseline are skipped
+        print("Testing comparing to baseline")
+
+        baseline = {'check_shot': {'2': 1.0, '4': 2.0}}
+        results = {'check_shot': {'2': 1.2, '4': 3.0, '8': 5.0}, 'place_ships': {'2': 1.0}}
+
+        self.assertEqual(compare_results(results, baseline, 0.25),
+                         [('check_shot', '2', 1.0, 1.2, False), ('check_shot', '4', 2.0, 3.0, True)])
+
+    def test_environment_differences(self):
+        # test that baseline measured with other Python, numpy, machine or seed is detected
+        print("Testing baseline environment")
+
+        report = run_benchmarks([2], 0, 1, ['check_end_game'])
+        baseline = dict(report, numpy='0.0', results={})
+
+        self.assertEqual(environment_differences(report, report), [])
+        self.assertEqual(environment_differences(report, baseline), [('numpy', '0.0', report['numpy'])])
@@ -1,5 +1,6 @@
 # Test game session class methods
 
+import json
 from unittest import TestCase
 from server.gamesession import *
 
@@ -164,3 +165,131 @@ class GameSessionTests(TestCase):
                        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
 
         self.assertEqual(player_field, test_field)
+
+    def test_remove_ships(self):
+        # test whether removing ships clears only given player pieces
+
+        print("Testing removing ships")
+
+        self.sess.assign_pieces(self.player)
+        coords = [[0, 0], [0, 1], [4, 4]]
+        coords2 = [[6, 0], [6, 1], [8, 7]]
+
+        self.sess.place_ships(self.owner, coords)
+        self.sess.place_ships(self.player, coords2)
+
+        self.sess.remove_ships(self.player)
+
+        self.assertEqual(self.sess.battlefield.sum(), 2 * len(coords))
+        self.assertEqual(self.sess.battlefield[6, 0], 0)
+        self.assertEqual(self.sess.battlefield[4, 4], 2)
+
+    def test_ship_registry(self):
+        # test whether ships are registered on placement and sunk ship coordinates are returned from registry
+
+        print("Testing ship registry")
+
+        self.sess.assign_pieces(self.player)
+        coords2 = [[6, 0], [6, 1], [6, 2], [8, 7], [9, 7]]
+        self.sess.place_ships(self.player, coords2)
+
+        self.assertEqual(len(self.sess.ships), 2)
+
+        self.assertEqual(self.sess.check_shot([6, 1]), 1)
+        self.assertEqual(self.sess.check_shot([6, 0]), 1)
+        self.assertEqual(self.sess.check_shot([6, 1]), 0)  # already shot
+        self.assertEqual(self.sess.check_shot([6, 2]), 2)
+
+        self.assertEqual(self.sess.get_ship_coordinates([6, 1]), [[6, 0], [6, 1], [6, 2]])
+        self.assertEqual(self.sess.get_ship([8, 7]).owner, self.player)
+
+        self.sess.place_ships(self.player, [[8, 7]])  # replacing ships clears old registry entries
+        self.assertEqual(len(self.sess.ships), 1)
+        self.assertIsNone(self.sess.get_ship([6, 0]))
+
+    def test_ship_squares_left(self):
+        # test whether remaining ship squares counters follow placement, removal and shots
+
+        print("Testing ship squares counters")
+
+        self.sess.assign_pieces(self.player)
+        self.sess.place_ships(self.owner, [[0, 0], [0, 1]])
+        self.sess.place_ships(self.player, [[6, 0], [8, 7], [9, 7]])
+
+        self.assertEqual(self.sess.ship_squares_left, {self.owner: 2, self.player: 3})
+
+        self.sess.place_ships(self.player, [[8, 7]])
+        self.assertEqual(self.sess.ship_squares_left[self.player], 1)
+
+        self.sess.start_game()
+        self.sess.check_shot([0, 0])
+        self.assertEqual(self.sess.ship_squares_left[self.owner], 1)
+        self.assertEqual(self.sess.check_end_game(), None)
+
+        self.sess.check_shot([0, 1])
+        self.assertEqual(self.sess.check_end_game(), self.owner)
+        self.assertEqual(self.sess.players_alive, [self.player])
+
+    def test_piece_ownership(self):
+        # test whether piece ownership lookups follow assigning and unassigning pieces
+
+        print("Testing piece ownership")
+
+        self.sess.assign_pieces(self.player)
+
+        self.assertEqual(self.sess.get_piece_owner(2), self.owner)
+        self.assertEqual(self.sess.get_piece_owner(5), self.player)
+        self.assertEqual(self.sess.get_map_pieces(self.player), [4, 5, 6, 7])
+
+        self.sess.unassign_pieces(self.player)
+
+        self.assertEqual(self.sess.get_piece_owner(5), None)
+        self.assertEqual(self.sess.get_map_pieces(self.player), [])
+        self.assertEqual(self.sess.get_player_battlefield(self.player), self.sess.battlefield.tolist())
+        self.assertEqual(self.sess.assign_pieces("p2"), [4, 5, 6, 7])
+        self.assertEqual(self.sess.get_ship_owner([6, 0]), "p2")
+
+    def test_player_battlefield_views(self):
+        # test whether cached player battlefield is updated on shots and delta contains ships and shots
+
+        print("Testing cached player battlefield views")
+
+        self.sess.assign_pieces(self.player)
+        self.sess.place_ships(self.owner, [[0, 0], [0, 1]])
+        self.sess.place_ships(self.player, [[6, 0], [8, 7]])
+
+        self.sess.get_player_battlefield(self.owner)  # build cached view
+        self.sess.check_shot([0, 0])
+        self.sess.check_shot([6, 0])
+        self.sess.check_shot([7, 3])
+
+        player_field = self.sess.get_player_battlefield(self.owner)
+        self.assertEqual(player_field[0][:2], [1, 2])
+        self.assertEqual(player_field[6][0], -1)
+        self.assertEqual(player_field[7][3], -1)
+        self.assertEqual(player_field[8][7], 0)
+
+        self.sess.player_views = {}  # rebuilt view must match incrementally updated one
+        self.assertEqual(self.sess.get_player_battlefield(self.owner), player_field)
+
+        delta = self.sess.get_player_battlefield_delta(self.player)
+        self.assertEqual(sorted(delta['ships']), [[6, 0], [8, 7]])
+        self.assertEqual(delta['shots'], [[0, 0], [6, 0], [7, 3]])
+
+    def test_player_list(self):
+        # test whether player list keeps order and membership in sync
+
+        print("Testing player list")
+
+        players = PlayerList(["a", "b", "c"])
+        players.append("b")  # already in list
+        players.remove("a")
+        players.insert(0, "d")
+
+        self.assertEqual(players, ["d", "b", "c"])
+        self.assertTrue("c" in players)
+        self.assertFalse("a" in players)
+        self.assertEqual(players.pop(), "c")
+        self.assertFalse("c" in players)
+        self.assertEqual(json.loads(json.dumps(players)), ["d", "b"])
+        self.assertRaises(ValueError, players.remove, "a")
@@ -0,0 +1,78 @@
+# Test asynchronous structured logging of server
+
+import logging
+from StringIO import StringIO
+from threading import Event
+from time import sleep
+from unittest import TestCase
+from common import AsyncLogHandler, SamplingFilter, StructuredFormatter, log_fields
+
+
+class LoggingTests(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        stream_handler = logging.StreamHandler(self.stream)
+        stream_handler.setFormatter(StructuredFormatter('%(levelname)s %(message)s'))
+        self.handler = AsyncLogHandler(stream_handler)
+        self.log = logging.getLogger('test_logging')
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(self.handler)
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_structured(self):
+        # test that fields are appended sorted after message and arguments are formatted when record is logged
+        print("Testing structured records")
+
+        coords = [1, 2]
+        self.log.info("Shot requested", extra=log_fields(user="p1", session="my game", coords=coords))
+        self.log.warning("Restored %d game sessions", 2)
+        coords.append(3)
+        self.handler.close()
+
+        self.assertEqual(self.stream.getvalue(), 'INFO Shot requested coords=[1, 2] session="my game" user=p1\n'
+                                                 'WARNING Restored 2 game sessions\n')
+
+    def test_sampling(self):
+        # test that every n-th record of each message is kept and warnings are always kept
+        print("Testing sampling of records")
+
+        self.handler.addFilter(SamplingFilter(3))
+        for i in range(5):
+            self.log.debug("Shot requested", extra=log_fields(shot=i))
+            self.log.warning("Unknown RPC method")
+        self.log.info("User connected")
+        self.handler.close()
+
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual([line for line in lines if line.startswith('DEBUG')],
+                         ['DEBUG Shot requested shot=0', 'DEBUG Shot requested shot=3'])
+        self.assertEqual(lines.count('WARNING Unknown RPC method'), 5)
+        self.assertTrue('INFO User connected' in lines)
+
+    def test_full_queue(self):
+        # test that records logged while queue is full are dropped without blocking and their count is logged
+        print("Testing full log queue")
+
+        written = []
+        released = Event()
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                released.wait()  # writer is stuck on I/O
+                written.append(record.getMessage())
+
+        handler = AsyncLogHandler(SlowHandler(), queue_size=2)
+        for i in range(6):
+            handler.handle(logging.makeLogRecord({'msg': "Shot %d", 'args': (i,)}))
+            if i == 0:
+                while not handler.queue.empty():  # wait until writer took first record
+                    sleep(0.001)
+        released.set()
+        handler.close()
+
+        self.assertEqual(written, ['Shot 0', 'Shot 1', 'Shot 2', 'Dropped 3 log records'])
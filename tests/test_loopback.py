@@ -0,0 +1,116 @@
+# Test routing and delivery of in-process loopback broker and memory transport
+
+from argparse import Namespace
+from unittest import TestCase
+from loopback import *
+from common import TRANSPORT_MEMORY, CONTENT_TYPE_JSON, BasicProperties, get_transport, encode_message
+
+
+class LoopbackBrokerTests(TestCase):
+
+    def setUp(self):
+        self.broker = LoopbackBroker()
+        self.connection = self.broker.connect()
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange='topic_server', type='topic')
+        self.received = []
+
+    def consume(self, routing_key=None, queue=''):
+        # bind new queue to topic_server (or use queue of default exchange) and collect its messages
+        queue_name = self.channel.queue_declare(queue=queue, exclusive=routing_key is not None).method.queue
+        if routing_key is not None:
+            self.channel.queue_bind(exchange='topic_server', queue=queue_name, routing_key=routing_key)
+        self.channel.basic_consume(lambda ch, method, props, body: self.received.append((routing_key, body)),
+                                   queue=queue_name, no_ack=True)
+        return queue_name
+
+    def test_topic_routing(self):
+        # test that messages reach queues whose binding keys match routing key
+        print("Testing topic routing")
+
+        self.consume('*.info')
+        self.consume('srv.sess.p1')
+        self.consume('srv.#')
+
+        self.channel.basic_publish(exchange='topic_server', routing_key='srv.info', body='a')
+        self.channel.basic_publish(exchange='topic_server', routing_key='srv.sess.p1', body='b')
+        self.channel.basic_publish(exchange='topic_server', routing_key='srv.sess.info', body='c')
+        self.channel.basic_publish(exchange='topic_server', routing_key='other.sess.p1', body='d')
+        self.connection.process_data_events()
+
+        self.assertEqual(sorted(self.received), [('*.info', 'a'), ('srv.#', 'a'), ('srv.#', 'b'), ('srv.#', 'c'),
+                                                 ('srv.sess.p1', 'b')])
+
+    def test_backlog(self):
+        # test that messages published before consuming are delivered to first consumer with their properties
+        print("Testing queue backlog")
+
+        self.channel.queue_declare(queue='srv_rpc')
+        props = BasicProperties(correlation_id='1')
+        self.channel.basic_publish(exchange='', routing_key='srv_rpc', properties=props, body='x')
+
+        delivered = []
+        self.channel.basic_consume(lambda ch, method, props, body: delivered.append((props, body)), queue='srv_rpc')
+        self.connection.process_data_events()
+
+        self.assertEqual(delivered, [(props, 'x')])
+
+    def test_close(self):
+        # test that exclusive queues of closed connection are deleted and other connections keep theirs
+        print("Testing closing connection")
+
+        other = self.broker.connect()
+        queue_name = other.channel().queue_declare(exclusive=True).method.queue
+        other.channel().queue_bind(exchange='topic_server', queue=queue_name, routing_key='srv.info')
+        self.consume('srv.info')
+
+        other.close()
+        self.channel.basic_publish(exchange='topic_server', routing_key='srv.info', body='a')
+        self.connection.process_data_events()
+
+        self.assertFalse(queue_name in self.broker.queues)
+        self.assertEqual(self.received, [('srv.info', 'a')])
+
+    def test_exclusive_consume(self):
+        # test that exclusive consumer keeps other connections from consuming queue until its connection closes
+        print("Testing exclusive consumer")
+
+        other = self.broker.connect()
+        other.channel().queue_declare(queue='srv_rpc')
+        other.channel().basic_consume(lambda ch, method, props, body: None, queue='srv_rpc', exclusive=True)
+
+        self.assertEqual(self.channel.queue_declare(queue='srv_rpc').method.consumer_count, 1)
+        self.assertRaises(ChannelClosed, self.consume, queue='srv_rpc')
+        self.assertRaises(ChannelClosed, self.channel.basic_consume, lambda ch, method, props, body: None,
+                          queue='srv_rpc', exclusive=True)
+
+        other.close()
+        self.assertEqual(self.channel.queue_declare(queue='srv_rpc').method.consumer_count, 0)
+        self.channel.basic_consume(lambda ch, method, props, body: None, queue='srv_rpc', exclusive=True)
+
+
+class MemoryTransportTests(TestCase):
+
+    def test_zero_copy(self):
+        # test that connections of memory transport share broker and consumers get published body object itself
+        print("Testing memory transport")
+
+        transport = get_transport(Namespace(transport=TRANSPORT_MEMORY))
+        self.assertTrue(transport is get_transport(Namespace(transport=TRANSPORT_MEMORY)))
+
+        server, client = transport.connect(), transport.connect()
+        server_channel, client_channel = server.channel(), client.channel()
+        client_channel.exchange_declare(exchange='topic_server', type='topic')
+        queue_name = client_channel.queue_declare(exclusive=True).method.queue
+        client_channel.queue_bind(exchange='topic_server', queue=queue_name, routing_key='srv.sess.info')
+        received = []
+        client_channel.basic_consume(lambda ch, method, props, body: received.append(body), queue=queue_name)
+
+        body = encode_message({'msg': "test"})
+        server_channel.basic_publish(exchange='topic_server', routing_key='srv.sess.info', body=body,
+                                     properties=BasicProperties(content_type=CONTENT_TYPE_JSON))
+        client.process_data_events()
+
+        self.assertTrue(received[0] is body)
+        server.close()
+        client.close()
@@ -0,0 +1,69 @@
+# Test server metrics and their text format
+
+import urllib2
+from unittest import TestCase
+from server.metrics import *
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_histogram(self):
+        # test that histogram buckets are cumulative and quantiles are estimated by bucket bounds
+        print("Testing histograms")
+
+        histogram = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.samples('latency_seconds', ())),
+                         [('latency_seconds_bucket', (('le', '0.1'),), 1),
+                          ('latency_seconds_bucket', (('le', '1'),), 3),
+                          ('latency_seconds_bucket', (('le', '+Inf'),), 4),
+                          ('latency_seconds_sum', (), 6.05),
+                          ('latency_seconds_count', (), 4)])
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+    def test_timed(self):
+        # test that timed function is observed also when it raises and in-flight gauge goes back to zero
+        print("Testing timed functions")
+
+        duration = self.registry.histogram('rpc_seconds', 'RPC', ('method',))
+        in_flight = self.registry.gauge('rpc_in_flight', 'RPC in flight', ('method',))
+        errors = self.registry.counter('rpc_exceptions_total', 'RPC exceptions', ('method',))
+
+        def handler(fail):
+            self.assertEqual(in_flight.labels('shoot').value, 1)
+            if fail:
+                raise ValueError()
+
+        timed_handler = timed(handler, duration.labels('shoot'), in_flight.labels('shoot'), errors.labels('shoot'))
+        timed_handler(False)
+        self.assertRaises(ValueError, timed_handler, True)
+
+        self.assertEqual(duration.labels('shoot').count, 2)
+        self.assertEqual(in_flight.labels('shoot').value, 0)
+        self.assertEqual(self.registry.snapshot()['rpc_exceptions_total'], {'shoot': 1})
+
+    def test_http(self):
+        # test that metrics are served in Prometheus text format
+        print("Testing metrics endpoint")
+
+        self.registry.counter('requests_total', 'Requests', ('method',)).labels('connect').inc(3)
+        self.registry.gauge_function('sessions', 'Sessions', lambda: 2)
+        server = MetricsServer(self.registry, 0)
+
+        try:
+            text = urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.port).read()
+        finally:
+            server.exit()
+
+        self.assertEqual(text, '# HELP requests_total Requests\n'
+                               '# TYPE requests_total counter\n'
+                               'requests_total{method="connect"} 3\n'
+                               '# HELP sessions Sessions\n'
+                               '# TYPE sessions gauge\n'
+                               'sessions 2\n')
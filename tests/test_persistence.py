@@ -0,0 +1,160 @@
+# Test restoring game sessions from snapshot and write-ahead log
+
+import cPickle as pickle
+import shutil
+import tempfile
+from argparse import Namespace
+from threading import RLock
+from unittest import TestCase
+from common import TRANSPORT_MEMORY, BasicProperties, encode_message, get_transport
+from server.gamesession import *
+from server.persistence import *
+from server.standby import StandbyServer
+
+
+class FileSessionStoreTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stores = []
+        self.sess = GameSession("sess", 2, "owner")
+        self.sess.players.append("p1")
+        self.sess.map_pieces = [[0, 1, 2, 3], [4, 5, 6, 7]]
+        self.sess.assign_pieces("p1")
+        self.sess.place_ships("owner", [[0, 0], [0, 1]])
+        self.sess.place_ships("p1", [[6, 0], [6, 1]])
+        self.sess.start_game()
+
+    def tearDown(self):
+        for store in self.stores:
+            store.exit()
+        shutil.rmtree(self.directory)
+
+    def restart(self):
+        # new store reading files left by previous one (previous one is not closed, like after crash)
+        store = FileSessionStore(self.directory)
+        self.stores.append(store)
+        return store, store.restore()
+
+    def test_replay_log(self):
+        # test that sessions and shots logged are restored
+        print("Testing replaying log")
+
+        store, sessions = self.restart()
+        store.start(lambda: [])
+        store.log_session(self.sess)
+        for coords in ([6, 0], [3, 3]):
+            self.sess.check_shot(coords)
+            self.sess.get_next_player()
+            store.log_shot(self.sess, coords)
+        store.sync()
+
+        store, sessions = self.restart()
+        restored = sessions["sess"]
+
+        self.assertEqual(restored.battlefield.tolist(), self.sess.battlefield.tolist())
+        self.assertEqual(restored.shots, self.sess.shots)
+        self.assertEqual(restored.next_shot_by, self.sess.next_shot_by)
+        self.assertEqual(restored.ship_squares_left, self.sess.ship_squares_left)
+
+    def test_snapshot(self):
+        # test that records after snapshot are replayed on top of it and deleted sessions are not restored
+        print("Testing snapshot")
+
+        store, sessions = self.restart()
+        store.start(lambda: [(self.sess, RLock())])
+        store.log_session(self.sess)
+        store.log_session(GameSession("deleted", 2, "p2"))
+        store.log_delete("deleted")
+        store.snapshot()
+
+        self.sess.check_shot([6, 0])
+        self.sess.get_next_player()
+        store.log_shot(self.sess, [6, 0])
+        store.sync()
+
+        store, sessions = self.restart()
+
+        self.assertEqual(sorted(sessions), ["sess"])
+        self.assertEqual(sessions["sess"].shots, [[6, 0]])
+        self.assertEqual(sessions["sess"].next_shot_by, self.sess.next_shot_by)
+
+
+class RecordingChannel(object):
+    # collects published messages instead of publishing them
+
+    def __init__(self):
+        self.messages = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.messages.append((exchange, routing_key, properties, body))
+
+
+class ReplicationTests(TestCase):
+
+    def setUp(self):
+        self.sess = GameSession("sess", 2, "owner")
+        self.sess.players.append("p1")
+        self.sess.map_pieces = [[0, 1, 2, 3], [4, 5, 6, 7]]
+        self.sess.assign_pieces("p1")
+        self.sess.place_ships("owner", [[0, 0], [0, 1]])
+        self.sess.place_ships("p1", [[6, 0], [6, 1]])
+        self.sess.start_game()
+
+    def test_replicate(self):
+        # test that standby gets same sessions from signed plain data records
+        print("Testing replication records")
+
+        channel = RecordingChannel()
+        store = ReplicatingSessionStore(SessionStore(), channel, "server", "secret")
+        store.log_session(self.sess)
+        for coords in ([6, 0], [3, 3]):
+            self.sess.check_shot(coords)
+            self.sess.get_next_player()
+            store.log_shot(self.sess, coords)
+        store.log_session(GameSession("deleted", 2, "p2"))
+        store.log_delete("deleted")
+
+        sessions = {}
+        for exchange, routing_key, properties, body in channel.messages:
+            self.assertEqual((exchange, routing_key), (REPLICATION_EXCHANGE, replication_key("server")))
+            apply_record(sessions, *decode_record(properties, body, "secret"))
+
+        restored = sessions["sess"]
+        self.assertEqual(sorted(sessions), ["sess"])
+        self.assertEqual(restored.battlefield.tolist(), self.sess.battlefield.tolist())
+        self.assertEqual(restored.ship_grid.tolist(), self.sess.ship_grid.tolist())
+        self.assertEqual(restored.shots, self.sess.shots)
+        self.assertEqual(restored.next_shot_by, self.sess.next_shot_by)
+        self.assertEqual(restored.ship_squares_left, self.sess.ship_squares_left)
+        self.assertEqual(restored.get_ship_owner([6, 1]), "p1")
+        self.assertEqual(restored.check_shot([6, 1]), self.sess.check_shot([6, 1]))
+
+    def test_forged_records(self):
+        # test that records not signed with shared secret are refused
+        print("Testing forged replication records")
+
+        body, properties = encode_record("sess", 'session', self.sess, "other secret")
+        self.assertRaises(ValueError, decode_record, properties, body, "secret")
+
+        body = pickle.dumps(("sess", 'session', self.sess))
+        self.assertRaises(ValueError, decode_record, BasicProperties(), body, "secret")
+
+        body = encode_message(["sess", 'session', {'session_name': "sess"}])
+        properties = BasicProperties(headers={'signature': sign_record(body, "secret")})
+        self.assertRaises(ValueError, decode_record, properties, body, "secret")
+
+    def test_fencing(self):
+        # test that standby sees RPC queues as taken while primary is connected and consumes them
+        print("Testing standby fencing")
+
+        args = Namespace(name="fenced", replication_secret="secret", transport=TRANSPORT_MEMORY)
+        primary = get_transport(args).connect()
+        primary.channel().queue_declare(queue="fenced_rpc")
+        primary.channel().basic_consume(lambda ch, method, props, body: None, queue="fenced_rpc", exclusive=True)
+        standby = StandbyServer(args, ["fenced_rpc"])
+
+        self.assertTrue(standby.rpc_queues_consumed())
+        primary.close()
+        self.assertFalse(standby.rpc_queues_consumed())
+        standby.connection.close()
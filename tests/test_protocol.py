@@ -0,0 +1,67 @@
+# Test client connection to server when connection thread stops
+
+import time
+from argparse import Namespace
+from threading import Event
+from unittest import TestCase
+from common import TRANSPORT_MEMORY
+from client.protocol import ConnectionManager, RPCClient, CONNECTION_TIMEOUT, IDLE_WAIT_TIME
+
+
+class LostConnection(object):
+    # connection that is lost while waiting for messages
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def process_data_events(self, time_limit=0):
+        raise IOError('Connection lost')
+
+
+class ProtocolTests(TestCase):
+
+    def setUp(self):
+        self.args = Namespace(transport=TRANSPORT_MEMORY, single_queue=False, binary=False)
+        self.connection_manager = ConnectionManager(self.args)
+        self.rpc = RPCClient(self.connection_manager, self.args, None)
+        self.rpc.server_name = 'unknown'
+
+    def tearDown(self):
+        self.connection_manager.exit()
+        self.connection_manager.join(CONNECTION_TIMEOUT)
+
+    def test_wake_up(self):
+        # test that I/O thread waiting for messages is woken up to publish message handed over by other thread
+        print("Testing publishing through I/O thread")
+
+        received = Event()
+        self.connection_manager.subscribe(lambda *args: received.set(), 'test.wake')
+        time.sleep(0.1)  # I/O thread is waiting for messages
+        self.connection_manager.publish('topic_server', 'test.wake', 'message')
+
+        self.assertTrue(received.wait(IDLE_WAIT_TIME / 2.0))
+
+    def test_timeout(self):
+        # test that call to server that does not answer times out
+        print("Testing timeout of call")
+
+        start = time.time()
+        self.assertEqual(self.rpc.connect(user="p1"), {'err': 'Connection timed out'})
+        self.assertTrue(time.time() - start < CONNECTION_TIMEOUT + 1)
+
+    def test_connection_lost(self):
+        # test that calls waiting for response and calls made later fail when connection thread stops
+        print("Testing lost connection")
+
+        future = self.rpc.call_async('connect', user="p1")
+        self.connection_manager.connection = LostConnection(self.connection_manager.connection)
+        self.connection_manager.join(CONNECTION_TIMEOUT)
+
+        self.assertEqual(future.result(0), {'err': 'Connection lost'})
+        start = time.time()
+        self.assertEqual(self.rpc.connect(user="p1"), {'err': 'Connection lost'})
+        self.assertTrue(time.time() - start < 1)
+        self.assertRaises(IOError, self.connection_manager.subscribe, lambda *args: None, 'unknown.info')
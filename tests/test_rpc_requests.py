@@ -0,0 +1,170 @@
+# Test handling of RPC requests by server
+
+from unittest import TestCase
+from common import BasicProperties, encode_message, decode_message
+from server import rpc_requests
+from server.persistence import SessionStore
+
+
+class Method(object):
+    delivery_tag = 1
+
+
+class RecordingChannel(object):
+    # collects replies to requests and topic messages instead of publishing them
+
+    def __init__(self):
+        self.replies = []
+        self.topic_messages = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        message = decode_message(body, properties.content_type)
+        if exchange == '':
+            self.replies.append(message)
+        else:
+            self.topic_messages.append((routing_key, message))
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+
+class RPCRequestTests(TestCase):
+
+    def setUp(self):
+        for registry in (rpc_requests.SESSIONS, rpc_requests.SESSION_LOCKS, rpc_requests.USER_SESSIONS,
+                         rpc_requests.SESSION_LIST):
+            registry.clear()
+        rpc_requests.connected_users.clear()
+        rpc_requests.STORE = SessionStore()
+        self.channel = RecordingChannel()
+
+    def request(self, handler, **data):
+        # handle request the way server does (holding request lock) and give reply to it
+        props = BasicProperties(reply_to='reply', correlation_id='1')
+        rpc_requests.with_request_lock(handler)(self.channel, Method(), props, encode_message(data))
+        return self.channel.replies[-1]
+
+    def test_session_locks(self):
+        # test that locks are not created for unknown sessions and lock of deleted session is removed
+        print("Testing session locks")
+
+        self.request(rpc_requests.on_request_connect, user="p1")
+        for i in range(10):
+            self.request(rpc_requests.on_request_ready, user="p1", sname="unknown%d" % i)
+        self.assertEqual(rpc_requests.SESSION_LOCKS, {})
+
+        reply = self.request(rpc_requests.on_request_create_session, user="p1", sname="s", player_count=2)
+        self.assertEqual(reply['err'], "")
+        self.request(rpc_requests.on_request_ready, user="p1", sname="s")
+        self.assertEqual(list(rpc_requests.SESSION_LOCKS), ["s"])
+
+        self.request(rpc_requests.on_request_leave_session, user="p1", sname="s")
+        self.assertFalse("s" in rpc_requests.SESSIONS)
+        self.assertEqual(rpc_requests.SESSION_LOCKS, {})
+
+    def test_decode_once(self):
+        # test that request is decoded once for whole chain of wrappers and invalid requests are answered with error
+        print("Testing decoding of requests")
+
+        decoded = []
+        decode_message = rpc_requests.decode_message
+
+        def counting_decode_message(body, content_type=None):
+            decoded.append(body)
+            return decode_message(body, content_type)
+
+        handler = rpc_requests.with_content_check(rpc_requests.with_shard_routing(rpc_requests.with_player_activity(
+            rpc_requests.with_persistence(rpc_requests.RPC_HANDLERS['create_session'], 'create_session')),
+            lambda shard: 'shard%d' % shard))
+        rpc_requests.decode_message = counting_decode_message
+        try:
+            reply = self.request(handler, user="p1", sname="s", player_count=2)
+        finally:
+            rpc_requests.decode_message = decode_message
+
+        self.assertEqual(reply['err'], "")
+        self.assertEqual(len(decoded), 1)
+
+        for body in ('{"user": ', '["p1"]'):
+            rpc_requests.with_request_lock(handler)(self.channel, Method(), BasicProperties(reply_to='reply'), body)
+            self.assertEqual(self.channel.replies[-1], {'err': "Invalid request"})
+
+    def test_persist_changes(self):
+        # test that session is logged to store only after requests that changed it
+        print("Testing persisting of changed sessions")
+
+        logged = []
+
+        class RecordingStore(SessionStore):
+            def log_session(self, sess):
+                logged.append(sess.session_name)
+
+            def log_delete(self, session_name):
+                logged.append(None)
+
+        rpc_requests.STORE = RecordingStore()
+        request = lambda method_name, **data: self.request(rpc_requests.with_persistence(
+            rpc_requests.RPC_HANDLERS[method_name], method_name), **data)
+
+        for user_name in ("p1", "p2", "p3"):
+            request('connect', user=user_name)
+        request('create_session', user="p1", sname="s", player_count=2)
+        request('join_session', user="p2", sname="s")
+        self.assertEqual(logged, ["s", "s"])
+
+        self.assertNotEqual(request('join_session', user="p3", sname="s")['err'], "")  # full
+        self.assertNotEqual(request('start_game', user="p2", sname="s")['err'], "")  # not owner
+        self.assertNotEqual(request('ready', user="p1", sname="unknown")['err'], "")
+        self.assertEqual(logged, ["s", "s"])
+
+        request('leave_session', user="p1", sname="s")
+        self.assertEqual(logged, ["s", "s", "s"])
+
+    def test_session_list_pages(self):
+        # test that client reads sessions list of more than one page page by page, also changes made meanwhile
+        print("Testing paging of sessions list")
+
+        from client.gui import LobbyFrame
+
+        session_count = rpc_requests.SESSION_PAGE_SIZE * 2 + 50
+        for i in range(session_count):
+            session_name = "game%03d" % i
+            rpc_requests.SESSION_LIST[session_name] = {'session_name': session_name, 'player_count': 1,
+                                                       'max_count': 2, 'in_game': False}
+        reply = self.request(rpc_requests.on_request_connect, user="p1")
+        self.assertEqual(len(reply['sessions']), rpc_requests.SESSION_PAGE_SIZE)
+        self.assertEqual(reply['total'], session_count)
+        self.assertTrue(reply['more'])
+
+        test = self
+        pages = []
+
+        class Listbox(object):
+            def __init__(self):
+                self.items = []
+
+            def insert(self, index, item):
+                self.items.insert(index, item)
+
+            def delete(self, first, last=None):
+                del self.items[first:len(self.items) if last is not None else first + 1]
+
+        class Window(object):
+            # answers calls of lobby right away with list_sessions handler of server
+            def call_async(self, method_name, callback, **data):
+                pages.append(data['after'])
+                if len(pages) == 1:  # session is removed while lobby is reading the list
+                    rpc_requests.SESSION_LIST.pop("game000")
+                    lobby.apply_games_delta(reply['seq'] + 1, 'remove', {'session_name': "game000"})
+                callback(test.request(rpc_requests.on_request_list_sessions, **data))
+
+        lobby = LobbyFrame.__new__(LobbyFrame)
+        lobby.parent, lobby.games_listbox = Window(), Listbox()
+        lobby.clear_games_list()
+        lobby.request_games_list(0, first_page=reply)
+
+        self.assertEqual(pages, ["game099", "game199"])
+        self.assertEqual(lobby.game_names, ["game%03d" % i for i in range(1, session_count)])
+        self.assertEqual(len(lobby.games_listbox.items), session_count - 1)
+        self.assertEqual(lobby.games_seq, {0: reply['seq'] + 1})
+        self.assertEqual(lobby.resync_deltas, {})
@@ -0,0 +1,38 @@
+# Test consistent hashing of game sessions to server shards
+
+from unittest import TestCase
+from common import HashRing
+
+
+class HashRingTests(TestCase):
+
+    def setUp(self):
+        self.keys = ["session%d" % i for i in range(1000)]
+
+    def test_spread(self):
+        # test that every shard gets a fair part of sessions
+        print("Testing spreading sessions to shards")
+
+        ring = HashRing(4)
+        counts = [0] * 4
+        for key in self.keys:
+            counts[ring.get_shard(key)] += 1
+
+        self.assertTrue(min(counts) > 150)
+
+    def test_adding_shard(self):
+        # test that adding shard moves sessions only to the new shard
+        print("Testing adding shard")
+
+        ring = HashRing(4)
+        new_ring = HashRing(5)
+
+        for key in self.keys:
+            self.assertTrue(new_ring.get_shard(key) in (ring.get_shard(key), 4))
+
+    def test_unicode_key(self):
+        # test that client and server (unicode from decoded messages) get the same shard
+        print("Testing unicode session names")
+
+        ring = HashRing(3)
+        self.assertEqual(ring.get_shard(u"m\xe4ng"), ring.get_shard(u"m\xe4ng".encode('utf-8')))
@@ -0,0 +1,34 @@
+# Test publishing from worker threads through connection thread
+
+from threading import Thread
+from time import time
+from unittest import TestCase
+from loopback import LoopbackBroker
+from server.workers import ThreadSafeChannel
+
+
+class ThreadSafeChannelTests(TestCase):
+
+    def test_flush_on_demand(self):
+        # test that connection thread is woken up to publish message queued by other thread
+        print("Testing publishing from worker thread")
+
+        broker = LoopbackBroker()
+        connection = broker.connect()
+        channel = connection.channel()
+        queue_name = channel.queue_declare(queue='replies').method.queue
+        received = []
+        channel.basic_consume(lambda ch, method, props, body: received.append(body), queue=queue_name)
+        safe_channel = ThreadSafeChannel(connection, channel)
+        self.assertEqual(connection.timeouts, [])  # queue is not polled
+
+        worker = Thread(target=safe_channel.basic_publish, kwargs={'exchange': '', 'routing_key': queue_name,
+                                                                   'body': 'reply'})
+        start = time()
+        worker.start()
+        while not received and time() - start < 1:
+            connection.process_data_events(time_limit=1)  # returns when there is something to do
+        worker.join()
+
+        self.assertEqual(received, ['reply'])
+        connection.close()